@@ -1,4 +1,27 @@
-from .m3inference import M3Inference
-from .m3twitter import M3Twitter
-from .preprocess import resize_imgs, update_json
-from .utils import get_lang
\ No newline at end of file
+import importlib
+
+# the public objects and their modules, imported on first access so that `import m3inference` does not import torch
+# and the other dependencies of the models
+_LAZY_OBJECTS = {
+    'M3Inference': 'm3inference',
+    'M3Twitter': 'm3twitter',
+    'compile_shards': 'shards',
+    'resize_imgs': 'preprocess',
+    'update_json': 'preprocess',
+    'ImageDownloader': 'preprocess',
+    'get_lang': 'utils',
+}
+
+__all__ = list(_LAZY_OBJECTS)
+
+
+def __getattr__(name):
+    if name not in _LAZY_OBJECTS:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    value = getattr(importlib.import_module(f'.{_LAZY_OBJECTS[name]}', __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
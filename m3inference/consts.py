@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # @Zijian Wang
 
+import logging
 import os
 import pickle
 
@@ -19,6 +20,31 @@ VISION_OUTPUT_SIZE = 2048
 USERNAME_LEN = 30
 SCREENNAME_LEN = 16
 DES_LEN = 200
+IMG_SIZE = 224  # height and width of the images of the vision model
+
+# inference parameter
+BUCKET_POOL_BATCHES = 32  # number of batches sorted together when bucketing by length
+QUANTIZE_CALIBRATION_IMAGES = 256  # number of images used to calibrate the int8 vision model
+# minimum text model confidence (highest probability) per category below which the cascade runs the full model
+CASCADE_THRESHOLDS = {'gender': 0.9, 'age': 0.7, 'org': 0.9}
+TOWER_THREADS = 4  # number of threads running the towers of the models concurrently (see `run_towers`)
+SERVER_MAX_BATCH_SIZE = 32  # maximum number of entries per batch of the inference server
+SERVER_MAX_WAIT_MS = 5  # maximum time an entry waits for its batch to fill up in the inference server
+PARALLEL_RANGES_PER_PROC = 4  # number of byte ranges of the input file per process in `parallel_infer`
+PARQUET_ROW_GROUP_SIZE = 2 ** 16  # minimum number of rows per row group of the Parquet output
+SHARD_SIZE = 2 ** 14  # number of entries per shard written by `compile_shards`
+SHARD_INDEX = 'shards.json'  # index of the shards in the output dir of `compile_shards`
+
+# preprocess parameter
+RESIZE_MANIFEST = 'manifest.jsonl'  # record of the resized images in the output dir of `resize_imgs`
+RESIZE_CHUNK_SIZE = 64  # number of images sent at a time to each process of `resize_imgs`
+
+# download parameter
+DOWNLOAD_THREADS = 32  # number of entries transformed concurrently by `M3Twitter.transform_jsonl`
+DOWNLOAD_PER_HOST = 8  # maximum number of concurrent connections to a host of `ImageDownloader`
+DOWNLOAD_TIMEOUT = 10  # seconds to wait for a connection or for data before an image download is retried
+DOWNLOAD_RETRIES = 3  # number of retries of a failed image download (connection errors, timeouts, 429 and 5xx)
+DOWNLOAD_BACKOFF = 0.5  # backoff factor of the retries, which wait 0, 2 * backoff, 4 * backoff... seconds
 
 # model dump parameter
 PRETRAINED_MODEL_ARCHIVE_MAP = {
@@ -32,6 +58,10 @@ PRETRAINED_MODEL_MD5_MAP = {
     'full_model': '7dd11b9d89d7fd209e3baa0058baa4a1',
     'text_model': 'c9a9fbd953b3ad5d84e792c3c50392ad'
 }
+MD5_CHUNK_SIZE = 2 ** 20  # number of bytes hashed at a time when checking a model file
+MD5_STAMP_SUFFIX = '.md5.json'  # sidecar file recording the size, mtime and MD5 of a checked model file
+MAPPED_WEIGHTS_SUFFIX = '_mapped.pt'  # copy of legacy model files in a format that can be memory-mapped
+ARTIFACT_META_SUFFIX = '.meta.json'  # sidecar file recording the weights and options of an exported model
 
 # unicode parameter
 UNICODE_CATS = 'Cc,Zs,Po,Sc,Ps,Pe,Sm,Pd,Nd,Lu,Sk,Pc,Ll,So,Lo,Pi,Cf,No,Pf,Lt,Lm,Mn,Cn,Me,Mc,Nl,Zl,Zp,Cs,Co'.split(",")
@@ -45,7 +75,26 @@ UNKNOWN_LANG = 'un'
 # embedding parameter
 EMBEDDING_INPUT_SIZE_LANGS = len(LANGS) + 1
 EMBEDDING_OUTPUT_SIZE_LANGS = 8
-EMB = pickle.load(open(os.path.join(os.path.dirname(__file__), "data", "emb.pkl"), "rb"))
+_EMB = None
+
+
+def get_emb():
+    '''
+    :return: the character ids of the text embeddings, loaded on the first call
+    '''
+    global _EMB
+    if _EMB is None:
+        with open(os.path.join(os.path.dirname(__file__), "data", "emb.pkl"), "rb") as f:
+            _EMB = pickle.load(f)
+    return _EMB
+
+
+def __getattr__(name):
+    # `EMB` is loaded on first access rather than at import time
+    if name == 'EMB':
+        return get_emb()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
 
 PRED_CATS = {
     'gender': ['male', 'female'],
@@ -55,3 +104,15 @@ PRED_CATS = {
 
 # Default profile image used on Twitter when no image has been specificed
 TW_DEFAULT_PROFILE_IMG = os.path.join(os.path.dirname(__file__), "data", "tw_default_profile.png")
+
+# logging parameter
+LOGGING_FORMAT = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s'
+LOGGING_DATEFMT = '%m/%d/%Y %H:%M:%S'
+
+
+def setup_logging():
+    '''
+    Log info messages to stderr, unless logging was configured by the application. It is called when a model is built
+    or images are preprocessed, rather than when the package is imported.
+    '''
+    logging.basicConfig(format=LOGGING_FORMAT, datefmt=LOGGING_DATEFMT, level=logging.INFO)
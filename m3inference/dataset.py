@@ -1,34 +1,39 @@
 #!/usr/bin/env python3
 # @Zijian Wang
 
-import unicodedata
+import json
+from collections import namedtuple
 
 from PIL import Image
-from torch.utils.data import Dataset
-from torchvision import transforms
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 
+from .tokenizer import get_tokenizer
 from .utils import *
+from .vision_cache import hash_image_file
 
 logger = logging.getLogger(__name__)
 
 
+# Images of a batch identified by key. `fig` holds the decoded images of the distinct `fig_keys`; the embeddings of
+# the other `keys` (one per entry) are looked up by the model wrapper.
+KeyedImages = namedtuple('KeyedImages', ['fig', 'fig_keys', 'keys'])
+# The image paths of a batch, whose images are only loaded (see `M3InferenceStreamDataset.load_images`) for the entries
+# that need them, e.g. those for which the text model of the cascade is unsure.
+ImagePaths = namedtuple('ImagePaths', ['paths'])
+
+
 class M3InferenceDataset(Dataset):
 
     def __init__(self, data: list, use_img=True):
 
-        self.tensor_trans = transforms.ToTensor()
+        self.tensor_trans = image_transform() if use_img else None
+        self.tokenizer = get_tokenizer()
+        # the entries are collated row by row, so every row has the same padded length
+        self.pad_to_max_len = True
         self.use_img = use_img
         self.data = []
         for entry in data:
-            entry = DotDict(entry)
-            if use_img:
-                self.data.append([entry.id, entry.lang, normalize_space(str(entry.name)),
-                                  normalize_space(str(entry.screen_name)),
-                                  normalize_url(normalize_space(str(entry.description))), entry.img_path])
-            else:
-                self.data.append([entry.id, entry.lang, normalize_space(str(entry.name)),
-                                  normalize_space(str(entry.screen_name)),
-                                  normalize_url(normalize_space(str(entry.description)))])
+            self.data.append(normalize_entry(entry, use_img))
 
         logger.info(f'{len(self.data)} data entries loaded.')
 
@@ -36,60 +41,222 @@ class M3InferenceDataset(Dataset):
         data = self.data[idx]
         return self._preprocess_data(data)
 
+    def __getitems__(self, indices):
+        # batched fetching (used by DataLoader on recent torch versions) so that the text is encoded per batch
+        return list(zip(*self._preprocess_batch([self.data[idx] for idx in indices])))
+
     def _preprocess_data(self, data):
+        return tuple(i[0] for i in self._preprocess_batch([data]))
+
+    def _preprocess_batch(self, data):
         if self.use_img:
-            _id, lang, username, screenname, des, img_path = data
-            # image
-            fig = self._image_loader(img_path)
+            _ids, langs, usernames, screennames, des, img_paths = zip(*data)
         else:
-            _id, lang, username, screenname, des = data
+            _ids, langs, usernames, screennames, des = zip(*data)
 
         # text
-        lang_tensor = LANGS[lang]
-
-        username_tensor = [0] * USERNAME_LEN
-        if username.strip(" ") == "":
-            username_tensor[0] = EMB["<empty>"]
-            username_len = 1
-        else:
-            if len(username) > USERNAME_LEN:
-                username = username[:USERNAME_LEN]
-            username_len = len(username)
-            username_tensor[:username_len] = [EMB.get(i, len(EMB) + 1) for i in username]
-
-        screenname_tensor = [0] * SCREENNAME_LEN
-        if screenname.strip(" ") == "":
-            screenname_tensor[0] = 32
-            screenname_len = 1
-        else:
-            if len(screenname) > SCREENNAME_LEN:
-                screenname = screenname[:SCREENNAME_LEN]
-            screenname_len = len(screenname)
-            screenname_tensor[:screenname_len] = [ord(i) for i in screenname]
-
-        des_tensor = [0] * DES_LEN
-        if des.strip(" ") == "":
-            des_tensor[0] = EMB["<empty>"]
-            des_len = 1
-        else:
-            if len(des) > DES_LEN:
-                des = des[:DES_LEN]
-            des_len = len(des)
-            des_tensor[:des_len] = [EMB.get(i, EMB[unicodedata.category(i)]) for i in des]
+        lang_tensor = torch.LongTensor([LANGS[lang] for lang in langs])
+        username_tensor, username_len = self.tokenizer.encode_username(usernames, self.pad_to_max_len)
+        screenname_tensor, screenname_len = self.tokenizer.encode_screenname(screennames, self.pad_to_max_len)
+        des_tensor, des_len = self.tokenizer.encode_des(des, self.pad_to_max_len)
 
+        batch = [lang_tensor, torch.from_numpy(username_tensor), torch.from_numpy(username_len),
+                 torch.from_numpy(screenname_tensor), torch.from_numpy(screenname_len),
+                 torch.from_numpy(des_tensor), torch.from_numpy(des_len)]
         if self.use_img:
-            return lang_tensor, torch.LongTensor(username_tensor), username_len, torch.LongTensor(
-                screenname_tensor), screenname_len, torch.LongTensor(des_tensor), des_len, fig
-        else:
-            return lang_tensor, torch.LongTensor(username_tensor), username_len, torch.LongTensor(
-                screenname_tensor), screenname_len, torch.LongTensor(des_tensor), des_len
+            # image
+            batch.append(self._load_images(img_paths))
+        return batch
+
+    def _load_images(self, img_paths):
+        return torch.stack([self._image_loader(img_path) for img_path in img_paths])
 
     def __len__(self):
         return len(self.data)
 
     def _image_loader(self, image_name):
-        image = Image.open(image_name)
-        return self.tensor_trans(image)
+        return load_image(image_name, self.tensor_trans)
+
+
+class M3InferenceStreamDataset(IterableDataset):
+    '''
+    Streaming counterpart of `M3InferenceDataset`.
+    Entries are read lazily and yielded as collated chunks of `(ids, batch, positions)`, so memory does not grow with
+    the input. Use it with `DataLoader(..., batch_size=None)`. With multiple workers, chunk `i` is handled by worker
+    `i % num_workers`, which makes the DataLoader return the chunks in input order.
+    When `bucket_pool` is set, pools of `bucket_pool` chunks are sorted by description and username length before being
+    split into chunks, so that each chunk holds texts of similar length. `positions` then holds the input index of each
+    entry to restore the order (it is `None` otherwise).
+    When `vision_cache` or `constant_images` is given, the images are keyed by content hash and the image slot of the
+    batch is a `KeyedImages` in which only the images that are neither cached nor constant are decoded.
+    When `lazy_images` is set, the image slot is an `ImagePaths`, and the images are neither hashed nor decoded.
+    '''
+
+    def __init__(self, data_or_datapath, use_img=True, chunk_size=BATCH_SIZE, vision_cache=None,
+                 constant_images=None, bucket_pool=None, uint8_images=False, lazy_images=False):
+        '''
+        :param data_or_datapath: the path to a jsonl file or an iterable of jsons (an iterator can only be consumed by
+                                 a single process, so it requires `num_workers=0`)
+        :param use_img: whether to load the profile images
+        :param chunk_size: the number of entries per yielded chunk
+        :param vision_cache: a `VisionCache` whose images are not decoded
+        :param constant_images: a dict of image path to key of images with precomputed embeddings, which are not decoded
+        :param bucket_pool: the number of chunks sorted together by text length (`None` to keep the input order)
+        :param uint8_images: whether to load the images as uint8 tensors (with values in [0, 255]) rather than as float
+                             tensors in [0, 1], for models that convert them on the fly
+        :param lazy_images: whether to yield the image paths instead of the images, to be loaded with `load_images`
+        '''
+        self.data_or_datapath = data_or_datapath
+        self.use_img = use_img
+        self.chunk_size = chunk_size
+        self.vision_cache = vision_cache
+        self.constant_images = {} if constant_images is None else \
+            {os.path.abspath(img_path): key for img_path, key in constant_images.items()}
+        self.bucket_pool = bucket_pool
+        self.lazy_images = lazy_images
+        self.tensor_trans = image_transform(uint8_images) if use_img else None
+        self.tokenizer = get_tokenizer()
+        # the chunks are collated at once, so the text is only padded to the longest one of each field
+        self.pad_to_max_len = False
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        if num_workers > 1 and iter(self.data_or_datapath) is self.data_or_datapath:
+            raise ValueError('An iterator can only be read by a single process. Please use `num_workers=0`.')
+
+        pool_size = self.chunk_size * (self.bucket_pool or 1)
+        pool = []
+        for idx, entry in enumerate(self._iter_raw()):
+            # entries of pools owned by other workers are skipped before being parsed
+            if (idx // pool_size) % num_workers != worker_id:
+                continue
+            pool.append((idx, entry))
+            if len(pool) == pool_size:
+                yield from self._preprocess_pool(pool)
+                pool = []
+        if pool:
+            yield from self._preprocess_pool(pool)
+
+    def _iter_raw(self):
+        if isinstance(self.data_or_datapath, str):
+            with open(self.data_or_datapath) as f:
+                for line in f:
+                    if line.strip():
+                        yield line
+        else:
+            yield from self.data_or_datapath
+
+    def _preprocess_pool(self, pool):
+        positions = [idx for idx, _ in pool]
+        rows = [normalize_entry(json.loads(entry) if isinstance(entry, str) else entry, self.use_img)
+                for _, entry in pool]
+        if self.bucket_pool:
+            order = sorted(range(len(rows)), key=lambda i: (min(len(rows[i][4]), DES_LEN),
+                                                            min(len(rows[i][2]), USERNAME_LEN)))
+            rows = [rows[i] for i in order]
+            positions = [positions[i] for i in order]
+
+        for start in range(0, len(rows), self.chunk_size):
+            chunk = rows[start:start + self.chunk_size]
+            yield [row[0] for row in chunk], self._preprocess_batch(chunk), \
+                  positions[start:start + self.chunk_size] if self.bucket_pool else None
+
+    def _load_images(self, img_paths):
+        if self.lazy_images:
+            return ImagePaths(list(img_paths))
+        return self.load_images(img_paths)
+
+    def load_images(self, img_paths):
+        '''
+        :param img_paths: the image paths of the entries of a batch
+        :return: the image slot of the batch: a tensor of the images, or a `KeyedImages`
+        '''
+        if self.vision_cache is None and not self.constant_images:
+            return M3InferenceDataset._load_images(self, img_paths)
+        # registered images are recognized by path before falling back to hashing the content
+        path_keys = {}
+        for img_path in img_paths:
+            if img_path not in path_keys:
+                path_keys[img_path] = self.constant_images.get(os.path.abspath(img_path)) or hash_image_file(img_path)
+        keys = [path_keys[img_path] for img_path in img_paths]
+
+        # decode each image that is neither constant nor cached once, even if several entries share it
+        constant_keys = set(self.constant_images.values())
+        cached = self.vision_cache.lookup(keys) >= 0 if self.vision_cache is not None else [False] * len(keys)
+        missing = {}
+        for i, key in enumerate(keys):
+            if not cached[i] and key not in constant_keys and key not in missing:
+                missing[key] = i
+        if missing:
+            fig = torch.stack([self._image_loader(img_paths[i]) for i in missing.values()])
+        else:
+            fig = torch.empty(0)
+        return KeyedImages(fig, list(missing), keys)
+
+    _preprocess_batch = M3InferenceDataset._preprocess_batch
+    _image_loader = M3InferenceDataset._image_loader
+
+
+def image_transform(uint8_images=False):
+    '''
+    :return: the conversion of the images to uint8 tensors in [0, 255], or to float tensors in [0, 1]
+    '''
+    # torchvision is only imported when images are loaded
+    from torchvision import transforms
+    return transforms.PILToTensor() if uint8_images else transforms.ToTensor()
+
+
+def load_image(image_name, tensor_trans=None):
+    return (image_transform() if tensor_trans is None else tensor_trans)(decode_image(image_name))
+
+
+def decode_image(image_name):
+    '''
+    Decode an image as an RGB image of `IMG_SIZE`x`IMG_SIZE`, resized with a bilinear filter as by `resize_imgs`.
+    JPEG images of at least twice that size are decoded straight at a reduced scale (1/2, 1/4 or 1/8, see
+    `Image.draft`), which skips most of the decoding work, before being resized.
+    :param image_name: the path to the image
+    :return: the PIL image
+    '''
+    image = Image.open(image_name)
+    if image.size != (IMG_SIZE, IMG_SIZE):
+        # a no-op for other formats than JPEG
+        image.draft('RGB', (IMG_SIZE, IMG_SIZE))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if image.size != (IMG_SIZE, IMG_SIZE):
+        image = image.resize((IMG_SIZE, IMG_SIZE), Image.BILINEAR)
+    return image
+
+
+def select_images(images, rows):
+    '''
+    :param images: the image slot of a batch (a tensor of images or embeddings, `KeyedImages` or `ImagePaths`)
+    :param rows: an array of the indices of the entries to keep
+    :return: the image slot of the selected entries
+    '''
+    if isinstance(images, ImagePaths):
+        return ImagePaths([images.paths[i] for i in rows])
+    if not isinstance(images, KeyedImages):
+        return images[torch.from_numpy(rows)]
+    keys = [images.keys[i] for i in rows]
+    selected_keys = set(keys)
+    fig_rows = [i for i, key in enumerate(images.fig_keys) if key in selected_keys]
+    fig = images.fig[torch.tensor(fig_rows, dtype=torch.int64)] if fig_rows else torch.empty(0)
+    return KeyedImages(fig, [images.fig_keys[i] for i in fig_rows], keys)
+
+
+def normalize_entry(entry, use_img=True):
+    entry = DotDict(entry)
+    if use_img:
+        return [entry.id, entry.lang, normalize_space(str(entry.name)),
+                normalize_space(str(entry.screen_name)),
+                normalize_url(normalize_space(str(entry.description))), entry.img_path]
+    else:
+        return [entry.id, entry.lang, normalize_space(str(entry.name)),
+                normalize_space(str(entry.screen_name)),
+                normalize_url(normalize_space(str(entry.description)))]
 
 
 if __name__ == "__main__":
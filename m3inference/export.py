@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import copy
+import inspect
+
+import torch
+import torch.nn as nn
+
+from .consts import *
+from .dataset import M3InferenceStreamDataset
+from .vision_cache import VISION_EMBEDDING_SIZE
+
+# names of the inputs of the exported ONNX models, in the order of the batches of `M3InferenceStreamDataset`
+ONNX_INPUT_NAMES = ['lang', 'username', 'username_len', 'screenname', 'screenname_len', 'des', 'des_len']
+ONNX_OUTPUT_NAMES = list(PRED_CATS)
+# the TorchScript-based exporter is the default before torch 2.5, which has no `dynamo` argument
+ONNX_EXPORT_KWARGS = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+
+# entries used to trace the models, with different text lengths (including empty ones)
+EXAMPLE_DATA = [
+    {'id': '0', 'name': 'M3 Inference', 'screen_name': 'm3inference', 'description': 'Demographic inference #M3 🙂',
+     'lang': 'en', 'img_path': TW_DEFAULT_PROFILE_IMG},
+    {'id': '1', 'name': 'x', 'screen_name': '', 'description': '', 'lang': 'un', 'img_path': TW_DEFAULT_PROFILE_IMG},
+    {'id': '2', 'name': 'Zijian Wang', 'screen_name': 'zijwang', 'description': 'https://m3 ' * 20, 'lang': 'fr',
+     'img_path': TW_DEFAULT_PROFILE_IMG}
+]
+
+
+def example_batch(use_img):
+    '''
+    :return: a batch of `EXAMPLE_DATA`, with the images replaced by vision embeddings for the full model
+    '''
+    _, batch, _ = next(iter(M3InferenceStreamDataset(EXAMPLE_DATA, use_img=use_img, chunk_size=len(EXAMPLE_DATA))))
+    if use_img:
+        batch = batch[:-1] + [torch.zeros(len(EXAMPLE_DATA), VISION_EMBEDDING_SIZE)]
+    return batch
+
+
+def trace_model(model, use_img, device='cpu'):
+    '''
+    Compile an eager model to TorchScript, which runs without the Python model code (e.g. after `torch.jit.load`).
+    The `forward` of the traced full model takes vision embeddings in the image slot; images are embedded with its
+    `embed_images` method.
+    :param model: an `M3InferenceModel` (`use_img=True`) or `M3InferenceTextModel` (`use_img=False`) in eval mode
+    :return: a `torch.jit.ScriptModule`
+    '''
+    batch = [i.to(device) for i in example_batch(use_img)]
+    with torch.no_grad():
+        if use_img:
+            fig = torch.zeros(1, 3, 224, 224, device=device)
+            return torch.jit.trace_module(model, {'forward': (batch,), 'embed_images': (fig,)}, strict=False)
+        else:
+            return torch.jit.trace(model, (batch,), strict=False)
+
+
+class _FlatInputs(nn.Module):
+    # ONNX graphs take the tensors of a batch as separate inputs
+    def __init__(self, model):
+        super(_FlatInputs, self).__init__()
+        self.model = model
+
+    def forward(self, *batch):
+        return self.model(list(batch))
+
+
+class _EmbedImages(nn.Module):
+    def __init__(self, model):
+        super(_EmbedImages, self).__init__()
+        self.model = model
+
+    def forward(self, fig):
+        return self.model.embed_images(fig)
+
+
+def export_onnx(model, use_img, f, vision_f=None):
+    '''
+    Export an eager model to ONNX, with dynamic batch and sequence axes. The graph of the full model takes vision
+    embeddings as its `fig` input; the vision model is exported as a separate graph to `vision_f`.
+    :param model: an `M3InferenceModel` (`use_img=True`) or `M3InferenceTextModel` (`use_img=False`) in eval mode
+    :param f: the path or file-like object to write the model to
+    :param vision_f: (full model only) the path or file-like object to write the vision model to
+    '''
+    # the exporter applies the dropout between stacked LSTM layers even in eval mode, where it has no effect
+    model = copy.deepcopy(model).cpu()
+    model.concurrent_towers = False
+    for module in model.modules():
+        if isinstance(module, nn.LSTM):
+            module.dropout = 0
+
+    input_names = ONNX_INPUT_NAMES + (['fig'] if use_img else [])
+    dynamic_axes = {name: {0: 'batch'} for name in input_names + ONNX_OUTPUT_NAMES}
+    for name in ['username', 'screenname', 'des']:
+        dynamic_axes[name][1] = f'{name}_seq'
+    with torch.no_grad():
+        torch.onnx.export(_FlatInputs(model), tuple(example_batch(use_img)), f, input_names=input_names,
+                          output_names=ONNX_OUTPUT_NAMES, dynamic_axes=dynamic_axes, **ONNX_EXPORT_KWARGS)
+        if use_img:
+            torch.onnx.export(_EmbedImages(model), (torch.zeros(1, 3, 224, 224),), vision_f, input_names=['fig'],
+                              output_names=['vision_output'],
+                              dynamic_axes={'fig': {0: 'batch', 2: 'height', 3: 'width'}, 'vision_output': {0: 'batch'}},
+                              **ONNX_EXPORT_KWARGS)
+
+
+class OnnxRuntimeModel:
+    '''
+    Runs exported ONNX models with onnxruntime on CPU, behind the interface of the torch models used by `M3Inference`.
+    '''
+
+    def __init__(self, model_f, vision_f=None):
+        '''
+        :param model_f: the path to (or the bytes of) a model written by `export_onnx`
+        :param vision_f: the path to (or the bytes of) the vision model of the full model
+        '''
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError('The onnxruntime backend requires onnxruntime. Please run `pip install onnxruntime`.')
+        self.session = onnxruntime.InferenceSession(model_f, providers=['CPUExecutionProvider'])
+        self.vision_session = None if vision_f is None else \
+            onnxruntime.InferenceSession(vision_f, providers=['CPUExecutionProvider'])
+
+    def __call__(self, batch):
+        inputs = {name: tensor.cpu().numpy() for name, tensor in zip(ONNX_INPUT_NAMES + ['fig'], batch)}
+        return tuple(torch.from_numpy(output) for output in self.session.run(None, inputs))
+
+    def embed_images(self, fig):
+        return torch.from_numpy(self.vision_session.run(None, {'fig': fig.cpu().numpy()})[0])
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        return self
@@ -1,23 +1,26 @@
 #!/usr/bin/env python3
 # @Zijian Wang
 
+import contextlib
+import io
 import json
 from collections import *
 from os.path import expanduser
 
-import pandas as pd
 import torch.nn as nn
 from torch.utils.data import DataLoader
 
 from .consts import *
-from .dataset import M3InferenceDataset
-from .full_model import M3InferenceModel
+from .dataset import ImagePaths, KeyedImages, M3InferenceStreamDataset, load_image, select_images
+from .export import OnnxRuntimeModel, export_onnx, trace_model
+from .full_model import Bfloat16VisionModel, M3InferenceModel
+from .output import OUTPUT_SINKS, PRED_COLUMNS
+from .parallel import parallel_predict
+from .quantization import quantize_text, quantize_vision
+from .shards import M3InferenceShardDataset
 from .text_model import M3InferenceTextModel
 from .utils import *
-
-logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
-                    datefmt='%m/%d/%Y %H:%M:%S',
-                    level=logging.INFO)
+from .vision_cache import VisionCache, hash_image_file
 
 logger = logging.getLogger(__name__)
 
@@ -28,120 +31,545 @@ class M3Inference:
     '''
 
     def __init__(self, model_dir=expanduser("~/m3/models/"), pretrained=True, use_full_model=True, use_cuda=True,
-                 parallel=False, seed=0, skip_logging=False):
+                 parallel=False, seed=0, skip_logging=False, vision_cache_dir=None, use_torchscript=False,
+                 backend='torch', quantize=None, quantize_calibration_data=None, vision_bf16=False, cascade=False,
+                 cascade_thresholds=None, concurrent_towers=False, weights_path=None):
         '''
         :param model_dir: the dir to cache/read cacahed model dump
-        :param pretrained: whether to load pretrained weight
+        :param pretrained: whether to load pretrained weight. The weights are memory-mapped from `model_dir` (legacy model files are converted once to a mappable copy next to them), and their MD5 is only checked again when the files change.
         :param use_full_model: whether to use the full m3 model (it is not recommended to set `use_full_model` to False unless you do not have profile images)
         :param use_cuda: whether to run on a GPU (effective only when there is a GPU)
         :param parallel: when to use DataParallel to infer on multiple GPUs (effective only when `use_cuda=True` and there are multiple available GPUs).
         :param seed: set random seed for `random`, `numpy.random`, and `torch`
         :param skip_logging: whether to skip the logger info and tqdm bar
+        :param vision_cache_dir: (full model only) the dir of a persistent cache of image embeddings keyed by image content. Cached images are neither decoded nor passed through the vision model on later runs.
+        :param use_torchscript: whether to run a compiled TorchScript model. With `pretrained=True`, it is loaded from `model_dir` if it was exported before (which skips building the model in Python and loading its weights), otherwise it is compiled from the pretrained weights and saved to `model_dir`. A saved model is only loaded if it was compiled with the same `concurrent_towers` and from the current weights in `model_dir` (see `ARTIFACT_META_SUFFIX`); otherwise it is compiled again.
+        :param backend: `torch` or `onnxruntime` (CPU only, requires the `onnxruntime` package). With `onnxruntime` and `pretrained=True`, the ONNX models are loaded from `model_dir` if they were exported before from the current weights in `model_dir`, otherwise they are exported from the pretrained weights and saved to `model_dir`.
+        :param quantize: `None` or `int8` to run a dynamically quantized model on CPU (with the `torch` backend): the LSTM and linear layers of the text side are quantized to int8, the vision model is kept in fp32 unless `quantize_calibration_data` is given.
+        :param quantize_calibration_data: (full model, with `quantize='int8'`) a list of jsons or the path to a jsonl file whose images are used to calibrate a static int8 quantization of the vision model
+        :param vision_bf16: (full model, with the eager `torch` backend) whether to run the vision model in bfloat16 with the channels_last memory format, on images loaded as uint8. It is faster on CPUs with bf16 instructions (e.g. AVX512-BF16 or AMX), at a small cost in precision.
+        :param cascade: (full model only) whether to predict with the text model first, and with the full model only for the entries for which the text model is unsure (see `cascade_thresholds`). The output then records the model used for each entry (`model` is `text_model` or `full_model`). Only the images of the entries going through the full model are decoded, in this process rather than in the dataloader workers.
+        :param cascade_thresholds: a dict of category to the confidence (highest predicted probability) of the text model below which the full model is used, overriding `CASCADE_THRESHOLDS`
+        :param concurrent_towers: (`torch` backend) whether to run the independent towers of the model (username, screen name, description and image) concurrently rather than one after another, which lowers the latency of small batches on multi-core machines. A TorchScript model compiled with this option runs them as forked branches.
+        :param weights_path: the path of a weights file written by `save_weights` (from an instance with the same `use_full_model`, `pretrained` and `seed`), which is memory-mapped instead of loading the weights into memory: the model is built without allocating its own parameters, and the processes mapping the same file share its pages in physical memory (see `parallel_infer`).
 
         '''
+        # the arguments to build replicas of this instance (see `parallel_infer`)
+        self.init_kwargs = {k: v for k, v in locals().items() if k not in ['self', '__class__']}
+        assert backend in ['torch', 'onnxruntime']
+        assert quantize in [None, 'int8']
+        assert quantize is None or (backend == 'torch' and not use_torchscript), \
+            'Quantized models only run with the eager torch backend.'
+        assert quantize_calibration_data is None or (quantize and use_full_model), \
+            'Calibration data is only used to quantize the vision model of the full model.'
+        assert not vision_bf16 or (use_full_model and backend == 'torch' and not use_torchscript and
+                                   quantize_calibration_data is None), \
+            'bfloat16 is only used by the eager vision model of the full model.'
+        assert not cascade or use_full_model, 'The cascade falls back to the full model.'
+        assert cascade_thresholds is None or (cascade and set(cascade_thresholds) <= set(PRED_CATS))
         if seed is not None:
             set_seed(seed)
-        self.device = torch.device('cpu') if not use_cuda or not torch.cuda.is_available() else torch.device('cuda')
+        self.device = torch.device('cpu') if not use_cuda or not torch.cuda.is_available() or backend == 'onnxruntime' \
+            or quantize else torch.device('cuda')
         self.parallel = parallel
         self.use_full_model = use_full_model
+        self.vision_bf16 = vision_bf16
         self.model_type = 'full_model' if self.use_full_model else 'text_model'
         self.model_dir = model_dir
         self.skip_logging = skip_logging
+        # the file the weights of the model are memory-mapped from (see `load_mapped_weights`)
+        self.weights_path = None
+        # the MD5 of the pretrained weights file of the model (`None` for other weights)
+        self.weights_md5 = None
 
+        setup_logging()
         if self.skip_logging:
             logging.getLogger().setLevel(logging.WARN)
 
         logger.info('Version 1.1.5')
         logger.info(f'Running on {self.device.type}.')
 
-        if not pretrained:
-            logger.info(f'No pretrained model will be loaded.')
-            return
-
-        if self.use_full_model:
-            logger.info(f'Will use full M3 model.')
-            self.model = M3InferenceModel(device=self.device)
-            self.load_pretrained_model()
+        torchscript_path = os.path.join(self.model_dir, f'{self.model_type}.pt')
+        onnx_paths = self._onnx_paths(os.path.join(self.model_dir, f'{self.model_type}.onnx'))
+        if backend == 'onnxruntime' and pretrained and self._is_artifact_current(onnx_paths, 'onnx'):
+            logger.info(f'Loading ONNX model {self.model_type} from {onnx_paths[0]}.')
+            self.model = OnnxRuntimeModel(*onnx_paths)
+        elif use_torchscript and pretrained and self._is_artifact_current([torchscript_path], 'torchscript'):
+            logger.info(f'Loading TorchScript model {self.model_type} from {torchscript_path}.')
+            self.model = torch.jit.load(torchscript_path, map_location=self.device)
         else:
-            logger.info(f'Will use text model. Note that as M3 was optimized to work well with both image and text data, \
-                                    it is not recommended to use text only model unless you do not have the profile image.')
-            self.model = M3InferenceTextModel(device=self.device)
-            self.load_pretrained_model()
-
-        if self.device.type == 'cuda' and self.parallel:
-            dev_count = torch.cuda.device_count()
-            if dev_count > 1:
-                logger.info(f"Model to be paralleled on {dev_count} GPUs.")
-                self.model = nn.DataParallel(self.model)
-        self.model.to(self.device)
+            # the parameters of a model built on the meta device are neither allocated nor initialized before being
+            # replaced by the loaded weights
+            with torch.device('meta') if pretrained or weights_path is not None else contextlib.nullcontext():
+                if self.use_full_model:
+                    logger.info(f'Will use full M3 model.')
+                    self.model = M3InferenceModel(device=self.device)
+                else:
+                    logger.info(f'Will use text model. Note that as M3 was optimized to work well with both image and text data, \
+                                            it is not recommended to use text only model unless you do not have the profile image.')
+                    self.model = M3InferenceTextModel(device=self.device)
+
+            if weights_path is not None:
+                self.load_mapped_weights(weights_path)
+            elif pretrained:
+                self.load_pretrained_model()
+            else:
+                logger.info(f'No pretrained model will be loaded.')
+
+            if quantize:
+                self.model.eval()
+                logger.info(f'Quantizing the text model to {quantize}.')
+                self.model = quantize_text(self.model)
+                if quantize_calibration_data is not None:
+                    logger.info(f'Quantizing the vision model to {quantize}.')
+                    quantize_vision(self.model, quantize_calibration_data)
+            if vision_bf16:
+                logger.info(f'Running the vision model in bfloat16.')
+                self.model.vision_model = Bfloat16VisionModel(self.model.vision_model)
+            self.model.concurrent_towers = concurrent_towers
+
+            if self.device.type == 'cuda' and self.parallel and not use_torchscript and backend == 'torch':
+                dev_count = torch.cuda.device_count()
+                if dev_count > 1:
+                    logger.info(f"Model to be paralleled on {dev_count} GPUs.")
+                    self.model = nn.DataParallel(self.model)
+            self.model.to(self.device)
+            self.model.eval()
+
+            if use_torchscript:
+                logger.info(f'Compiling model {self.model_type} to TorchScript.')
+                self.model = trace_model(self.model, self.use_full_model, self.device)
+                if pretrained:
+                    self.export_torchscript(torchscript_path)
+            elif backend == 'onnxruntime':
+                logger.info(f'Exporting model {self.model_type} to ONNX.')
+                if pretrained:
+                    self.export_onnx(onnx_paths[0])
+                else:
+                    onnx_paths = [io.BytesIO() for path in onnx_paths if path]
+                    export_onnx(self.model, self.use_full_model, *onnx_paths)
+                    onnx_paths = [f.getvalue() for f in onnx_paths]
+                self.model = OnnxRuntimeModel(*onnx_paths)
         self.model.eval()
 
-    def load_pretrained_model(self):
+        self.cascade_model = None
+        if cascade:
+            logger.info(f'Will use the text model first and the full model when it is unsure.')
+            self.cascade_thresholds = dict(CASCADE_THRESHOLDS, **(cascade_thresholds or {}))
+            with torch.device('meta') if pretrained else contextlib.nullcontext():
+                self.cascade_model = M3InferenceTextModel(device=self.device)
+            if pretrained:
+                self.load_pretrained_model(self.cascade_model, 'text_model')
+            if quantize:
+                self.cascade_model = quantize_text(self.cascade_model.eval())
+            self.cascade_model.concurrent_towers = concurrent_towers
+            self.cascade_model.to(self.device)
+            self.cascade_model.eval()
+        # how many entries of the last `infer`/`infer_stream` call went through the full model in the cascade
+        self.cascade_stats = Counter()
+
+        self.vision_cache = None
+        if vision_cache_dir is not None and self.use_full_model:
+            model_tag = PRETRAINED_MODEL_MD5_MAP[self.model_type] if pretrained else f'untrained-seed-{seed}'
+            # the images are resized to `IMG_SIZE` when decoded (see `decode_image`)
+            model_tag += f'-{IMG_SIZE}'
+            if quantize_calibration_data is not None:
+                # the embeddings of the quantized vision model differ from the fp32 ones (and depend on the calibration)
+                model_tag += f'-{quantize}'
+            elif vision_bf16:
+                model_tag += '-bf16'
+            self.vision_cache = VisionCache(vision_cache_dir, model_tag)
+
+        # images with embeddings computed once at load time (path -> key, key -> embedding)
+        self.constant_images = {}
+        self.constant_embeddings = {}
+        # how the vision embeddings of the last `infer`/`infer_stream` call were obtained
+        self.vision_stats = Counter()
+        if self.use_full_model:
+            self.register_constant_image(TW_DEFAULT_PROFILE_IMG)
+
+    def register_constant_image(self, img_path):
+        '''
+        Precompute the vision embedding of an image shared by many users (e.g., a default profile image).
+        Entries with this image, whether referenced by this path or by a file with the same content, skip the image
+        decoding and the vision model. The Twitter default profile image is registered when the full model is used.
+        :param img_path: the path to the image
+        '''
+        assert self.use_full_model, 'Constant images are only used by the full model.'
+        key = hash_image_file(img_path)
+        with torch.no_grad():
+            fig = load_image(img_path).unsqueeze(0).to(self.device)
+            self.constant_embeddings[key] = self._image_embedder(fig)[0].cpu()
+        self.constant_images[img_path] = key
+        logger.info(f'Registered constant image {img_path}.')
+
+    @property
+    def _image_embedder(self):
+        return self.model.module.embed_images if isinstance(self.model, nn.DataParallel) else self.model.embed_images
+
+    def export_torchscript(self, export_path):
+        '''
+        Save the model as a compiled TorchScript artifact, which can be run with `use_torchscript=True` (by saving it as `{model_dir}/{model_type}.pt`) or loaded with `torch.jit.load` without this package's model code.
+        The `forward` of the full model takes vision embeddings in the image slot, computed from images by its `embed_images` method.
+        :param export_path: the path to write the artifact to
+        '''
+        model = self.model.module if isinstance(self.model, nn.DataParallel) else self.model
+        if not isinstance(model, torch.jit.ScriptModule):
+            model = trace_model(model, self.use_full_model, self.device)
+        model.save(export_path)
+        self._save_artifact_meta(export_path, 'torchscript')
+        logger.info(f'Saved TorchScript model to {export_path}.')
+
+    def export_onnx(self, export_path):
+        '''
+        Save the eager model as ONNX, which can be run with `backend='onnxruntime'` (by saving it as `{model_dir}/{model_type}.onnx`) or with any ONNX runtime.
+        The inputs are the tensors of a batch (see `ONNX_INPUT_NAMES`), with dynamic batch and sequence axes. The full model takes vision embeddings as its `fig` input, computed from images by the vision model saved next to it as `{model_type}_vision.onnx`.
+        :param export_path: the path to write the model to
+        '''
+        model = self.model.module if isinstance(self.model, nn.DataParallel) else self.model
+        assert isinstance(model, nn.Module) and not isinstance(model, torch.jit.ScriptModule), \
+            'Only eager models can be exported to ONNX.'
+        export_onnx(model, self.use_full_model, *self._onnx_paths(export_path))
+        self._save_artifact_meta(export_path, 'onnx')
+        logger.info(f'Saved ONNX model to {export_path}.')
+
+    def _artifact_meta(self, artifact_type, weights_md5):
+        # what an exported model depends on: the weights it was exported from, and the options of the TorchScript trace
+        meta = {'weights_md5': weights_md5}
+        if artifact_type == 'torchscript':
+            meta['concurrent_towers'] = self.init_kwargs['concurrent_towers']
+        return meta
+
+    def _save_artifact_meta(self, artifact_path, artifact_type):
+        with open(artifact_path + ARTIFACT_META_SUFFIX, 'w') as f:
+            json.dump(self._artifact_meta(artifact_type, self.weights_md5), f)
+
+    def _is_artifact_current(self, artifact_paths, artifact_type):
+        '''
+        :return: whether the model exported to `artifact_paths` (with `export_torchscript` or `export_onnx`) can be
+        loaded: it was exported with the current options, and from the current weights of `model_dir` (if any)
+        '''
+        if not all(os.path.isfile(path) for path in artifact_paths if path):
+            return False
+        try:
+            with open(artifact_paths[0] + ARTIFACT_META_SUFFIX) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            logger.info(f'{artifact_paths[0]} was exported without its options. It will be exported again.')
+            return False
+        model_path = os.path.join(self.model_dir, f'{self.model_type}.mdl')
+        weights_md5 = stamped_file_md5(model_path) if os.path.isfile(model_path) else meta.get('weights_md5')
+        if meta != self._artifact_meta(artifact_type, weights_md5):
+            logger.info(f'{artifact_paths[0]} was exported from other weights or options. It will be exported again.')
+            return False
+        self.weights_md5 = weights_md5
+        return True
+
+    def save_weights(self, path):
+        '''
+        Save the weights of the eager model (neither quantized nor in bfloat16) in a file that can be memory-mapped with `weights_path`.
+        :param path: the path to write the weights to
+        '''
+        model = self._eager_model()
+        assert model is not None, 'Only the weights of unconverted eager models can be saved.'
+        torch.save(model.state_dict(), path)
+        logger.info(f'Saved weights to {path}.')
+
+    def load_mapped_weights(self, weights_path, model=None):
+        '''
+        Replace the parameters of the model by the tensors of a weights file (e.g. written by `save_weights`). Files in the zipfile format of `torch.save` are memory-mapped copy-on-write: pages are read from the file on first use and shared with the other processes mapping it. Files in the legacy format are read into memory.
+        :param model: the model to load the weights into (`self.model` by default)
+        '''
+        model = self.model if model is None else model
+        mmap = zipfile.is_zipfile(weights_path)
+        model.load_state_dict(torch.load(weights_path, map_location='cpu', mmap=mmap, weights_only=True), assign=True)
+        if mmap and model is self.model:
+            self.weights_path = weights_path
+        logger.info(f'{"Mapped" if mmap else "Loaded"} weights at {weights_path}')
+
+    def _eager_model(self):
+        # the model whose weights have the layout of the pretrained weights, `None` if it was converted
+        model = self.model.module if isinstance(self.model, nn.DataParallel) else self.model
+        if not isinstance(model, (M3InferenceModel, M3InferenceTextModel)) or self.init_kwargs['quantize'] \
+                or self.vision_bf16:
+            return None
+        return model
+
+    def _onnx_paths(self, onnx_path):
+        # the path of the model and of the vision model of the full model (`None` for the text model)
+        return onnx_path, os.path.splitext(onnx_path)[0] + '_vision.onnx' if self.use_full_model else None
+
+    def load_pretrained_model(self, model=None, model_type=None):
+        '''
+        :param model: the model to load the weights into (`self.model` by default)
+        :param model_type: `full_model` or `text_model` (`self.model_type` by default)
+        '''
+        model = self.model if model is None else model
+        model_type = self.model_type if model_type is None else model_type
         if not os.path.isdir(self.model_dir):
             logger.info(f'Dir {self.model_dir} does not exist. Creating now.')
             os.makedirs(self.model_dir)
             logger.info(f'Dir {self.model_dir} created.')
 
-        model_path = os.path.join(self.model_dir, f'{self.model_type}.mdl')
+        model_path = os.path.join(self.model_dir, f'{model_type}.mdl')
 
         if not os.path.isfile(model_path):
-            logger.info(f'Model {self.model_type} does not exist at {model_path}. Try to download it now.')
-            if self.model_type in PRETRAINED_MODEL_ARCHIVE_MAP:
-                fetch_pretrained_model(self.model_type, model_path)
-                self.load_model_weight(model_path)
+            logger.info(f'Model {model_type} does not exist at {model_path}. Try to download it now.')
+            if model_type in PRETRAINED_MODEL_ARCHIVE_MAP:
+                fetch_pretrained_model(model_type, model_path)
+                self.load_model_weight(model_path, model=model, model_type=model_type)
             else:
-                logger.info(f"Model {self.model_type} is not in out pretrained model list. \
+                logger.info(f"Model {model_type} is not in out pretrained model list. \
                             Consider {list(PRETRAINED_MODEL_ARCHIVE_MAP.keys())}.")
         else:
-            logger.info(f'Model {self.model_type} exists at {model_path}.')
-            self.load_model_weight(model_path, need_check=True)
+            logger.info(f'Model {model_type} exists at {model_path}.')
+            self.load_model_weight(model_path, need_check=True, model=model, model_type=model_type)
 
-    def load_model_weight(self, model_path, need_check=False):
+    def load_model_weight(self, model_path, need_check=False, model=None, model_type=None):
+        model = self.model if model is None else model
+        model_type = self.model_type if model_type is None else model_type
         if need_check:
-            check_file_md5(self.model_type, model_path)
-        self.model.load_state_dict(torch.load(model_path, map_location=self.device))
+            check_file_md5(model_type, model_path)
+        self.load_mapped_weights(mappable_weights(model_path) or model_path, model)
+        if model is self.model:
+            self.weights_md5 = stamped_file_md5(model_path)
         logger.info(f'Loaded pretrained weight at {model_path}')
 
-    def infer(self, data_or_datapath, output_format='json', batch_size=16, num_workers=4):
+    def infer(self, data_or_datapath, output_format='json', batch_size=16, num_workers=4, bucket_by_length=False,
+              output_path=None):
         """
         Predict attributes
-        :param data_or_datapath: a list of jsons or the path to the json file. For each json entry, the following keys are expected: `id`, `name`, `screen_name`, `description`, `lang`, `img_path` (required when using the full model)
-        :param output_format: `json` (with `id` as key and predictions as nested values) or `dataframe` (pandas dataframe)
+        :param data_or_datapath: a list of jsons or the path to the json file. For each json entry, the following keys are expected: `id`, `name`, `screen_name`, `description`, `lang`, `img_path` (required when using the full model). It can also be the dir of shards written by `compile_shards`, which are read without parsing, tokenizing or decoding the entries (the vision cache, the constant images and `bucket_by_length` are then not used, and the ids are strings).
+        :param output_format: `json` (with `id` as key and predictions as nested values) or `dataframe` (pandas dataframe), or a columnar file written to `output_path` batch by batch: `parquet` or `arrow` (an Arrow IPC file), which require pyarrow, or `npy` (a dir of one `.npy` file per column, see `NumpyOutputSink`)
         :param batch_size: batch_size for dataloader
         :param num_workers: number of workers for dataloader
-        :return: an object in `output_format` format
+        :param bucket_by_length: whether to batch together entries with similar description and username lengths (the output keeps the input order)
+        :param output_path: (columnar formats) the path to write the output to. The input file is then read lazily, and neither the input nor the output is held in memory.
+        :return: an object in `output_format` format (`output_path` for the columnar formats)
         """
-        assert output_format in ['json', 'dataframe']
-        if isinstance(data_or_datapath, str):
+        assert output_format in ['json', 'dataframe'] + list(OUTPUT_SINKS)
+        if output_format in OUTPUT_SINKS:
+            assert output_path is not None, f'The {output_format} output is written to `output_path`.'
+            with OUTPUT_SINKS[output_format](output_path) as sink:
+                for ids, pred in self._predict_batches(data_or_datapath, batch_size, num_workers, bucket_by_length):
+                    sink.write(ids, pred)
+            logger.info(f'Saved predictions to {output_path}.')
+            return output_path
 
-            # jsonl file path, if not working, raise an error
-            data = []
-            with open(data_or_datapath) as f:
-                for line in f:
-                    data.append(json.loads(line))
+        if isinstance(data_or_datapath, str) and os.path.isdir(data_or_datapath):
+            # compiled shards hold the ids
+            data, y_pred = [], []
+            for ids, pred in self._predict_batches(data_or_datapath, batch_size, num_workers):
+                data.extend({'id': _id} for _id in ids)
+                y_pred.append(pred)
         else:
-            # json object
-            data = data_or_datapath
-        # prediction
-        dataloader = DataLoader(M3InferenceDataset(data, use_img=self.use_full_model), batch_size,
-                                num_workers=num_workers, pin_memory=True)
-        y_pred = []
-        with torch.no_grad():
-            for batch in tqdm(dataloader, desc='Predicting...', disable=logging.root.level>=logging.WARN):
-                batch = [i.to(self.device) for i in batch]
-                pred = self.model(batch)
-                y_pred.append([_pred.detach().cpu().numpy() for _pred in pred])
+            if isinstance(data_or_datapath, str):
+                # jsonl file path, if not working, raise an error
+                data = []
+                with open(data_or_datapath) as f:
+                    for line in f:
+                        data.append(json.loads(line))
+            else:
+                # json object
+                data = data_or_datapath
+            # prediction
+            y_pred = [pred for _, pred in self._predict_batches(data, batch_size, num_workers, bucket_by_length,
+                                                               total=-(-len(data) // batch_size))]
 
         if output_format == 'json':
             return self.format_json_output(data, y_pred)
         else:
             return self.format_dataframe_output(data, y_pred)
 
+    def infer_stream(self, data_or_datapath, output_format='json', batch_size=16, num_workers=4,
+                     bucket_by_length=False):
+        """
+        Predict attributes lazily, yielding the results batch by batch in input order. Memory stays bounded regardless of the input size.
+        :param data_or_datapath: an iterable of jsons, the path to the jsonl file (see `infer` for the expected keys) or the dir of compiled shards. Iterators (e.g., generators) can only be read once, so they are preprocessed in this process (`num_workers` is ignored for them).
+        :param output_format: `json` or `dataframe` (see `infer`), applied to each yielded batch. Duplicated ids are only detected within a batch.
+        :param batch_size: the number of entries per yielded batch
+        :param num_workers: number of workers for dataloader
+        :param bucket_by_length: whether to batch together entries with similar description and username lengths (the output keeps the input order)
+        :return: a generator of objects in `output_format` format
+        """
+        assert output_format in ['json', 'dataframe']
+        for ids, pred in self._predict_batches(data_or_datapath, batch_size, num_workers, bucket_by_length):
+            data = [{'id': _id} for _id in ids]
+            if output_format == 'json':
+                yield self.format_json_output(data, [pred])
+            else:
+                yield self.format_dataframe_output(data, [pred])
+
+    def parallel_infer(self, datapath, n_procs=os.cpu_count(), threads_per_proc=1, output_format='json', batch_size=16,
+                       bucket_by_length=False, share_weights=True):
+        """
+        Predict attributes with `n_procs` replicas of the model in worker processes, each limited to `threads_per_proc` torch threads. The jsonl file is split into byte ranges, which the workers read and predict independently. The output is in input order, as with `infer`.
+        The workers are spawned and build their replica with the arguments of this instance (registered constant images included), so scripts calling it need an `if __name__ == '__main__':` guard. Embeddings computed by the workers are not added to the vision cache.
+        :param datapath: the path to the jsonl file (see `infer` for the expected keys)
+        :param n_procs: the number of worker processes
+        :param threads_per_proc: the number of torch threads of each worker
+        :param output_format: `json` or `dataframe` (see `infer`)
+        :param batch_size: batch_size of each worker
+        :param bucket_by_length: whether to batch together entries with similar description and username lengths within each range (the output keeps the input order)
+        :param share_weights: whether the workers memory-map the weights of this instance (the file they were mapped from, or a temporary copy written with `save_weights`) rather than each loading a private copy, so that the physical memory of the weights does not grow with `n_procs`. Quantized and bfloat16 models are converted by each worker after mapping the weights, and models loaded from TorchScript or ONNX files are not shared.
+        :return: an object in `output_format` format
+        """
+        assert output_format in ['json', 'dataframe']
+        ids, y_pred = parallel_predict(self, datapath, n_procs, threads_per_proc, batch_size, bucket_by_length,
+                                       share_weights)
+        data = [{'id': _id} for _id in ids]
+        if output_format == 'json':
+            return self.format_json_output(data, y_pred)
+        else:
+            return self.format_dataframe_output(data, y_pred)
+
+    def _predict_batches(self, data_or_datapath, batch_size, num_workers, bucket_by_length=False, total=None):
+        if isinstance(data_or_datapath, str) and os.path.isdir(data_or_datapath):
+            dataset = M3InferenceShardDataset(data_or_datapath, use_img=self.use_full_model, chunk_size=batch_size,
+                                              uint8_images=self.vision_bf16)
+        else:
+            if not isinstance(data_or_datapath, str) and iter(data_or_datapath) is data_or_datapath:
+                # each worker would read its own copy of a one-shot iterator (sharing the offset of a file it reads)
+                num_workers = 0
+            dataset = self._stream_dataset(data_or_datapath, chunk_size=batch_size,
+                                           bucket_pool=BUCKET_POOL_BATCHES if bucket_by_length else None)
+        dataloader = DataLoader(dataset, batch_size=None, num_workers=num_workers, pin_memory=True)
+        self.vision_stats = Counter()
+        self.cascade_stats = Counter()
+        with torch.no_grad():
+            batches = tqdm(dataloader, desc='Predicting...', total=total, disable=logging.root.level>=logging.WARN)
+            yield from self._restore_order(((ids, self._predict_batch(batch), positions)
+                                            for ids, batch, positions in batches), batch_size)
+
+        if self.vision_stats:
+            skipped = self.vision_stats['images'] - self.vision_stats['computed']
+            logger.info(f'Vision model skipped for {skipped}/{self.vision_stats["images"]} images '
+                        f'(constant: {self.vision_stats["constant"]}, cached: {self.vision_stats["cached"]}, '
+                        f'duplicate: {self.vision_stats["duplicate"]}).')
+        if self.cascade_stats:
+            logger.info(f'Full model used for {self.cascade_stats["full_model"]}/{self.cascade_stats["entries"]} '
+                        f'entries ({self.cascade_stats["full_model"] / self.cascade_stats["entries"]:.1%}).')
+
+    def predict_entries(self, entries):
+        '''
+        Predict a single batch of entries in the calling thread, e.g. the batches of a server. Unlike `infer`, it starts no `DataLoader`, shows no progress bar and does not reset or update `vision_stats` and `cascade_stats`, so that it can be called from another thread.
+        :param entries: a list of json entries with the keys expected by `infer`
+        :return: a list of the prediction of each entry, in the format of `format_json_output` (`{id: {category: {value: probability}}}`)
+        '''
+        ids, batch, _ = next(iter(self._stream_dataset(entries, chunk_size=len(entries))))
+        with torch.no_grad():
+            pred = self._predict_batch(batch, vision_stats=Counter(), cascade_stats=Counter())
+        return [self.format_json_output([{'id': _id}], [[_pred[i:i + 1] for _pred in pred]])
+                for i, _id in enumerate(ids)]
+
+    def _stream_dataset(self, data_or_datapath, chunk_size=BATCH_SIZE, bucket_pool=None):
+        # with the cascade, the images are only loaded (by `_predict_cascade`) for the entries the text model is unsure of
+        return M3InferenceStreamDataset(data_or_datapath, use_img=self.use_full_model, chunk_size=chunk_size,
+                                        vision_cache=self.vision_cache, constant_images=self.constant_images,
+                                        bucket_pool=bucket_pool, uint8_images=self.vision_bf16,
+                                        lazy_images=self.cascade_model is not None)
+
+    @staticmethod
+    def _restore_order(results, batch_size):
+        """
+        Re-batch predictions of length-bucketed batches in input order.
+        :param results: an iterable of `(ids, pred, positions)`, where `positions` holds the input index of each entry or is `None` for batches already in order
+        :return: a generator of `(ids, pred)` in input order
+        """
+        pending = {}
+        next_position = 0
+        ids_out, rows_out = [], []
+        for ids, pred, positions in results:
+            if positions is None:
+                yield ids, pred
+                continue
+            for i, (position, _id) in enumerate(zip(positions, ids)):
+                pending[position] = _id, [_pred[i] for _pred in pred]
+            while next_position in pending:
+                _id, row = pending.pop(next_position)
+                next_position += 1
+                ids_out.append(_id)
+                rows_out.append(row)
+                if len(ids_out) == batch_size:
+                    yield ids_out, [np.stack(_pred) for _pred in zip(*rows_out)]
+                    ids_out, rows_out = [], []
+        if ids_out:
+            yield ids_out, [np.stack(_pred) for _pred in zip(*rows_out)]
+
+    def _predict_batch(self, batch, cascade=True, vision_stats=None, cascade_stats=None):
+        # the sources of the embeddings and the models used are counted in `vision_stats` and `cascade_stats`
+        # (`self.vision_stats` and `self.cascade_stats` by default)
+        if cascade and self.cascade_model is not None:
+            return self._predict_cascade(batch, vision_stats, cascade_stats)
+        if isinstance(batch[-1], KeyedImages):
+            batch = batch[:-1] + [self._embed_images(batch[-1], vision_stats)]
+        elif self.use_full_model and isinstance(self.model, (torch.jit.ScriptModule, OnnxRuntimeModel)):
+            # the compiled full model takes vision embeddings
+            batch = batch[:-1] + [self._image_embedder(batch[-1].to(self.device))]
+        batch = [i.to(self.device) for i in batch]
+        pred = self.model(batch)
+        return [_pred.detach().cpu().numpy() for _pred in pred]
+
+    def _predict_cascade(self, batch, vision_stats=None, cascade_stats=None):
+        """
+        Predict with the text model, then with the full model for the entries for which the text model is unsure.
+        The images of these entries are loaded here (in this process rather than in the dataloader workers) when the
+        batch holds their paths.
+        :return: the predictions, followed by an array of the model used for each entry
+        """
+        cascade_stats = self.cascade_stats if cascade_stats is None else cascade_stats
+        pred = [_pred.detach().cpu().numpy() for _pred in self.cascade_model([i.to(self.device) for i in batch[:-1]])]
+        unsure = np.zeros(len(pred[0]), dtype=bool)
+        for pred_cat, pred_per_cat in zip(PRED_CATS, pred):
+            unsure |= pred_per_cat.max(1) < self.cascade_thresholds[pred_cat]
+
+        rows = np.flatnonzero(unsure)
+        if len(rows):
+            index = torch.from_numpy(rows)
+            images = select_images(batch[-1], rows)
+            if isinstance(images, ImagePaths):
+                images = self._stream_dataset(None).load_images(images.paths)
+            full_pred = self._predict_batch([i[index] for i in batch[:-1]] + [images], cascade=False,
+                                           vision_stats=vision_stats)
+            for pred_per_cat, full_pred_per_cat in zip(pred, full_pred):
+                pred_per_cat[rows] = full_pred_per_cat
+        cascade_stats['entries'] += len(unsure)
+        cascade_stats['full_model'] += len(rows)
+        return pred + [np.where(unsure, 'full_model', 'text_model')]
+
+    def _embed_images(self, images, vision_stats=None):
+        """
+        Compute the vision embeddings of a batch of `KeyedImages`: decoded images go through the vision model (and are
+        added to the vision cache), the others are constant images or are read from the cache. Entries sharing an
+        image reuse its embedding. The sources of the embeddings are counted in `vision_stats` (`self.vision_stats` by
+        default).
+        """
+        vision_stats = self.vision_stats if vision_stats is None else vision_stats
+        embeddings = {key: self.constant_embeddings[key] for key in images.keys if key in self.constant_embeddings}
+        if images.fig_keys:
+            fig_output = self._image_embedder(images.fig.to(self.device)).cpu()
+            embeddings.update(zip(images.fig_keys, fig_output))
+            if self.vision_cache is not None:
+                self.vision_cache.put(images.fig_keys, fig_output.numpy())
+
+        cached_keys = [key for key in dict.fromkeys(images.keys) if key not in embeddings]
+        if cached_keys:
+            cached = torch.from_numpy(self.vision_cache.get(self.vision_cache.lookup(cached_keys)))
+            embeddings.update(zip(cached_keys, cached))
+
+        fig_keys, cached_keys = set(images.fig_keys), set(cached_keys)
+        vision_stats['images'] += len(images.keys)
+        vision_stats['computed'] += len(fig_keys)
+        vision_stats['constant'] += sum(key in self.constant_embeddings for key in images.keys)
+        vision_stats['cached'] += sum(key in cached_keys for key in images.keys)
+        vision_stats['duplicate'] += sum(key in fig_keys for key in images.keys) - len(fig_keys)
+        return torch.stack([embeddings[key] for key in images.keys])
+
     @classmethod
     def format_json_output(cls, data, y_pred):
 
-        # merge batches to reformat the result
-        y_pred = [[b[c][i] for c in range(3)] for b in y_pred for i in range(len(b[0]))]
+        # merge batches to reformat the result (a 4th array holds the model of each entry with the cascade)
+        y_pred = [[b[c][i] for c in range(len(b))] for b in y_pred for i in range(len(b[0]))]
 
         # construct output json
         pred_joined = OrderedDict()
@@ -153,18 +581,26 @@ class M3Inference:
             nested_pred = {}
             for (pred_cat, pred_types), pred_per_cat in zip(PRED_CATS.items(), pred):
                 nested_pred[pred_cat] = {k: round(float(v), 4) for k, v in zip(pred_types, pred_per_cat)}
+            if len(pred) > len(PRED_CATS):
+                nested_pred['model'] = str(pred[len(PRED_CATS)])
             pred_joined[_id] = nested_pred
         return pred_joined
 
     @classmethod
     def format_dataframe_output(cls, data, y_pred):
-        y_pred = np.vstack([np.hstack(i) for i in y_pred])
+        models = [i[len(PRED_CATS)] for i in y_pred if len(i) > len(PRED_CATS)]
+        y_pred = np.vstack([np.hstack(i[:len(PRED_CATS)]) for i in y_pred])
 
         # construct output df
-        columns = [f'{pred_cat}_{v}' for pred_cat, values in PRED_CATS.items() for v in values]
+        columns = list(PRED_COLUMNS)
+        import pandas as pd
         df = pd.DataFrame(y_pred)
         df.columns = columns
         df['id'] = [i['id'] for i in data]
+        if models:
+            # the model of each entry with the cascade
+            columns.append('model')
+            df['model'] = np.concatenate(models)
         df = df[['id'] + columns]
 
         if len(set(df['id'])) != len(df['id']):
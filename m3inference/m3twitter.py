@@ -6,17 +6,15 @@ import html
 import json
 import logging
 import os
-from rauth import OAuth1Service
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from os.path import expanduser
 
-from .consts import UNKNOWN_LANG, TW_DEFAULT_PROFILE_IMG
+from .consts import DOWNLOAD_THREADS, UNKNOWN_LANG, TW_DEFAULT_PROFILE_IMG
 from .m3inference import M3Inference
-from .preprocess import download_resize_img
+from .preprocess import ImageDownloader, download_resize_img
 from .utils import get_lang
 
-logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
-                    datefmt='%m/%d/%Y %H:%M:%S',
-                    level=logging.INFO)
 
 logger = logging.getLogger(__name__)
 
@@ -43,19 +41,41 @@ class M3Twitter(M3Inference):
             logger.info(f'Dir {self.cache_dir} created.')
 
     def transform_jsonl(self, input_file, output_file, img_path_key=None, lang_key=None, resize_img=True,
-                        keep_full_size_img=False):
-        with open(input_file, "r") as fhIn:
-            with open(output_file, "w") as fhOut:
+                        keep_full_size_img=False, download_threads=DOWNLOAD_THREADS, downloader=None):
+        """
+        Transform each line of `input_file` with `transform_jsonl_object`, on `download_threads` threads so that the
+        profile images are downloaded concurrently. The lines are written to `output_file` in input order.
+        :param download_threads: the number of lines transformed concurrently
+        :param downloader: the `ImageDownloader` of the images (by default, one with at most `DOWNLOAD_PER_HOST`
+                           connections per host, `DOWNLOAD_RETRIES` retries and a `DOWNLOAD_TIMEOUT` timeout)
+        """
+        own_downloader = downloader is None
+        if own_downloader:
+            downloader = ImageDownloader()
+        try:
+            with open(input_file, "r") as fhIn, open(output_file, "w") as fhOut, \
+                    ThreadPoolExecutor(download_threads) as executor:
+                # the lines being transformed, in input order; a few per thread so that the threads are kept busy
+                # while the oldest line is waited for
+                pending = deque()
                 for line in fhIn:
-                    m3vals = self.transform_jsonl_object(line, img_path_key=img_path_key, lang_key=lang_key,
-                                                         resize_img=resize_img, keep_full_size_img=keep_full_size_img)
-                    fhOut.write("{}\n".format(json.dumps(m3vals)))
+                    pending.append(executor.submit(self.transform_jsonl_object, line, img_path_key=img_path_key,
+                                                   lang_key=lang_key, resize_img=resize_img,
+                                                   keep_full_size_img=keep_full_size_img, downloader=downloader))
+                    if len(pending) >= 4 * download_threads:
+                        fhOut.write("{}\n".format(json.dumps(pending.popleft().result())))
+                while pending:
+                    fhOut.write("{}\n".format(json.dumps(pending.popleft().result())))
+        finally:
+            if own_downloader:
+                downloader.close()
 
     def transform_jsonl_object(self, input, img_path_key=None, lang_key=None, resize_img=True,
-                               keep_full_size_img=False):
+                               keep_full_size_img=False, downloader=None):
         """
         input is either a Twitter tweet object (https://developer.twitter.com/en/docs/tweets/data-dictionary/overview/tweet-object)
             or a Twitter user object (https://developer.twitter.com/en/docs/tweets/data-dictionary/overview/user-object)
+        downloader is the `ImageDownloader` of the profile image (it is downloaded with `urllib` by default)
         """
         if isinstance(input, str):
             input = json.loads(input)
@@ -69,14 +89,14 @@ class M3Twitter(M3Inference):
             img_path = user[img_path_key]
             if resize_img:
                 img_file_resize = "{}/{}_224x224.{}".format(self.cache_dir, user["id_str"], get_extension(img_path))
-                download_resize_img(img_path, img_file_resize)
+                download_resize_img(img_path, img_file_resize, downloader=downloader)
             else:
                 img_file_resize = img_path
         elif img_path_key != None and img_path_key in input:
             img_path = input[img_path_key]
             if resize_img:
                 img_file_resize = "{}/{}_224x224.{}".format(self.cache_dir, user["id_str"], get_extension(img_path))
-                download_resize_img(img_path, img_file_resize)
+                download_resize_img(img_path, img_file_resize, downloader=downloader)
             else:
                 img_file_resize = img_path
         elif user["default_profile_image"]:
@@ -90,9 +110,9 @@ class M3Twitter(M3Inference):
             img_file_resize = "{}/{}_224x224.{}".format(self.cache_dir, user["id_str"], get_extension(img_path))
             if not os.path.isfile(img_file_resize):
                 if keep_full_size_img:
-                    download_resize_img(img_path, img_file_resize, img_file_full)
+                    download_resize_img(img_path, img_file_resize, img_file_full, downloader=downloader)
                 else:
-                    download_resize_img(img_path, img_file_resize)
+                    download_resize_img(img_path, img_file_resize, downloader=downloader)
         # check if an error occurred and the image was not downloaded
         if not os.path.exists(img_file_resize):
             img_file_resize = TW_DEFAULT_PROFILE_IMG
@@ -157,6 +177,7 @@ class M3Twitter(M3Inference):
     
     
     def twitter_init(self, api_key, api_secret, access_token, access_secret):
+        from rauth import OAuth1Service
         twitter = OAuth1Service(
             consumer_key=api_key,
             consumer_secret=api_secret,
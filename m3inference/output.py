@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+import logging
+import os
+import struct
+
+import numpy as np
+
+from .consts import *
+
+logger = logging.getLogger(__name__)
+
+# the probability columns of the tabular outputs, in the order of the model outputs
+PRED_COLUMNS = [f'{pred_cat}_{v}' for pred_cat, values in PRED_CATS.items() for v in values]
+# the header of the `.npy` columns, padded to a fixed length so that the final shape is written in place on close
+NPY_HEADER_LEN = 128
+
+
+class OutputSink:
+    '''
+    Writes the predictions batch by batch, as they are computed, rather than assembling the whole result in memory
+    (see `M3Inference.infer` with `output_path`). The output has an `id` column (with the ids as strings, as in
+    `compile_shards`), one float32 column per predicted value (`PRED_COLUMNS`), and a `model` column with the cascade.
+    '''
+
+    def write(self, ids, pred):
+        '''
+        :param ids: the ids of a batch
+        :param pred: the prediction arrays of the batch, one `(batch, len(values))` array per category of `PRED_CATS`,
+                     followed by an array of the model used for each entry with the cascade
+        '''
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ArrowOutputSink(OutputSink):
+    '''
+    Appends each batch as a record batch to an Arrow IPC file (`format='arrow'`, which pandas and pyarrow can
+    memory-map), or to a Parquet file (`format='parquet'`) in row groups of at least `PARQUET_ROW_GROUP_SIZE` rows.
+    Requires pyarrow.
+    '''
+
+    def __init__(self, path, format='parquet'):
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ImportError('Parquet and Arrow outputs require pyarrow. Please run `pip install pyarrow`.')
+        assert format in ['parquet', 'arrow']
+        self.pa = pa
+        self.path = path
+        self.format = format
+        self.writer = None
+        # the batches of the next row group of the Parquet file
+        self.batches = []
+
+    def write(self, ids, pred):
+        pa = self.pa
+        # each category is a contiguous (batch, values) array: its columns are strided views, gathered by Arrow
+        columns = [pa.array([str(_id) for _id in ids], pa.string())] + [pa.array(_pred[:, i]) for _pred in pred[:len(PRED_CATS)]
+                                                  for i in range(_pred.shape[1])]
+        names = ['id'] + PRED_COLUMNS
+        if len(pred) > len(PRED_CATS):
+            columns.append(pa.array(pred[len(PRED_CATS)], pa.string()))
+            names.append('model')
+        batch = pa.RecordBatch.from_arrays(columns, names)
+        if self.writer is None:
+            if self.format == 'parquet':
+                import pyarrow.parquet as pq
+                self.writer = pq.ParquetWriter(self.path, batch.schema)
+            else:
+                self.writer = pa.ipc.new_file(self.path, batch.schema)
+        if self.format == 'arrow':
+            self.writer.write_batch(batch)
+            return
+        self.batches.append(batch)
+        if sum(len(b) for b in self.batches) >= PARQUET_ROW_GROUP_SIZE:
+            self._write_row_group()
+
+    def _write_row_group(self):
+        self.writer.write_table(self.pa.Table.from_batches(self.batches))
+        self.batches = []
+
+    def close(self):
+        if self.batches:
+            self._write_row_group()
+        if self.writer is not None:
+            self.writer.close()
+
+
+class NumpyOutputSink(OutputSink):
+    '''
+    Appends each column to its own file in the dir `path`: `{column}.npy` for the probabilities, which can be loaded
+    with `np.load(..., mmap_mode='r')`, and one value per line in `id.txt` (and `model.txt` with the cascade).
+    '''
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.n_rows = 0
+        self.columns = [open(os.path.join(path, f'{column}.npy'), 'wb') for column in PRED_COLUMNS]
+        for f in self.columns:
+            f.write(npy_header(0))
+        self.ids = open(os.path.join(path, 'id.txt'), 'w')
+        self.models = None
+
+    def write(self, ids, pred):
+        files = iter(self.columns)
+        for _pred in pred[:len(PRED_CATS)]:
+            _pred = _pred.astype('<f4', copy=False)
+            for i in range(_pred.shape[1]):
+                next(files).write(np.ascontiguousarray(_pred[:, i]).data)
+        self.ids.write(''.join(f'{_id}\n' for _id in ids))
+        if len(pred) > len(PRED_CATS):
+            if self.models is None:
+                self.models = open(os.path.join(self.path, 'model.txt'), 'w')
+            self.models.write(''.join(f'{model}\n' for model in pred[len(PRED_CATS)]))
+        self.n_rows += len(ids)
+
+    def close(self):
+        for f in self.columns:
+            f.seek(0)
+            f.write(npy_header(self.n_rows))
+            f.close()
+        self.ids.close()
+        if self.models is not None:
+            self.models.close()
+
+
+def npy_header(n_rows):
+    # a version 1.0 header of a float32 vector, padded with spaces to `NPY_HEADER_LEN` bytes
+    header = repr({'descr': '<f4', 'fortran_order': False, 'shape': (n_rows,)})
+    header = header.ljust(NPY_HEADER_LEN - 10 - 1) + '\n'
+    return np.lib.format.magic(1, 0) + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+# output formats written by a sink, and the sink writing them
+OUTPUT_SINKS = {
+    'parquet': lambda path: ArrowOutputSink(path, 'parquet'),
+    'arrow': lambda path: ArrowOutputSink(path, 'arrow'),
+    'npy': NumpyOutputSink,
+}
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import logging
+import multiprocessing
+import os
+import tempfile
+
+import torch
+
+from .consts import *
+
+logger = logging.getLogger(__name__)
+
+
+def jsonl_byte_ranges(path, n_ranges):
+    '''
+    Split a jsonl file into up to `n_ranges` contiguous byte ranges of similar size, without reading it. Each line
+    belongs to the range its first byte is in (see `iter_jsonl_range`).
+    :return: a list of `(start, end)` byte offsets
+    '''
+    size = os.path.getsize(path)
+    bounds = sorted(set(size * i // n_ranges for i in range(n_ranges + 1)))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def iter_jsonl_range(path, start, end):
+    '''
+    :return: a generator of the non-empty lines of a jsonl file that start in the byte range `[start, end)`
+    '''
+    with open(path, 'rb') as f:
+        if start > 0:
+            # the line containing byte `start - 1` started in the previous range
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            if line.strip():
+                yield line.decode('utf-8')
+
+
+# the model replica of a worker process
+_worker_m3 = None
+
+
+def _init_worker(init_kwargs, constant_images, threads_per_proc):
+    global _worker_m3
+    from .m3inference import M3Inference
+
+    torch.set_num_threads(threads_per_proc)
+    _worker_m3 = M3Inference(**dict(init_kwargs, skip_logging=True))
+    for img_path in constant_images:
+        if img_path not in _worker_m3.constant_images:
+            _worker_m3.register_constant_image(img_path)
+    if _worker_m3.vision_cache is not None:
+        # the processes share the cache files, so none of them appends to them
+        _worker_m3.vision_cache.read_only = True
+
+
+def _infer_range(task):
+    path, start, end, batch_size, bucket_by_length = task
+    ids, y_pred = [], []
+    for batch_ids, pred in _worker_m3._predict_batches(iter_jsonl_range(path, start, end), batch_size, num_workers=0,
+                                                       bucket_by_length=bucket_by_length):
+        ids.extend(batch_ids)
+        y_pred.append(pred)
+    return ids, y_pred
+
+
+def parallel_predict(m3, datapath, n_procs, threads_per_proc=1, batch_size=16, bucket_by_length=False,
+                     share_weights=True):
+    '''
+    Predict with `n_procs` replicas of `m3` in worker processes, each working on byte ranges of the input file.
+    See `M3Inference.parallel_infer`.
+    :return: the list of ids and the list of batches of predictions, in input order
+    '''
+    ranges = jsonl_byte_ranges(datapath, n_procs * PARALLEL_RANGES_PER_PROC)
+    tasks = [(datapath, start, end, batch_size, bucket_by_length) for start, end in ranges]
+    logger.info(f'Predicting {len(ranges)} ranges of {datapath} with {n_procs} processes of {threads_per_proc} threads.')
+
+    ids, y_pred = [], []
+    init_kwargs = m3.init_kwargs
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # the workers map the same file, whose pages are loaded once in the page cache
+        if share_weights and m3.weights_path is not None:
+            init_kwargs = dict(init_kwargs, weights_path=m3.weights_path)
+        elif share_weights and m3._eager_model() is not None:
+            init_kwargs = dict(init_kwargs, weights_path=os.path.join(tmp_dir, f'{m3.model_type}.pt'))
+            m3.save_weights(init_kwargs['weights_path'])
+        # models are not fork-safe once their thread pools are started, so the workers are spawned
+        with multiprocessing.get_context('spawn').Pool(n_procs, _init_worker,
+                                                        (init_kwargs, list(m3.constant_images), threads_per_proc)) as pool:
+            for range_ids, range_pred in pool.imap(_infer_range, tasks):
+                ids.extend(range_ids)
+                y_pred.extend(range_pred)
+    return ids, y_pred
@@ -2,25 +2,30 @@
 # @Zijian Wang
 
 import argparse
-import glob
 import json
 import logging
+import multiprocessing
 import os
+import threading
 import urllib.request, urllib.error
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
 
 from PIL import Image
 from tqdm import tqdm
 
-logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
-                    datefmt='%m/%d/%Y %H:%M:%S',
-                    level=logging.INFO)
+from .consts import DOWNLOAD_BACKOFF, DOWNLOAD_PER_HOST, DOWNLOAD_RETRIES, DOWNLOAD_TIMEOUT, RESIZE_CHUNK_SIZE, \
+    RESIZE_MANIFEST, setup_logging
 
 logger = logging.getLogger(__name__)
 
 
-def download_resize_img(url, img_out_path, img_out_path_fullsize=None):
+def download_resize_img(url, img_out_path, img_out_path_fullsize=None, downloader=None):
     # url=url.replace("_200x200","_400x400")
+    if downloader is not None:
+        return downloader.download_resize_img(url, img_out_path, img_out_path_fullsize)
     try:
         img_data = urllib.request.urlopen(url)
         img_data = img_data.read()
@@ -43,57 +48,216 @@ def download_resize_img(url, img_out_path, img_out_path_fullsize=None):
     return resize_img(BytesIO(img_data), img_out_path, force=True,url=url)
 
 
+class ImageDownloader:
+    '''
+    Downloads and resizes images (see `download_resize_img`) from any number of threads, over a pool of HTTP
+    connections that are reused across images. At most `per_host` connections to each host are open at a time; the
+    other threads wait for one of them to be free. Downloads that fail with a connection error, a timeout, or a 429 or
+    5xx status are retried with an exponential backoff. Concurrent downloads to the same path are made once.
+    '''
+
+    def __init__(self, per_host=DOWNLOAD_PER_HOST, timeout=DOWNLOAD_TIMEOUT, retries=DOWNLOAD_RETRIES,
+                 backoff=DOWNLOAD_BACKOFF):
+        '''
+        :param per_host: the maximum number of concurrent connections to a host
+        :param timeout: the seconds to wait for a connection or for data
+        :param retries: the number of retries of a failed download
+        :param backoff: the backoff factor of the retries (see `urllib3.util.Retry`)
+        '''
+        # requests is only imported when images are downloaded
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util import Retry
+        self.requests = requests
+        self.timeout = timeout
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=[429, 500, 502, 503, 504],
+                      raise_on_status=False)
+        # a blocking pool of `per_host` connections per host caps the concurrent requests to each host
+        adapter = HTTPAdapter(pool_maxsize=per_host, pool_block=True, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # the output paths being downloaded, and an event set once they are done
+        self._downloading = {}
+        self._lock = threading.Lock()
+
+    def download_resize_img(self, url, img_out_path, img_out_path_fullsize=None):
+        '''
+        :return: the status of `resize_img`, or `None` if the image could not be downloaded
+        '''
+        with self._lock:
+            done = self._downloading.get(img_out_path)
+            if done is None:
+                self._downloading[img_out_path] = threading.Event()
+        if done is not None:
+            done.wait()
+            return 'resized' if os.path.exists(img_out_path) else None
+
+        try:
+            try:
+                response = self.session.get(url, timeout=self.timeout)
+                response.raise_for_status()
+                img_data = response.content
+            except self.requests.RequestException as err:
+                logger.warning(f'Error fetching profile image from Twitter. {err}')
+                return None
+            if img_out_path_fullsize is not None:
+                with open(img_out_path_fullsize, "wb") as fh:
+                    fh.write(img_data)
+            return resize_img(BytesIO(img_data), img_out_path, force=True, url=url)
+        finally:
+            with self._lock:
+                self._downloading.pop(img_out_path).set()
+
+    def close(self):
+        self.session.close()
+
+
 def resize_img(img_path, img_out_path, filter=Image.BILINEAR, force=False,url=None):
+    '''
+    :return: `'resized'`, `'small'` if the image is too small to be resized (unless `force`), or `'failed'`
+    '''
     try:
-        img = Image.open(img_path).convert("RGB")
+        img = Image.open(img_path)
         if img.size[0] + img.size[1] < 400 and not force:
             logger.info(f'{img_path} / {url} is too small. Skip.')
-            return
+            return 'small'
+        # JPEG images of at least 448x448 are decoded at a reduced scale (see `decode_image`)
+        img.draft('RGB', (224, 224))
+        if img.mode != 'RGB':
+            img = img.convert("RGB")
         img = img.resize((224, 224), filter)
         img.save(img_out_path)
+        return 'resized'
     except Exception as e:
         logger.warning(f'Error when resizing {img_path} / {url}\nThe error message is {e}\n')
+        return 'failed'
 
 
-def resize_imgs(src_root, dest_root, src_list=None, filter=Image.BILINEAR, force=False):
+def resize_imgs(src_root, dest_root, src_list=None, filter=Image.BILINEAR, force=False, workers=1,
+                chunk_size=RESIZE_CHUNK_SIZE):
+    '''
+    Resize images to 224x224 JPEG images, in this process or in a pool of `workers` processes.
+    Each image is recorded with the size and mtime of its source in a manifest (`RESIZE_MANIFEST` in `dest_root`), so
+    that later calls skip the unchanged images without listing `dest_root`. Images that could not be read are retried
+    on the next call. When `dest_root` has no manifest, the images resized by earlier versions are recorded as is.
+    :param src_root: the dir of the source images
+    :param dest_root: the dir to write the resized images (`{name}.jpeg`) and the manifest to
+    :param src_list: the paths of the source images in `src_root` (all the files of `src_root` by default)
+    :param filter: the resampling filter
+    :param force: whether to resize every image, even unchanged or small ones
+    :param workers: the number of processes (1 by default, to resize in this process). The processes are spawned, so
+        scripts calling it with more than one worker need an `if __name__ == '__main__':` guard.
+    :param chunk_size: the number of images sent at a time to each process
+    :return: a `Counter` of the images `resized`, `unchanged`, too `small` or `failed`
+    '''
+    setup_logging()
     if not os.path.exists(src_root):
         raise FileNotFoundError(f"{src_root} does not exist.")
 
     if not os.path.exists(dest_root):
         os.makedirs(dest_root)
 
-    src_list = glob.glob(os.path.join(src_root, '*')) if src_list is None else src_list
+    if src_list is None:
+        with os.scandir(src_root) as entries:
+            src_list = sorted(entry.path for entry in entries if entry.is_file() and not entry.name.startswith('.'))
 
-    des_set = set([os.path.relpath(img_path, dest_root).replace('.jpeg', '')
-                   for img_path in glob.glob(os.path.join(dest_root, '*'))])
+    manifest_path = os.path.join(dest_root, RESIZE_MANIFEST)
+    legacy = not os.path.isfile(manifest_path)
+    manifest = load_manifest(manifest_path)
+    stats = Counter()
+    with open(manifest_path, 'a') as manifest_file:
+        tasks = []
+        for img_path in src_list:
+            img_name = os.path.relpath(img_path, src_root)
+            out_name = os.path.splitext(img_name)[0] + '.jpeg'
+            try:
+                stat = os.stat(img_path)
+            except OSError as e:
+                logger.warning(f'Error when resizing {img_path}\nThe error message is {e}\n')
+                stats['failed'] += 1
+                continue
+            if not force:
+                if manifest.get(img_name, (None, None))[:2] == (stat.st_size, stat.st_mtime_ns):
+                    logger.debug(f"{img_name} is unchanged. Skipping...")
+                    stats['unchanged'] += 1
+                    continue
+                if legacy and os.path.exists(os.path.join(dest_root, out_name)):
+                    logger.debug(f"{out_name} exists. Skipping...")
+                    _write_manifest_record(manifest_file, img_name, stat.st_size, stat.st_mtime_ns, out_name)
+                    stats['unchanged'] += 1
+                    continue
+            tasks.append((img_path, os.path.join(dest_root, out_name), filter, force, img_name, stat.st_size,
+                          stat.st_mtime_ns, out_name))
 
-    for img_path in tqdm(src_list, desc='resizing images', disable=logging.root.level>=logging.WARN):
+        # unlike a `multiprocessing.Pool`, which starts new workers forever, the executor is broken by a worker
+        # failing to start (e.g. by re-running an unguarded script)
+        pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) \
+            if workers > 1 and len(tasks) > chunk_size else None
+        try:
+            results = pool.map(_resize_task, tasks, chunksize=chunk_size) if pool is not None \
+                else map(_resize_task, tasks)
+            for img_name, size, mtime_ns, out_name, status in tqdm(results, total=len(tasks), desc='resizing images',
+                                                                  disable=logging.root.level >= logging.WARN):
+                stats[status] += 1
+                # the image is recorded once written, so that an interrupted call resumes where it stopped
+                if status != 'failed':
+                    _write_manifest_record(manifest_file, img_name, size, mtime_ns,
+                                           out_name if status == 'resized' else None)
+        except BrokenProcessPool as e:
+            raise RuntimeError('A process resizing images terminated abruptly. Scripts calling `resize_imgs` with '
+                               "more than one worker need an `if __name__ == '__main__':` guard.") from e
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=False)
+    logger.info(f'Resized {stats["resized"]} images to {dest_root} ({stats["unchanged"]} unchanged, '
+                f'{stats["small"]} too small, {stats["failed"]} failed).')
+    return stats
 
-        img_name = os.path.splitext(os.path.relpath(img_path, src_root))[0]
-        if not force and img_name in des_set:
-            logger.debug(f"{img_name} exists. Skipping...")
-            continue
-        else:
-            out_path = os.path.join(dest_root, img_name) + '.jpeg'
-            logger.debug(f'{img_name} not found in {dest_root}. Resizing to {out_path}')
-            resize_img(img_path, out_path, filter=filter, force=force)
+
+def _resize_task(task):
+    img_path, out_path, filter, force, img_name, size, mtime_ns, out_name = task
+    return img_name, size, mtime_ns, out_name, resize_img(img_path, out_path, filter=filter, force=force)
+
+
+def _write_manifest_record(manifest_file, img_name, size, mtime_ns, out_name):
+    manifest_file.write(json.dumps({'src': img_name, 'size': size, 'mtime_ns': mtime_ns, 'out': out_name}) + '\n')
+
+
+def load_manifest(manifest_path):
+    '''
+    :return: a dict of the name of each source image in the manifest of `resize_imgs` to its `(size, mtime_ns, out)`,
+             where `out` is the name of the resized image (`None` for images too small to be resized)
+    '''
+    manifest = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a record cut by an interrupted call
+                    continue
+                manifest[record['src']] = (record['size'], record['mtime_ns'], record['out'])
+    return manifest
 
 
 def update_json(jsonl_filepath, jsonl_outfilepath, src_root, dest_root):
-    logger.info(f'Loading jsons from {jsonl_filepath}')
-    list_of_jsons = []
-    with open(jsonl_filepath) as infile:
+    '''
+    Point the `img_path` of each json of a jsonl file to the image resized by `resize_imgs`. The file is rewritten line
+    by line.
+    '''
+    setup_logging()
+    logger.info(f'Updating jsons from {jsonl_filepath} to {jsonl_outfilepath}')
+    n_jsons = 0
+    with open(jsonl_filepath) as infile, open(jsonl_outfilepath, 'w') as outfile:
         for line in infile:
-            list_of_jsons.append(json.loads(line))
-
-    new_jsons = []
-    for j in list_of_jsons:
-        img_path = j['img_path']
-        j['img_path'] = os.path.splitext(os.path.abspath(os.path.join(dest_root, os.path.relpath(img_path, src_root))))[
-                            0] + '.jpeg'
-        new_jsons.append(j)
-    logger.info(f'Saving jsons to {jsonl_outfilepath}')
-    with open(jsonl_outfilepath, 'w') as outfile:
-        for j in list_of_jsons:
+            if not line.strip():
+                continue
+            j = json.loads(line)
+            img_path = j['img_path']
+            j['img_path'] = os.path.splitext(os.path.abspath(os.path.join(dest_root, os.path.relpath(img_path, src_root))))[
+                                0] + '.jpeg'
             outfile.write(json.dumps(j, sort_keys=True) + '\n')
-
+            n_jsons += 1
+    logger.info(f'Saved {n_jsons} jsons to {jsonl_outfilepath}')
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from .consts import *
+from .dataset import M3InferenceStreamDataset
+
+
+def quantize_text(model):
+    '''
+    Dynamic int8 quantization of the text side of a model: the weights of its LSTM and linear layers (including the
+    merge and output layers) are stored in int8, and activations are quantized on the fly. The embeddings and the
+    vision model are kept in fp32.
+    :param model: an `M3InferenceModel` or `M3InferenceTextModel` on CPU, in eval mode
+    :return: a quantized copy of the model
+    '''
+    layers = {name for name, module in model.named_children() if isinstance(module, (nn.LSTM, nn.Linear))}
+    return quantize_dynamic(model, layers, dtype=torch.qint8)
+
+
+def quantize_vision(model, calibration_data, max_images=QUANTIZE_CALIBRATION_IMAGES):
+    '''
+    Static int8 quantization of the vision model of a full model (in place). The activation ranges are calibrated on the
+    profile images of `calibration_data`, which should look like the images the model will be run on.
+    :param model: an `M3InferenceModel` on CPU, in eval mode
+    :param calibration_data: a list of jsons or the path to a jsonl file, with `img_path` keys
+    :param max_images: the maximum number of images used for calibration
+    :return: the model
+    '''
+    example = torch.zeros(1, 3, 224, 224)
+    prepared = prepare_fx(model.vision_model, get_default_qconfig_mapping(torch.backends.quantized.engine), (example,))
+    seen = 0
+    with torch.no_grad():
+        for _, batch, _ in M3InferenceStreamDataset(calibration_data, use_img=True, chunk_size=BATCH_SIZE):
+            prepared(batch[-1][:max_images - seen])
+            seen += len(batch[-1])
+            if seen >= max_images:
+                break
+    model.vision_model = convert_fx(prepared)
+    return model
+
+
+def prediction_drift(expected, result):
+    '''
+    :param expected: the `dataframe` output of `M3Inference.infer` with the reference model
+    :param result: the `dataframe` output of `M3Inference.infer` on the same data with another model
+    :return: the maximum absolute difference of the predicted probabilities in each category of `PRED_CATS`
+    '''
+    return {cat: max(float((expected[f'{cat}_{v}'] - result[f'{cat}_{v}']).abs().max()) for v in values)
+            for cat, values in PRED_CATS.items()}
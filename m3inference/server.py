@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+from .consts import *
+from .utils import *
+
+logger = logging.getLogger(__name__)
+
+
+class M3InferenceServer:
+    '''
+    Asyncio HTTP server around a resident `M3Inference` model, on TCP or on a Unix socket.
+    Concurrent requests are collected into batches of up to `max_batch_size` entries. A batch is run as soon as it is
+    full, or `max_wait_ms` after its first entry arrived.
+
+    Endpoints:
+    * `POST /infer` with a json entry (or a list of entries) with the keys expected by `M3Inference.infer`. The
+      response has the shape of `M3Inference.format_json_output`: `{id: {category: {value: probability}}}`.
+    * `GET /health`
+    '''
+
+    def __init__(self, m3, max_batch_size=SERVER_MAX_BATCH_SIZE, max_wait_ms=SERVER_MAX_WAIT_MS):
+        '''
+        :param m3: an `M3Inference` (or `M3Twitter`) instance
+        :param max_batch_size: the maximum number of entries per batch
+        :param max_wait_ms: the maximum time in milliseconds an entry waits for other entries to fill its batch
+        '''
+        self.m3 = m3
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        # batches run one at a time next to the event loop, which keeps accepting requests
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='m3-server')
+        self.queue = None
+        # the number of entries and batches served
+        self.stats = Counter()
+
+    async def start(self, host='127.0.0.1', port=8000, unix_socket=None):
+        '''
+        Start serving on `host:port`, or on `unix_socket` if given.
+        :return: the `asyncio.Server`
+        '''
+        self.queue = asyncio.Queue()
+        self._batcher = asyncio.ensure_future(self._batch_loop())
+        if unix_socket is not None:
+            server = await asyncio.start_unix_server(self._handle_connection, path=unix_socket)
+            logger.info(f'Serving on {unix_socket}.')
+        else:
+            server = await asyncio.start_server(self._handle_connection, host, port)
+            logger.info(f'Serving on {host}:{server.sockets[0].getsockname()[1]}.')
+        return server
+
+    async def predict(self, entry):
+        '''
+        :param entry: a json entry
+        :return: the prediction of the entry, in the format of `M3Inference.format_json_output`
+        '''
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((entry, future))
+        return await future
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            entries = [entry for entry, _ in batch]
+            try:
+                results = await loop.run_in_executor(self.executor, self._predict_entries, entries)
+            except Exception as e:
+                # isolate the entries that fail (e.g. a missing image) from the rest of the batch
+                logger.warning(f'Batch of {len(entries)} entries failed ({e!r}). Predicting them one by one.')
+                results = []
+                for entry in entries:
+                    try:
+                        results.append(await loop.run_in_executor(self.executor, self._predict_entries, [entry]))
+                    except Exception as entry_error:
+                        results.append([entry_error])
+                results = [result[0] for result in results]
+
+            for (_, future), result in zip(batch, results):
+                if future.cancelled():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def _predict_entries(self, entries):
+        self.stats['batches'] += 1
+        self.stats['entries'] += len(entries)
+        return self.m3.predict_entries(entries)
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, version = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, response = await self._route(method, path.split('?', 1)[0], body)
+                keep_alive = headers.get('connection', '').lower() != 'close' and version.strip() == 'HTTP/1.1'
+                payload = json.dumps(response).encode()
+                writer.write(f'HTTP/1.1 {status.value} {status.phrase}\r\n'
+                             f'Content-Type: application/json\r\n'
+                             f'Content-Length: {len(payload)}\r\n'
+                             f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode() + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method, path, body):
+        if path == '/health':
+            return HTTPStatus.OK, {'status': 'ok'}
+        if path != '/infer':
+            return HTTPStatus.NOT_FOUND, {'error': f'Unknown path {path}.'}
+        if method != 'POST':
+            return HTTPStatus.METHOD_NOT_ALLOWED, {'error': 'Use POST.'}
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return HTTPStatus.BAD_REQUEST, {'error': 'The body is not valid json.'}
+        entries = data if isinstance(data, list) else [data]
+        if not all(isinstance(entry, dict) and 'id' in entry for entry in entries):
+            return HTTPStatus.BAD_REQUEST, {'error': 'Each entry must be a json object with an `id`.'}
+
+        results = await asyncio.gather(*[self.predict(entry) for entry in entries], return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            return HTTPStatus.UNPROCESSABLE_ENTITY, {'error': repr(errors[0])}
+        response = {}
+        for result in results:
+            response.update(result)
+        return HTTPStatus.OK, response
+
+
+def serve(m3, host='127.0.0.1', port=8000, unix_socket=None, max_batch_size=SERVER_MAX_BATCH_SIZE,
+          max_wait_ms=SERVER_MAX_WAIT_MS):
+    '''
+    Serve `m3` until interrupted (see `M3InferenceServer`).
+    '''
+
+    async def main():
+        server = await M3InferenceServer(m3, max_batch_size, max_wait_ms).start(host, port, unix_socket)
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if unix_socket is not None and os.path.exists(unix_socket):
+            os.remove(unix_socket)
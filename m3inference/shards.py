@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from .consts import *
+from .dataset import decode_image, normalize_entry
+from .tokenizer import get_tokenizer
+
+logger = logging.getLogger(__name__)
+
+# the text fields of the shards, with their column in the normalized entries (see `normalize_entry`)
+SHARD_TEXT_FIELDS = [('username', 2), ('screenname', 3), ('des', 4)]
+
+
+def compile_shards(data_or_datapath, out_dir, use_img=True, shard_size=SHARD_SIZE):
+    '''
+    Preprocess entries once into shards of fixed-width arrays, which `M3InferenceShardDataset` (and `M3Inference.infer`
+    given `out_dir`) memory-map without parsing, tokenizing or decoding the entries again.
+    Each shard is a dir of `.npy` files: the ids (as strings), the int8 language ids (`lang`), the int16 token ids of
+    the username, screen name and description padded to their maximum length (`username`, `screenname`, `des`) and
+    their int16 lengths (`username_len`, ...), and with `use_img` the uint8 images of shape `(3, 224, 224)` (`fig`).
+    Images of another size or mode are converted to RGB and resized to 224x224 (see `decode_image`).
+    :param data_or_datapath: a list of jsons or the path to a jsonl file (see `M3Inference.infer` for the expected keys)
+    :param out_dir: the dir to write the shards and their index (`SHARD_INDEX`) to
+    :param use_img: whether to decode the images (required to predict with the full model)
+    :param shard_size: the number of entries per shard
+    :return: the number of entries
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    index = {'use_img': use_img, 'shards': []}
+    rows = []
+    for entry in _iter_entries(data_or_datapath):
+        rows.append(normalize_entry(entry, use_img))
+        if len(rows) == shard_size:
+            index['shards'].append(_write_shard(out_dir, len(index['shards']), rows, use_img))
+            rows = []
+    if rows:
+        index['shards'].append(_write_shard(out_dir, len(index['shards']), rows, use_img))
+
+    # the index is written last, so that the shards of an interrupted run are not read
+    with open(os.path.join(out_dir, SHARD_INDEX), 'w') as f:
+        json.dump(index, f)
+    size = sum(shard['size'] for shard in index['shards'])
+    logger.info(f'Compiled {size} entries into {len(index["shards"])} shards in {out_dir}.')
+    return size
+
+
+def _iter_entries(data_or_datapath):
+    if isinstance(data_or_datapath, str):
+        with open(data_or_datapath) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        yield from data_or_datapath
+
+
+def _write_shard(out_dir, shard_idx, rows, use_img):
+    name = f'{shard_idx:05d}'
+    shard_dir = os.path.join(out_dir, name)
+    os.makedirs(shard_dir, exist_ok=True)
+    tokenizer = get_tokenizer()
+
+    arrays = {'id': np.array([str(row[0]) for row in rows]),
+              'lang': np.array([LANGS[row[1]] for row in rows], dtype=np.int8)}
+    for field, column in SHARD_TEXT_FIELDS:
+        ids, lengths = getattr(tokenizer, f'encode_{field}')([row[column] for row in rows])
+        if ids.max(initial=0) > np.iinfo(np.int16).max:
+            row = rows[int(np.argmax(ids.max(axis=1)))]
+            raise ValueError(f'The {field} of entry {row[0]} has characters whose ids do not fit in int16.')
+        arrays[field] = ids.astype(np.int16)
+        arrays[f'{field}_len'] = lengths.astype(np.int16)
+    for key, array in arrays.items():
+        np.save(os.path.join(shard_dir, f'{key}.npy'), array)
+
+    if use_img:
+        # the images are decoded one by one into the mapped file
+        fig = np.lib.format.open_memmap(os.path.join(shard_dir, 'fig.npy'), mode='w+', dtype=np.uint8,
+                                        shape=(len(rows), 3, IMG_SIZE, IMG_SIZE))
+        for i, row in enumerate(rows):
+            fig[i] = load_shard_image(row[5])
+        fig.flush()
+        del fig
+    return {'name': name, 'size': len(rows)}
+
+
+def load_shard_image(img_path):
+    '''
+    :return: the image as a uint8 array of shape `(3, 224, 224)`
+    '''
+    return np.asarray(decode_image(img_path)).transpose(2, 0, 1)
+
+
+class M3InferenceShardDataset(IterableDataset):
+    '''
+    Reads the shards written by `compile_shards` and yields collated chunks of `(ids, batch, positions)` like
+    `M3InferenceStreamDataset` (with `positions=None`), straight from the memory-mapped arrays. The text of each chunk
+    is padded to its longest field. Use it with `DataLoader(..., batch_size=None)`. With multiple workers, chunk `i` is
+    handled by worker `i % num_workers`, which makes the DataLoader return the chunks in input order. The chunks do not
+    span shards.
+    '''
+
+    def __init__(self, shard_dir, use_img=True, chunk_size=BATCH_SIZE, uint8_images=False):
+        '''
+        :param shard_dir: the `out_dir` of `compile_shards`
+        :param use_img: whether to load the images (the shards must have been compiled with them)
+        :param chunk_size: the maximum number of entries per yielded chunk
+        :param uint8_images: whether to yield the images as uint8 tensors (with values in [0, 255]) rather than as float
+                             tensors in [0, 1], for models that convert them on the fly
+        '''
+        with open(os.path.join(shard_dir, SHARD_INDEX)) as f:
+            index = json.load(f)
+        assert index['use_img'] or not use_img, f'The shards in {shard_dir} were compiled without images.'
+        self.shard_dir = shard_dir
+        self.shards = index['shards']
+        self.use_img = use_img
+        self.chunk_size = chunk_size
+        self.uint8_images = uint8_images
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+
+        chunk_idx = 0
+        for shard in self.shards:
+            arrays = self._load_shard(shard['name'])
+            for start in range(0, shard['size'], self.chunk_size):
+                if chunk_idx % num_workers == worker_id:
+                    yield self._collate(arrays, slice(start, start + self.chunk_size))
+                chunk_idx += 1
+
+    def __len__(self):
+        # the number of chunks
+        return sum(-(-shard['size'] // self.chunk_size) for shard in self.shards)
+
+    def _load_shard(self, name):
+        keys = ['id', 'lang'] + [key for field, _ in SHARD_TEXT_FIELDS for key in [field, f'{field}_len']]
+        if self.use_img:
+            keys.append('fig')
+        return {key: np.load(os.path.join(self.shard_dir, name, f'{key}.npy'), mmap_mode='r') for key in keys}
+
+    def _collate(self, arrays, rows):
+        batch = [torch.from_numpy(arrays['lang'][rows].astype(np.int64))]
+        for field, _ in SHARD_TEXT_FIELDS:
+            lengths = arrays[f'{field}_len'][rows].astype(np.int64)
+            batch += [torch.from_numpy(arrays[field][rows, :lengths.max()].astype(np.int64)),
+                      torch.from_numpy(lengths)]
+        if self.use_img:
+            fig = torch.from_numpy(np.array(arrays['fig'][rows]))
+            batch.append(fig if self.uint8_images else fig.float().div_(255))
+        return arrays['id'][rows].tolist(), batch, None
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 # @Zijian Wang
 
+from functools import partial
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -12,16 +14,18 @@ class M3InferenceTextModel(nn.Module):
     def __init__(self, device='cuda' if torch.cuda.is_available() else 'cpu'):
         super(M3InferenceTextModel, self).__init__()
         self.device = device
-        self.batch_size = -1
+        # whether to run the towers concurrently (see `run_towers`)
+        self.concurrent_towers = False
 
         self.username_lang_embed = nn.Embedding(EMBEDDING_INPUT_SIZE_LANGS, EMBEDDING_OUTPUT_SIZE_LANGS,
-                                                padding_idx=EMB['<empty>'])
+                                                padding_idx=get_emb()['<empty>'])
         self.screenname_lang_embed = nn.Embedding(EMBEDDING_INPUT_SIZE_LANGS, EMBEDDING_OUTPUT_SIZE_LANGS,
-                                                  padding_idx=EMB['<empty>'])
+                                                  padding_idx=get_emb()['<empty>'])
         self.des_lang_embed = nn.Embedding(EMBEDDING_INPUT_SIZE_LANGS, EMBEDDING_OUTPUT_SIZE_LANGS,
-                                           padding_idx=EMB['<empty>'])
+                                           padding_idx=get_emb()['<empty>'])
 
-        self.username_embed = nn.Embedding(EMBEDDING_INPUT_SIZE, EMBEDDING_OUTPUT_SIZE, padding_idx=EMB['<empty>'])
+        self.username_embed = nn.Embedding(EMBEDDING_INPUT_SIZE, EMBEDDING_OUTPUT_SIZE,
+                                           padding_idx=get_emb()['<empty>'])
         self.username_dense = nn.Linear(in_features=EMBEDDING_OUTPUT_SIZE + EMBEDDING_OUTPUT_SIZE_LANGS,
                                         out_features=EMBEDDING_OUTPUT_SIZE)
         self.username_lstm = nn.LSTM(input_size=EMBEDDING_OUTPUT_SIZE, hidden_size=LSTM_HIDDEN_SIZE,
@@ -29,14 +33,14 @@ class M3InferenceTextModel(nn.Module):
         self._init_dense(self.username_dense)
 
         self.screenname_embed = nn.Embedding(EMBEDDING_INPUT_SIZE_ASCII, EMBEDDING_OUTPUT_SIZE_ASCII,
-                                             padding_idx=EMB['<empty>'])
+                                             padding_idx=get_emb()['<empty>'])
         self.screenname_dense = nn.Linear(in_features=EMBEDDING_OUTPUT_SIZE_ASCII + EMBEDDING_OUTPUT_SIZE_LANGS,
                                           out_features=EMBEDDING_OUTPUT_SIZE_ASCII)
         self.screenname_lstm = nn.LSTM(input_size=EMBEDDING_OUTPUT_SIZE_ASCII, hidden_size=LSTM_HIDDEN_SIZE,
                                        num_layers=LSTM_LAYER, batch_first=True, bidirectional=True, dropout=0.25)
         self._init_dense(self.screenname_dense)
 
-        self.des_embed = nn.Embedding(EMBEDDING_INPUT_SIZE, EMBEDDING_OUTPUT_SIZE, padding_idx=EMB['<empty>'])
+        self.des_embed = nn.Embedding(EMBEDDING_INPUT_SIZE, EMBEDDING_OUTPUT_SIZE, padding_idx=get_emb()['<empty>'])
         self.des_dense = nn.Linear(in_features=EMBEDDING_OUTPUT_SIZE + EMBEDDING_OUTPUT_SIZE_LANGS,
                                    out_features=EMBEDDING_OUTPUT_SIZE)
         self.des_lstm = nn.LSTM(input_size=EMBEDDING_OUTPUT_SIZE, hidden_size=LSTM_HIDDEN_SIZE,
@@ -57,81 +61,41 @@ class M3InferenceTextModel(nn.Module):
         nn.init.kaiming_normal_(layer.weight)
         nn.init.uniform_(layer.bias)
 
-    def _init_hidden(self):
-
-        self.username_h0 = torch.zeros(2 * LSTM_LAYER, self.batch_size, LSTM_HIDDEN_SIZE).to(self.device)
-        self.username_c0 = torch.zeros(2 * LSTM_LAYER, self.batch_size, LSTM_HIDDEN_SIZE).to(self.device)
+    def _encode_text(self, text, text_len, lang_embed, embed, dense, lstm):
+        # all state is local to the call, so that a model can be shared between threads
+        text_embed = dense(torch.cat([embed(text), lang_embed.unsqueeze(1).expand(-1, text.shape[1], -1)], 2))
 
-        self.screenname_h0 = torch.zeros(2 * LSTM_LAYER, self.batch_size, LSTM_HIDDEN_SIZE).to(self.device)
-        self.screenname_c0 = torch.zeros(2 * LSTM_LAYER, self.batch_size, LSTM_HIDDEN_SIZE).to(self.device)
+        # the packed sequence is sorted by length, and the final states are returned in the input order
+        text_pack = pack_padded_sequence(text_embed, text_len.cpu(), batch_first=True, enforce_sorted=False)
+        if isinstance(lstm, nn.LSTM):
+            # quantized LSTMs (see `quantization.py`) have no cuDNN weights to flatten
+            lstm.flatten_parameters()
+        # the initial hidden and cell states default to zeros
+        _, (text_h, _) = lstm(text_pack)
 
-        self.des_h0 = torch.zeros(2 * LSTM_LAYER_DES, self.batch_size, LSTM_HIDDEN_SIZE).to(self.device)
-        self.des_c0 = torch.zeros(2 * LSTM_LAYER_DES, self.batch_size, LSTM_HIDDEN_SIZE).to(self.device)
+        # final states of the last layer: the last step of the forward direction and the first step of the backward
+        # direction (the padded output is never built)
+        return torch.cat([text_h[-2], text_h[-1]], 1)
 
     def forward(self, data, label=None):
 
         lang, username, username_len, screenname, screenname_len, des, des_len = data
-        self.batch_size = len(lang)
-        self._init_hidden()
 
         username_lang_embed = self.username_lang_embed(lang)
         screenname_lang_embed = self.screenname_lang_embed(lang)
         des_lang_embed = self.des_lang_embed(lang)
 
-        self.merge_layer = []
-
-        username_embed = self.username_embed(username)
-
-        username_embed = self.username_dense(torch.cat([username_embed,
-                                                        username_lang_embed.unsqueeze(1).expand(self.batch_size,
-                                                                                                USERNAME_LEN,
-                                                                                                EMBEDDING_OUTPUT_SIZE_LANGS)],
-                                                       2))
-        username_pack, username_unsort = pack_wrapper(username_embed, username_len)
-        self.username_lstm.flatten_parameters()
-        username_out, (self.username_h0, self.username_c0) = self.username_lstm(username_pack, (
-            self.username_h0, self.username_c0))
-        username_output = unpack_wrapper(username_out, username_unsort)
-
-        self.merge_layer.append(torch.cat([username_output[torch.arange(0, self.batch_size, dtype=torch.int64),
-                                           username_len - 1, :LSTM_HIDDEN_SIZE],
-                                           username_output[torch.arange(0, self.batch_size, dtype=torch.int64),
-                                           torch.zeros(self.batch_size, dtype=torch.long), LSTM_HIDDEN_SIZE:]], 1))
-
-        screenname_embed = self.screenname_embed(screenname)
-
-        screenname_embed = self.screenname_dense(torch.cat([screenname_embed,
-                                                            screenname_lang_embed.unsqueeze(1).expand(
-                                                                self.batch_size, SCREENNAME_LEN,
-                                                                EMBEDDING_OUTPUT_SIZE_LANGS)], 2))
-
-        screenname_pack, screenname_unsort = pack_wrapper(screenname_embed, screenname_len)
-        self.screenname_lstm.flatten_parameters()
-        screenname_out, (self.screenname_h0, self.screenname_c0) = self.screenname_lstm(screenname_pack, (
-            self.screenname_h0, self.screenname_c0))
-        screenname_output = unpack_wrapper(screenname_out, screenname_unsort)
-        self.merge_layer.append(torch.cat([screenname_output[torch.arange(0, self.batch_size, dtype=torch.int64),
-                                           screenname_len - 1, :LSTM_HIDDEN_SIZE],
-                                           screenname_output[torch.arange(0, self.batch_size, dtype=torch.int64),
-                                           torch.zeros(self.batch_size, dtype=torch.long), LSTM_HIDDEN_SIZE:]], 1))
-
-        des_embed = self.des_embed(des)
-
-        des_embed = self.des_dense(torch.cat([des_embed,
-                                              des_lang_embed.unsqueeze(1).expand(self.batch_size, DES_LEN,
-                                                                                 EMBEDDING_OUTPUT_SIZE_LANGS)],
-                                             2))
-
-        des_pack, des_unsort = pack_wrapper(des_embed, des_len)
-        self.des_lstm.flatten_parameters()
-        des_out, (self.des_h0, self.des_c0) = self.des_lstm(des_pack, (self.des_h0, self.des_c0))
-        des_output = unpack_wrapper(des_out, des_unsort)
-        self.merge_layer.append(torch.cat(
-            [des_output[torch.arange(0, self.batch_size, dtype=torch.int64), des_len - 1, :LSTM_HIDDEN_SIZE],
-             des_output[torch.arange(0, self.batch_size, dtype=torch.int64),
-             torch.zeros(self.batch_size, dtype=torch.long), LSTM_HIDDEN_SIZE:]], 1))
-
-        merged_cat = torch.cat(self.merge_layer, 1)
+        towers = [
+            partial(self._encode_text, username, username_len, username_lang_embed, self.username_embed,
+                    self.username_dense, self.username_lstm),
+            partial(self._encode_text, screenname, screenname_len, screenname_lang_embed, self.screenname_embed,
+                    self.screenname_dense, self.screenname_lstm),
+            partial(self._encode_text, des, des_len, des_lang_embed, self.des_embed, self.des_dense, self.des_lstm)
+        ]
+
+        merge_layer = run_towers(towers, self.concurrent_towers)
+
+        merged_cat = torch.cat(merge_layer, 1)
 
         dense = F.relu(self.merge_dense(merged_cat), inplace=True)
         if label == "gender":
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import unicodedata
+
+import numpy as np
+
+from .consts import *
+
+MAX_CODEPOINT = 0x110000
+
+
+class CharTokenizer:
+    '''
+    Vectorized character encoder for the text fields.
+    The character ids (`get_emb`) and their unicode category fallbacks are compiled into codepoint lookup tables, so a
+    whole batch of strings is encoded with a few NumPy operations. The ids are identical to looking each character up
+    in the character ids.
+    '''
+
+    def __init__(self, emb=None):
+        emb = get_emb() if emb is None else emb
+        self.empty_id = emb['<empty>']
+
+        # fallback of each codepoint in descriptions: the embedding of its unicode category
+        cat_ids = {cat: emb[cat] for cat in UNICODE_CATS}
+        self.des_table = np.array([cat_ids[unicodedata.category(chr(i))] for i in range(MAX_CODEPOINT)],
+                                  dtype=np.int16)
+        # fallback of each codepoint in usernames: the unknown token
+        self.username_table = np.full(MAX_CODEPOINT, len(emb) + 1, dtype=np.int16)
+        for k, v in emb.items():
+            if len(k) == 1:
+                self.des_table[ord(k)] = v
+                self.username_table[ord(k)] = v
+
+    def encode_username(self, texts, pad_to_max_len=True):
+        return self._encode(texts, USERNAME_LEN, self.username_table, self.empty_id, pad_to_max_len)
+
+    def encode_screenname(self, texts, pad_to_max_len=True):
+        return self._encode(texts, SCREENNAME_LEN, None, 32, pad_to_max_len)
+
+    def encode_des(self, texts, pad_to_max_len=True):
+        return self._encode(texts, DES_LEN, self.des_table, self.empty_id, pad_to_max_len)
+
+    def _encode(self, texts, max_len, table, empty_id, pad_to_max_len=True):
+        '''
+        :param texts: a list of strings
+        :param max_len: the maximum length (longer strings are truncated)
+        :param table: codepoint-to-id lookup table, or `None` to use the codepoints as ids
+        :param empty_id: the id used for blank strings, which are encoded with length 1
+        :param pad_to_max_len: whether to pad to `max_len` rather than to the longest string of the batch
+        :return: an int64 array of ids of shape `(len(texts), padded length)` and an int64 array of lengths
+        '''
+        is_empty = np.array([text.strip(" ") == "" for text in texts], dtype=bool)
+        texts = ["" if empty else text[:max_len] for text, empty in zip(texts, is_empty)]
+        lengths = np.array([len(text) for text in texts], dtype=np.int64)
+        padded_len = max_len if pad_to_max_len else max(1, lengths.max(initial=0))
+
+        codepoints = np.frombuffer(''.join(texts).encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+        ids = codepoints.astype(np.int64) if table is None else table[codepoints].astype(np.int64)
+
+        # scatter the flat ids into the padded (row, position) layout
+        output = np.zeros((len(texts), padded_len), dtype=np.int64)
+        rows = np.repeat(np.arange(len(texts)), lengths)
+        starts = np.cumsum(lengths) - lengths
+        output[rows, np.arange(len(ids)) - starts[rows]] = ids
+
+        output[is_empty, 0] = empty_id
+        lengths[is_empty] = 1
+        return output, lengths
+
+
+_tokenizer = None
+
+
+def get_tokenizer():
+    '''
+    :return: the shared `CharTokenizer` (its lookup tables are built on the first call)
+    '''
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = CharTokenizer()
+    return _tokenizer
@@ -1,17 +1,20 @@
 #!/usr/bin/env python3
 # @Zijian Wang
 
+from concurrent.futures import ThreadPoolExecutor
 from random import shuffle
 
 import hashlib
+import json
 import logging
 import numpy as np
-import pycld2 as cld2
 import random
 import re
-import requests
 import shutil
 import tempfile
+import threading
+import torch
+import zipfile
 from torch.nn.utils.rnn import *
 from tqdm import tqdm
 
@@ -54,7 +57,41 @@ def unpack_wrapper(sents, idx_unsort):
     return h
 
 
+_tower_executor = None
+_tower_executor_lock = threading.Lock()
+
+
+def run_towers(towers, concurrent=False):
+    '''
+    Run the independent towers of a model, one after another or concurrently: on a shared thread pool in eager mode
+    (torch ops release the GIL), or as forked branches of the graph when the model is compiled by tracing.
+    :param towers: a list of functions without arguments, each returning a tensor
+    :param concurrent: whether to run the towers concurrently
+    :return: the list of the outputs of the towers
+    '''
+    if not concurrent:
+        return [tower() for tower in towers]
+    if torch.jit.is_tracing():
+        futures = [torch.jit.fork(tower) for tower in towers]
+        return [torch.jit.wait(future) for future in futures]
+
+    global _tower_executor
+    with _tower_executor_lock:
+        if _tower_executor is None:
+            _tower_executor = ThreadPoolExecutor(max_workers=TOWER_THREADS, thread_name_prefix='m3-tower')
+    # the grad mode is thread-local, so the pool threads follow the caller's (e.g. `torch.no_grad()`)
+    grad_enabled = torch.is_grad_enabled()
+
+    def run(tower):
+        with torch.set_grad_enabled(grad_enabled):
+            return tower()
+
+    futures = [_tower_executor.submit(run, tower) for tower in towers]
+    return [future.result() for future in futures]
+
+
 def get_lang(sent):
+    import pycld2 as cld2
     lang = cld2.detect(''.join([i for i in sent if i.isprintable()]), bestEffort=True)[2][0][1]
     return UNKNOWN_LANG if lang not in LANGS else lang
 
@@ -79,6 +116,7 @@ def fetch_pretrained_model(model_name, model_path):
             temp_file = tempfile.NamedTemporaryFile()
             logger.info(f'{model_path} not found in cache, downloading from {model_url} to {temp_file.name}')
 
+            import requests
             req = requests.get(model_url, stream=True)
             content_length = req.headers.get('Content-Length')
             total = int(content_length) if content_length is not None else None
@@ -114,15 +152,99 @@ def fetch_pretrained_model(model_name, model_path):
             break
 
 
+def file_md5(path):
+    '''
+    :return: the MD5 hex digest of a file, read in chunks of `MD5_CHUNK_SIZE` bytes into a reused buffer
+    '''
+    md5 = hashlib.md5()
+    buffer = bytearray(MD5_CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            md5.update(view[:n])
+    return md5.hexdigest()
+
+
+def file_stamp(path):
+    # a file is assumed unchanged as long as its size and modification time are
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def stamped_file_md5(path):
+    '''
+    :return: the MD5 of a file. It is saved with a stamp of the file next to it (`MD5_STAMP_SUFFIX`), and the file is
+    not hashed again until its size or modification time change.
+    '''
+    stamp = file_stamp(path)
+    stamp_path = path + MD5_STAMP_SUFFIX
+    try:
+        with open(stamp_path) as f:
+            saved_stamp = json.load(f)
+        if {k: saved_stamp.get(k) for k in stamp} == stamp and 'md5' in saved_stamp:
+            logger.info(f'MD5 of {path} was computed before.')
+            return saved_stamp['md5']
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    logger.info(f'Computing MD5 of {path}')
+    stamp['md5'] = file_md5(path)
+    try:
+        with open(stamp_path + '.tmp', 'w') as f:
+            json.dump(stamp, f)
+        os.replace(stamp_path + '.tmp', stamp_path)
+    except OSError as e:
+        logger.warning(f'Could not save the MD5 stamp of {path} ({e}). It will be hashed again next time.')
+    return stamp['md5']
+
+
 def check_file_md5(model_name, model_path):
+    '''
+    Check the MD5 of a model file (see `stamped_file_md5`).
+    :return: whether the MD5 matches
+    '''
     assert model_name in PRETRAINED_MODEL_MD5_MAP
     logger.info(f'Checking MD5 for model {model_name} at {model_path}')
-    correct_md5 = PRETRAINED_MODEL_MD5_MAP[model_name]
-    downloaded_md5 = hashlib.md5(open(model_path, 'rb').read()).hexdigest()
-    if correct_md5 == downloaded_md5:
+    if stamped_file_md5(model_path) == PRETRAINED_MODEL_MD5_MAP[model_name]:
         logger.info('MD5s match.')
         return True
     else:
         logger.error('MD5s mismatch. Consider clean your tmp dir (default: `./m3_tmp`) and retry,'
                      ' or download from the link in our github repo.')
         return False
+
+
+def mappable_weights(model_path):
+    '''
+    :return: the path of the weights at `model_path` in the zipfile format of `torch.save`, which `torch.load` can
+    memory-map: `model_path` itself, or a copy converted from the legacy format and saved next to it on first use
+    (`MAPPED_WEIGHTS_SUFFIX`). The copy records the MD5 of `model_path` it was converted from (`ARTIFACT_META_SUFFIX`),
+    and is converted again once `model_path` has another MD5. `None` if the copy cannot be saved.
+    '''
+    if zipfile.is_zipfile(model_path):
+        return model_path
+    mapped_path = os.path.splitext(model_path)[0] + MAPPED_WEIGHTS_SUFFIX
+    meta_path = mapped_path + ARTIFACT_META_SUFFIX
+    meta = {'weights_md5': stamped_file_md5(model_path)}
+    try:
+        with open(meta_path) as f:
+            if os.path.isfile(mapped_path) and json.load(f) == meta:
+                return mapped_path
+    except (OSError, ValueError):
+        pass
+    logger.info(f'Converting {model_path} to {mapped_path}, which can be memory-mapped.')
+    try:
+        # the copy is not recorded as converted from any weights until it is written
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        torch.save(torch.load(model_path, map_location='cpu', weights_only=True), mapped_path + '.tmp')
+        os.replace(mapped_path + '.tmp', mapped_path)
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+    except OSError as e:
+        logger.warning(f'Could not save {mapped_path} ({e}). The weights will be read into memory.')
+        return None
+    return mapped_path
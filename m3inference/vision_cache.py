@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import logging
+import os
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, where a cache dir must not be written by several processes at a time
+    fcntl = None
+
+from .consts import *
+
+logger = logging.getLogger(__name__)
+
+KEY_SIZE = 16
+VISION_EMBEDDING_SIZE = LSTM_HIDDEN_SIZE * 2
+
+
+def hash_image_file(img_path):
+    '''
+    :return: the content hash of an image file, used as its key in `VisionCache`
+    '''
+    h = hashlib.blake2b(digest_size=KEY_SIZE)
+    with open(img_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.digest()
+
+
+class VisionCache:
+    '''
+    Append-only on-disk cache of the vision embeddings (the output of `vision_model`) keyed by image content hash.
+    The embeddings are stored in a memory-mapped float32 file (`vectors.f32`) and the keys, in the same order, in
+    `keys.bin`. `meta.json` records the model the embeddings were computed with.
+    Writers sharing a cache dir append to both files under an exclusive lock (`lock`), and the files are cut to the
+    rows they both hold when the cache is opened or written, so that keys and vectors stay aligned.
+    '''
+
+    def __init__(self, cache_dir, model_tag, dim=VISION_EMBEDDING_SIZE, read_only=False):
+        '''
+        :param cache_dir: the dir to store the cache
+        :param model_tag: an identifier of the model weights; a cache built with other weights is rejected
+        :param dim: the size of the embeddings
+        :param read_only: whether to ignore `put`, e.g. in processes sharing the cache with a writer
+        '''
+        self.cache_dir = cache_dir
+        self.dim = dim
+        self.read_only = read_only
+        self.keys_path = os.path.join(cache_dir, 'keys.bin')
+        self.vectors_path = os.path.join(cache_dir, 'vectors.f32')
+        self.lock_path = os.path.join(cache_dir, 'lock')
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        meta_path = os.path.join(cache_dir, 'meta.json')
+        meta = {'model': model_tag, 'dim': dim}
+        with self._lock():
+            if os.path.isfile(meta_path):
+                with open(meta_path) as f:
+                    cached_meta = json.load(f)
+                if cached_meta != meta:
+                    raise ValueError(f'Vision cache at {cache_dir} was built for {cached_meta}, not {meta}. '
+                                     f'Please use another dir.')
+            else:
+                with open(meta_path, 'w') as f:
+                    json.dump(meta, f)
+
+        self._load_index()
+        logger.info(f'Vision cache at {cache_dir} loaded with {self.size} embeddings.')
+
+    @contextmanager
+    def _lock(self):
+        # an exclusive lock of the cache dir across processes, released when the lock file is closed
+        with open(self.lock_path, 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _aligned_size(self):
+        '''
+        :return: the number of rows held by both files. When written (under the lock), the files are cut to these rows.
+        '''
+        sizes = [(path, row_size, os.path.getsize(path) if os.path.isfile(path) else 0)
+                 for path, row_size in [(self.keys_path, KEY_SIZE), (self.vectors_path, self.dim * 4)]]
+        size = min(file_size // row_size for _, row_size, file_size in sizes)
+        for path, row_size, file_size in sizes:
+            # the tail of an interrupted write (or, when read-only, of a write in progress)
+            if not self.read_only and file_size != size * row_size:
+                logger.warning(f'{path} has {file_size - size * row_size} bytes past the {size} rows of the vision '
+                               f'cache, written by an interrupted process. They are dropped.')
+                with open(path, 'r+b') as f:
+                    f.truncate(size * row_size)
+        return size
+
+    def _read_keys(self, start, stop):
+        # the raw keys of rows `start` to `stop`
+        if stop <= start:
+            return []
+        with open(self.keys_path, 'rb') as f:
+            f.seek(start * KEY_SIZE)
+            data = f.read((stop - start) * KEY_SIZE)
+        return [data[i:i + KEY_SIZE] for i in range(0, len(data), KEY_SIZE)]
+
+    def _load_index(self):
+        if self.read_only:
+            self.size = self._aligned_size()
+        else:
+            with self._lock():
+                self.size = self._aligned_size()
+        keys = np.fromfile(self.keys_path, dtype=f'S{KEY_SIZE}', count=self.size) if self.size \
+            else np.empty(0, dtype=f'S{KEY_SIZE}')
+
+        order = np.argsort(keys, kind='stable')
+        self._sorted_keys = keys[order]
+        self._sorted_rows = order.astype(np.int64)
+        # entries added after the index was loaded
+        self._new_rows = {}
+        self._vectors = None
+
+    def __getstate__(self):
+        # the memmap is reopened lazily, e.g. in dataloader workers
+        state = self.__dict__.copy()
+        state['_vectors'] = None
+        return state
+
+    def __len__(self):
+        return self.size
+
+    def lookup(self, keys):
+        '''
+        :param keys: a list of image keys
+        :return: an int64 array with the row of each key, -1 for the keys not in the cache
+        '''
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        if len(keys) == 0:
+            return rows
+        if len(self._sorted_keys):
+            query = np.array(keys, dtype=f'S{KEY_SIZE}')
+            pos = np.searchsorted(self._sorted_keys, query).clip(max=len(self._sorted_keys) - 1)
+            found = self._sorted_keys[pos] == query
+            rows[found] = self._sorted_rows[pos[found]]
+        for i, key in enumerate(keys):
+            if rows[i] < 0:
+                rows[i] = self._new_rows.get(key, -1)
+        return rows
+
+    def get(self, rows):
+        '''
+        :param rows: rows returned by `lookup`
+        :return: a float32 array of shape `(len(rows), dim)`
+        '''
+        if self._vectors is None or len(self._vectors) < self.size:
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(self.size, self.dim))
+        return np.asarray(self._vectors[rows])
+
+    def put(self, keys, vectors):
+        '''
+        Add embeddings to the cache. Keys that are already cached are ignored.
+        :param keys: a list of image keys
+        :param vectors: a float array of shape `(len(keys), dim)`
+        '''
+        if self.read_only:
+            return
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self._lock():
+            # the rows appended by other processes since the index was loaded
+            size = self._aligned_size()
+            for row, key in enumerate(self._read_keys(self.size, size), self.size):
+                self._new_rows.setdefault(key, row)
+            self.size = size
+
+            new, seen = [], set()
+            for i, (key, row) in enumerate(zip(keys, self.lookup(keys))):
+                if row < 0 and key not in seen:
+                    seen.add(key)
+                    new.append(i)
+            if not new:
+                return
+            with open(self.vectors_path, 'ab') as f:
+                f.write(vectors[new].tobytes())
+            with open(self.keys_path, 'ab') as f:
+                f.write(b''.join(keys[i] for i in new))
+            for row, i in enumerate(new, self.size):
+                self._new_rows[keys[i]] = row
+            self.size += len(new)
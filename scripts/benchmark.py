@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import PIL.Image
+import torch
+
+from m3inference import M3Inference, M3Twitter
+from m3inference.consts import DOWNLOAD_THREADS, MAPPED_WEIGHTS_SUFFIX, MD5_STAMP_SUFFIX, PRED_CATS, \
+    PRETRAINED_MODEL_MD5_MAP, TW_DEFAULT_PROFILE_IMG
+from m3inference import parallel
+from m3inference.dataset import M3InferenceStreamDataset, decode_image
+from m3inference.output import OUTPUT_SINKS
+from m3inference.shards import M3InferenceShardDataset, compile_shards
+from m3inference.quantization import prediction_drift
+from m3inference.utils import file_md5
+
+logger = logging.getLogger()
+
+CHARS = list('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789' + ' ' * 12 + '.,!#@' + 'éüñçøłあ한😀')
+
+
+def synthetic_profiles(n, seed=0):
+    '''
+    Profiles with Twitter-like text lengths: a quarter of empty bios, log-normal bio lengths otherwise (capped at the
+    160 characters allowed by Twitter) and log-normal name lengths.
+    '''
+    rng = np.random.RandomState(seed)
+    des_lens = np.where(rng.rand(n) < 0.25, 0, np.clip(rng.lognormal(np.log(60), 0.8, n), 1, 160).astype(int))
+    name_lens = np.clip(rng.lognormal(np.log(12), 0.4, n), 1, 50).astype(int)
+    screen_name_lens = np.clip(rng.lognormal(np.log(10), 0.3, n), 1, 15).astype(int)
+    return [{'id': str(i),
+             'name': ''.join(rng.choice(CHARS, name_lens[i])),
+             'screen_name': ''.join(rng.choice(CHARS[:62], screen_name_lens[i])),
+             'description': ''.join(rng.choice(CHARS, des_lens[i])),
+             'lang': 'en',
+             'img_path': TW_DEFAULT_PROFILE_IMG} for i in range(n)]
+
+
+def timed(fn, repeat=1):
+    '''
+    :return: the best wall time of `repeat` calls of `fn` in seconds
+    '''
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_bucketing(args):
+    m3 = M3Inference(pretrained=False, use_full_model=args.full_model, use_cuda=False, skip_logging=True)
+    data = synthetic_profiles(args.n)
+    print(f'{args.n} profiles, batch_size={args.batch_size}')
+    for bucket_by_length in [False, True]:
+        seconds = timed(lambda: m3.infer(data, batch_size=args.batch_size, num_workers=args.num_workers,
+                                         bucket_by_length=bucket_by_length), args.repeat)
+        print(f'bucket_by_length={bucket_by_length}: {args.n / seconds:.1f} profiles/s')
+
+
+def bench_torchscript(args):
+    model_type = 'full_model' if args.full_model else 'text_model'
+    data = synthetic_profiles(args.n)
+    with tempfile.TemporaryDirectory() as model_dir:
+        M3Inference(pretrained=False, use_full_model=args.full_model, use_cuda=False, skip_logging=True) \
+            .export_torchscript(os.path.join(model_dir, f'{model_type}.pt'))
+        for use_torchscript in [False, True]:
+            start = time.perf_counter()
+            # the untrained eager model builds the same modules as the pretrained one, without the weight download
+            m3 = M3Inference(model_dir=model_dir, pretrained=use_torchscript, use_full_model=args.full_model,
+                             use_cuda=False, skip_logging=True, use_torchscript=use_torchscript)
+            startup = time.perf_counter() - start
+            seconds = timed(lambda: m3.infer(data, batch_size=args.batch_size, num_workers=args.num_workers),
+                            args.repeat)
+            print(f'use_torchscript={use_torchscript}: startup {startup:.2f}s, {args.n / seconds:.1f} profiles/s')
+
+
+def bench_onnxruntime(args):
+    data = synthetic_profiles(args.n)
+    for backend in ['torch', 'onnxruntime']:
+        m3 = M3Inference(pretrained=False, use_full_model=args.full_model, use_cuda=False, skip_logging=True,
+                         backend=backend)
+        for batch_size in sorted({1, args.batch_size}):
+            seconds = timed(lambda: m3.infer(data, batch_size=batch_size, num_workers=args.num_workers), args.repeat)
+            print(f'backend={backend}, batch_size={batch_size}: {args.n / seconds:.1f} profiles/s')
+
+
+def bench_quantize(args):
+    # the drift of untrained weights is only indicative: use --pretrained and --data to gate a release
+    if args.data is None:
+        data, n = synthetic_profiles(args.n), args.n
+    else:
+        with open(args.data) as f:
+            data, n = args.data, sum(1 for line in f if line.strip())
+    kwargs = dict(pretrained=args.pretrained, use_full_model=args.full_model, use_cuda=False, skip_logging=True)
+    if args.model_dir is not None:
+        kwargs['model_dir'] = args.model_dir
+    fp32 = M3Inference(**kwargs)
+    int8 = M3Inference(quantize='int8', quantize_calibration_data=data if args.quantize_vision else None, **kwargs)
+
+    seconds, results = {}, {}
+    for name, m3 in [('fp32', fp32), ('int8', int8)]:
+        seconds[name] = timed(lambda: m3.infer(data, output_format='dataframe', batch_size=args.batch_size,
+                                               num_workers=args.num_workers), args.repeat)
+        results[name] = m3.infer(data, output_format='dataframe', batch_size=args.batch_size,
+                                 num_workers=args.num_workers)
+        print(f'{name}: {n / seconds[name]:.1f} profiles/s')
+    print(f'speedup: {seconds["fp32"] / seconds["int8"]:.2f}x')
+
+    drift = prediction_drift(results['fp32'], results['int8'])
+    for cat, d in drift.items():
+        print(f'max {cat} probability drift: {d:.4f}')
+    if max(drift.values()) > args.max_drift:
+        raise SystemExit(f'The int8 model drifts by more than {args.max_drift} from the fp32 model.')
+
+
+def _vision_latency(vision_bf16, batch_size, repeat):
+    m3 = M3Inference(pretrained=False, use_cuda=False, skip_logging=True, vision_bf16=vision_bf16)
+    fig = torch.randint(0, 256, (batch_size, 3, 224, 224), dtype=torch.uint8)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with torch.no_grad():
+        # the images of the fp32 model are converted by the dataset (see `load_image`)
+        seconds = timed(lambda: m3._image_embedder(fig if vision_bf16 else fig.float().div_(255)), repeat)
+    return seconds, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) / 1024
+
+
+def bench_bf16(args):
+    # each run is in a fresh process, so that its peak memory is measured separately
+    with multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+        for vision_bf16 in [False, True]:
+            seconds, peak_mb = pool.apply(_vision_latency, (vision_bf16, args.batch_size, args.repeat))
+            print(f'vision_bf16={vision_bf16}: {seconds * 1000:.0f} ms per batch of {args.batch_size} images, '
+                  f'peak memory +{peak_mb:.0f} MB')
+
+    fp32 = M3Inference(pretrained=False, use_cuda=False, skip_logging=True)
+    bf16 = M3Inference(pretrained=False, use_cuda=False, skip_logging=True, vision_bf16=True)
+    fig = torch.randint(0, 256, (args.batch_size, 3, 224, 224), dtype=torch.uint8)
+    with torch.no_grad():
+        drift = (fp32._image_embedder(fig.float().div_(255)) - bf16._image_embedder(fig)).abs().max().item()
+    print(f'max vision embedding drift: {drift:.4f}')
+    if args.data is not None:
+        for cat, d in prediction_drift(*[m3.infer(args.data, output_format='dataframe', batch_size=args.batch_size,
+                                                  num_workers=args.num_workers) for m3 in [fp32, bf16]]).items():
+            print(f'max {cat} probability drift: {d:.4f}')
+
+
+def bench_towers(args):
+    data = synthetic_profiles(64)
+    print(f'{torch.get_num_threads()} intra-op threads')
+    models = {concurrent_towers: M3Inference(pretrained=False, use_full_model=args.full_model, use_cuda=False,
+                                             skip_logging=True, concurrent_towers=concurrent_towers).model
+              for concurrent_towers in [False, True]}
+    for batch_size in [1, 2, 4, 8, 16, 32, 64]:
+        # the images of the full model go through the vision model (no constant image)
+        _, batch, _ = next(iter(M3InferenceStreamDataset(data[:batch_size], use_img=args.full_model,
+                                                         chunk_size=batch_size)))
+        with torch.no_grad():
+            latencies = [timed(lambda: models[concurrent_towers](batch), args.repeat) * 1000
+                         for concurrent_towers in [False, True]]
+        print(f'batch_size={batch_size}: sequential {latencies[0]:.1f} ms, concurrent {latencies[1]:.1f} ms')
+
+
+def bench_parallel(args):
+    m3 = M3Inference(pretrained=False, use_full_model=args.full_model, use_cuda=False, skip_logging=True)
+    n_procs_list = sorted({2 ** i for i in range(args.max_procs.bit_length()) if 2 ** i <= args.max_procs} |
+                          {args.max_procs})
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_path = os.path.join(tmp_dir, 'data.jsonl')
+        with open(data_path, 'w') as f:
+            for entry in synthetic_profiles(args.n):
+                f.write(json.dumps(entry) + '\n')
+
+        seconds = timed(lambda: m3.infer(data_path, batch_size=args.batch_size, num_workers=args.num_workers),
+                        args.repeat)
+        print(f'infer: {args.n / seconds:.1f} profiles/s')
+        # the time to start the workers and build their models is included
+        for n_procs in n_procs_list:
+            seconds = timed(lambda: m3.parallel_infer(data_path, n_procs, args.threads_per_proc,
+                                                      batch_size=args.batch_size), args.repeat)
+            print(f'parallel_infer n_procs={n_procs}, threads_per_proc={args.threads_per_proc}: '
+                  f'{args.n / seconds:.1f} profiles/s')
+
+
+def _memory_mb():
+    # RSS counts the shared pages in full in every process, PSS divides them between the processes sharing them
+    with open('/proc/self/smaps_rollup') as f:
+        fields = dict(line.split(':', 1) for line in f if ':' in line and not line.startswith(' '))
+    return {key: int(fields[key].split()[0]) / 1024 for key in ['Rss', 'Pss']}
+
+
+_replica_barrier = None
+
+
+def _init_replica(init_kwargs, barrier):
+    global _replica_barrier
+    _replica_barrier = barrier
+    parallel._init_worker(init_kwargs, [], 1)
+
+
+def _replica_memory(data):
+    parallel._worker_m3.infer(data, num_workers=0)
+    # every replica is up when the memory is read
+    _replica_barrier.wait()
+    return dict(_memory_mb(), peak_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def bench_shared_weights(args):
+    m3 = M3Inference(pretrained=False, use_full_model=args.full_model, use_cuda=False, skip_logging=True)
+    data = synthetic_profiles(args.batch_size)
+    ctx = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        weights_path = os.path.join(tmp_dir, f'{m3.model_type}.pt')
+        m3.save_weights(weights_path)
+        print(f'weights: {os.path.getsize(weights_path) / 2 ** 20:.0f} MB')
+        for n_procs in sorted({1, 2, 4, args.max_procs}):
+            for path in [None, weights_path]:
+                barrier = ctx.Barrier(n_procs)
+                with ctx.Pool(n_procs, _init_replica, (dict(m3.init_kwargs, weights_path=path), barrier)) as pool:
+                    usage = pool.map(_replica_memory, [data] * n_procs, chunksize=1)
+                print(f'{n_procs} replicas, shared_weights={path is not None}: '
+                      f'total PSS {sum(u["Pss"] for u in usage):.0f} MB, '
+                      f'peak RSS per process {max(u["peak_rss"] for u in usage):.0f} MB')
+
+
+def _startup(model_dir, use_full_model, md5, legacy):
+    model_type = 'full_model' if use_full_model else 'text_model'
+    if md5 is not None:
+        PRETRAINED_MODEL_MD5_MAP[model_type] = md5
+    start = time.perf_counter()
+    if legacy:
+        # the loading before the MD5 stamps and the memory-mapped weights: the file is read whole to be hashed, and
+        # loaded into a model with allocated (and initialized) parameters
+        m3 = M3Inference(pretrained=False, use_full_model=use_full_model, use_cuda=False, skip_logging=True)
+        model_path = os.path.join(model_dir, f'{model_type}.mdl')
+        assert hashlib.md5(open(model_path, 'rb').read()).hexdigest() == PRETRAINED_MODEL_MD5_MAP[model_type]
+        m3.model.load_state_dict(torch.load(model_path, map_location='cpu'))
+    else:
+        M3Inference(model_dir=model_dir, use_full_model=use_full_model, use_cuda=False, skip_logging=True)
+    return time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_startup(args):
+    model_type = 'full_model' if args.full_model else 'text_model'
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model_dir, md5 = args.model_dir, None
+        if model_dir is None:
+            # untrained weights in the legacy format, in place of the pretrained ones
+            model_dir = tmp_dir
+            m3 = M3Inference(pretrained=False, use_full_model=args.full_model, use_cuda=False, skip_logging=True)
+            model_path = os.path.join(model_dir, f'{model_type}.mdl')
+            torch.save(m3.model.state_dict(), model_path, _use_new_zipfile_serialization=False)
+            md5 = file_md5(model_path)
+        model_path = os.path.join(model_dir, f'{model_type}.mdl')
+        for path in [model_path + MD5_STAMP_SUFFIX, os.path.splitext(model_path)[0] + MAPPED_WEIGHTS_SUFFIX]:
+            if os.path.isfile(path):
+                os.remove(path)
+        # the file is in the page cache for every run
+        file_md5(model_path)
+
+        # each start is in a fresh process, so that its peak memory is measured separately
+        with multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+            for name, legacy in [('read and hash whole file, load a copy', True), ('first start', False),
+                                 ('stamped, memory-mapped', False)]:
+                seconds, peak_mb = pool.apply(_startup, (model_dir, args.full_model, md5, legacy))
+                print(f'{name}: {seconds:.2f} s, peak RSS {peak_mb:.0f} MB')
+
+
+IMPORT_STATEMENTS = ['import m3inference', 'from m3inference import resize_imgs', 'from m3inference import M3Inference',
+                     'import torch']
+
+
+def bench_import(args):
+    # each import is timed in a fresh interpreter, without the time to start it
+    code = 'import time; start = time.perf_counter(); {}; print(time.perf_counter() - start)'
+    import_ms = {}
+    for statement in IMPORT_STATEMENTS:
+        import_ms[statement] = min(float(subprocess.run([sys.executable, '-c', code.format(statement)], check=True,
+                                                        capture_output=True, text=True).stdout) * 1000
+                                   for _ in range(args.repeat))
+        print(f'{statement}: {import_ms[statement]:.1f} ms')
+    if import_ms['import m3inference'] > args.budget_ms:
+        raise SystemExit(f'`import m3inference` takes more than {args.budget_ms} ms.')
+
+
+def synthetic_predictions(rows, batch_size, seed=0):
+    # batches of ids and probabilities with the shapes of the model outputs
+    rng = np.random.RandomState(seed)
+    pred = [rng.dirichlet(np.ones(len(values)), batch_size).astype(np.float32) for values in PRED_CATS.values()]
+    for start in range(0, rows, batch_size):
+        n = min(batch_size, rows - start)
+        yield [str(10 ** 17 + i) for i in range(start, start + n)], [_pred[:n] for _pred in pred]
+
+
+def _write_output(output_format, rows, batch_size, output_path):
+    start = time.perf_counter()
+    if output_format in OUTPUT_SINKS:
+        with OUTPUT_SINKS[output_format](output_path) as sink:
+            for ids, pred in synthetic_predictions(rows, batch_size):
+                sink.write(ids, pred)
+    else:
+        # the batches are kept until the end, as in `infer`
+        data, y_pred = [], []
+        for ids, pred in synthetic_predictions(rows, batch_size):
+            data.extend({'id': _id} for _id in ids)
+            y_pred.append([_pred.copy() for _pred in pred])
+        if output_format == 'json':
+            M3Inference.format_json_output(data, y_pred)
+        else:
+            M3Inference.format_dataframe_output(data, y_pred)
+    return time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_output(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # each format is written in a fresh process, so that its peak memory is measured separately
+        with multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+            for output_format in args.formats:
+                output_path = os.path.join(tmp_dir, f'predictions.{output_format}')
+                seconds, peak_mb = pool.apply(_write_output, (output_format, args.rows, args.batch_size, output_path))
+                print(f'{output_format}: {args.rows / seconds:.0f} rows/s, peak RSS {peak_mb:.0f} MB')
+
+
+def bench_shards(args):
+    m3 = M3Inference(pretrained=False, use_full_model=args.full_model, use_cuda=False, skip_logging=True)
+    # every image is decoded and goes through the vision model
+    m3.constant_images.clear()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_path = os.path.join(tmp_dir, 'data.jsonl')
+        img_path = os.path.join(tmp_dir, 'profile.png')
+        PIL.Image.open(TW_DEFAULT_PROFILE_IMG).convert('RGB').resize((224, 224), PIL.Image.BILINEAR).save(img_path)
+        with open(data_path, 'w') as f:
+            for entry in synthetic_profiles(args.n):
+                f.write(json.dumps(dict(entry, img_path=img_path)) + '\n')
+        shard_dir = os.path.join(tmp_dir, 'shards')
+        seconds = timed(lambda: compile_shards(data_path, shard_dir, use_img=args.full_model))
+        print(f'compile_shards: {args.n / seconds:.1f} profiles/s')
+
+        for name, path in [('jsonl', data_path), ('shards', shard_dir)]:
+            seconds = timed(lambda: m3.infer(path, batch_size=args.batch_size, num_workers=args.num_workers),
+                            args.repeat)
+            print(f'infer from {name}: {args.n / seconds:.1f} profiles/s')
+        batches = [batch for _, batch, _ in M3InferenceShardDataset(shard_dir, use_img=args.full_model,
+                                                                    chunk_size=args.batch_size)]
+        with torch.no_grad():
+            seconds = timed(lambda: [m3.model(batch) for batch in batches], args.repeat)
+        print(f'forward only: {args.n / seconds:.1f} profiles/s')
+
+
+def bench_decode(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args.sizes:
+            img_path = os.path.join(tmp_dir, f'profile_{size}.jpg')
+            PIL.Image.open(TW_DEFAULT_PROFILE_IMG).convert('RGB').resize((size, size), PIL.Image.BILINEAR) \
+                .save(img_path, quality=90)
+            full_decode = lambda: PIL.Image.open(img_path).convert('RGB').resize((224, 224), PIL.Image.BILINEAR)
+            for name, decode in [('full decode + resize', full_decode), ('draft decode + resize',
+                                                                         lambda: decode_image(img_path))]:
+                seconds = timed(lambda: [decode() for _ in range(args.n)], args.repeat)
+                print(f'{size}x{size} {name}: {seconds / args.n * 1000:.2f} ms/image')
+
+
+class DelayedHandler(SimpleHTTPRequestHandler):
+    # the latency of each request, in seconds
+    delay = 0
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+def bench_download(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        m3twitter = M3Twitter(cache_dir=os.path.join(tmp_dir, 'cache'), pretrained=False, use_full_model=False,
+                              use_cuda=False, skip_logging=True)
+        PIL.Image.open(TW_DEFAULT_PROFILE_IMG).convert('RGB').resize((400, 400), PIL.Image.BILINEAR) \
+            .save(os.path.join(tmp_dir, 'profile_400x400.jpg'))
+        handler = type('Handler', (DelayedHandler,), {'delay': args.latency_ms / 1000})
+        server = ThreadingHTTPServer(('127.0.0.1', 0), partial(handler, directory=tmp_dir))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        input_path = os.path.join(tmp_dir, 'tweets.jsonl')
+        with open(input_path, 'w') as f:
+            for i, entry in enumerate(synthetic_profiles(args.profiles)):
+                user = {'id_str': str(i), 'name': entry['name'], 'screen_name': entry['screen_name'],
+                        'description': '', 'default_profile_image': False,
+                        'profile_image_url_https': f'http://127.0.0.1:{server.server_address[1]}/profile_normal.jpg'}
+                f.write(json.dumps({'user': user}) + '\n')
+
+        def transform_serially():
+            # one blocking urllib request per line, as in earlier versions
+            with open(input_path) as f:
+                for line in f:
+                    m3twitter.transform_jsonl_object(line)
+
+        for name, transform in [('urllib, serial', transform_serially),
+                                ('pooled, 1 thread', lambda: m3twitter.transform_jsonl(input_path, os.devnull,
+                                                                                      download_threads=1)),
+                                (f'pooled, {args.download_threads} threads',
+                                 lambda: m3twitter.transform_jsonl(input_path, os.devnull,
+                                                                   download_threads=args.download_threads))]:
+            # the images are downloaded again by each run
+            m3twitter.cache_dir = tempfile.mkdtemp(dir=tmp_dir)
+            seconds = timed(transform)
+            print(f'{name}: {args.profiles / seconds:.1f} profiles/s')
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks of M3 inference on synthetic profiles (untrained weights).')
+    parser.add_argument('--n', type=int, default=2048, help='(Optional) The number of profiles')
+    parser.add_argument('--batch_size', type=int, default=64, help='(Optional) The batch size')
+    parser.add_argument('--num_workers', type=int, default=0, help='(Optional) The number of dataloader workers')
+    parser.add_argument('--repeat', type=int, default=3, help='(Optional) Report the best of this many runs')
+    parser.add_argument('--full_model', action='store_true', help='(Optional) Use the full model instead of the text model')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    subparsers.add_parser('bucketing', help='Throughput with and without length bucketing') \
+        .set_defaults(func=bench_bucketing)
+    subparsers.add_parser('torchscript', help='Startup time and throughput of the eager and TorchScript models') \
+        .set_defaults(func=bench_torchscript)
+    subparsers.add_parser('onnxruntime', help='Throughput of the torch and onnxruntime backends') \
+        .set_defaults(func=bench_onnxruntime)
+    quantize_parser = subparsers.add_parser('quantize', help='Speedup and prediction drift of the int8 model, which '
+                                                             'fails above a maximum drift')
+    quantize_parser.add_argument('--max_drift', type=float, default=0.05,
+                                 help='(Optional) The maximum drift of a predicted probability')
+    quantize_parser.add_argument('--quantize_vision', action='store_true',
+                                 help='(Optional) Also quantize the vision model, calibrated on the profiles')
+    quantize_parser.add_argument('--pretrained', action='store_true', help='(Optional) Use the pretrained weights')
+    quantize_parser.add_argument('--model_dir', default=None, help='(Optional) The dir of the pretrained weights')
+    quantize_parser.add_argument('--data', default=None,
+                                 help='(Optional) A jsonl file of profiles to use instead of synthetic ones')
+    quantize_parser.set_defaults(func=bench_quantize)
+    bf16_parser = subparsers.add_parser('bf16', help='Latency, peak memory and drift of the bfloat16 vision model')
+    bf16_parser.add_argument('--data', default=None,
+                             help='(Optional) A jsonl file of profiles to measure the prediction drift on')
+    bf16_parser.set_defaults(func=bench_bf16)
+    parallel_parser = subparsers.add_parser('parallel', help='Throughput scaling of `parallel_infer` from 1 to '
+                                                             '--max_procs processes')
+    parallel_parser.add_argument('--max_procs', type=int, default=os.cpu_count(),
+                                 help='(Optional) The maximum number of processes')
+    parallel_parser.add_argument('--threads_per_proc', type=int, default=1,
+                                 help='(Optional) The number of torch threads per process')
+    parallel_parser.set_defaults(func=bench_parallel)
+    shared_parser = subparsers.add_parser('shared_weights', help='Memory of 1 to --max_procs model replicas with '
+                                                                 'private and memory-mapped weights')
+    shared_parser.add_argument('--max_procs', type=int, default=8, help='(Optional) The maximum number of replicas')
+    shared_parser.set_defaults(func=bench_shared_weights)
+    startup_parser = subparsers.add_parser('startup', help='Time and peak memory to start a pretrained model, with '
+                                                           'and without MD5 stamps and memory-mapped weights')
+    startup_parser.add_argument('--model_dir', default=None,
+                                help='(Optional) The dir of the pretrained weights (untrained weights by default). '
+                                     'Their MD5 stamps and mappable copies are removed first.')
+    startup_parser.set_defaults(func=bench_startup)
+    import_parser = subparsers.add_parser('import', help='Import time of the package, which fails above a budget')
+    import_parser.add_argument('--budget_ms', type=float, default=50,
+                               help='(Optional) The maximum time of `import m3inference` in milliseconds')
+    import_parser.set_defaults(func=bench_import)
+    output_parser = subparsers.add_parser('output', help='Time and peak memory to output predictions of synthetic '
+                                                         'batches in each format')
+    output_parser.add_argument('--rows', type=int, default=10 ** 7, help='(Optional) The number of predicted rows')
+    output_parser.add_argument('--formats', nargs='+', default=['json', 'dataframe'] + list(OUTPUT_SINKS),
+                               help='(Optional) The output formats to compare')
+    output_parser.set_defaults(func=bench_output)
+    subparsers.add_parser('shards', help='Throughput of infer from a jsonl file and from compiled shards, and of the '
+                                         'forward pass alone').set_defaults(func=bench_shards)
+    decode_parser = subparsers.add_parser('decode', help='Time to decode JPEG images to 224x224 with and without '
+                                                         'draft mode')
+    decode_parser.add_argument('--sizes', type=int, nargs='+', default=[400, 800, 1600],
+                               help='(Optional) The widths (and heights) of the source images')
+    decode_parser.set_defaults(func=bench_decode)
+    download_parser = subparsers.add_parser('download', help='Throughput of `M3Twitter.transform_jsonl` downloading '
+                                                             'images from a local server with a simulated latency')
+    download_parser.add_argument('--profiles', type=int, default=256, help='(Optional) The number of profiles')
+    download_parser.add_argument('--latency_ms', type=float, default=50, help='(Optional) The latency of each request')
+    download_parser.add_argument('--download_threads', type=int, default=DOWNLOAD_THREADS,
+                                 help='(Optional) The number of threads of `transform_jsonl`')
+    download_parser.set_defaults(func=bench_download)
+    subparsers.add_parser('towers', help='Latency of a batch with sequential and concurrent towers at batch sizes '
+                                         '1 to 64').set_defaults(func=bench_towers)
+
+    args = parser.parse_args()
+    logger.setLevel(logging.WARN)
+    args.func(args)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import itertools
+import json
+import time
+
+import numpy as np
+
+
+async def post(reader, writer, path, payload):
+    body = json.dumps(payload).encode()
+    writer.write(f'POST {path} HTTP/1.1\r\nHost: m3\r\nContent-Type: application/json\r\n'
+                 f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+    return status, json.loads(await reader.readexactly(int(headers['content-length'])))
+
+
+async def client(args, entries, latencies, errors):
+    if args.unix_socket is not None:
+        reader, writer = await asyncio.open_unix_connection(args.unix_socket)
+    else:
+        reader, writer = await asyncio.open_connection(args.host, args.port)
+    for entry in entries:
+        start = time.perf_counter()
+        status, _ = await post(reader, writer, '/infer', entry)
+        latencies.append(time.perf_counter() - start)
+        if status != 200:
+            errors.append(status)
+    writer.close()
+
+
+async def main(args):
+    with open(args.data) as f:
+        data = [json.loads(line) for line in f if line.strip()]
+    # one request per entry, with unique ids
+    entries = [dict(entry, id=f'{entry["id"]}-{i}') for i, entry in zip(range(args.requests), itertools.cycle(data))]
+    latencies, errors = [], []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(args, entries[i::args.concurrency], latencies, errors)
+                           for i in range(args.concurrency)])
+    seconds = time.perf_counter() - start
+
+    print(f'{len(latencies)} requests, concurrency {args.concurrency}, {len(errors)} errors')
+    print(f'throughput: {len(latencies) / seconds:.1f} requests/s')
+    print(f'latency p50: {np.percentile(latencies, 50) * 1000:.1f} ms, '
+          f'p99: {np.percentile(latencies, 99) * 1000:.1f} ms')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test of the M3 inference server (see `scripts/serve.py`).')
+    parser.add_argument('--data', type=str, required=True,
+                        help='The jsonl file of the entries to send, one per request (cycled through)')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='(Optional) The host of the server')
+    parser.add_argument('--port', type=int, default=8000, help='(Optional) The port of the server')
+    parser.add_argument('--unix_socket', type=str, default=None,
+                        help='(Optional) The Unix socket of the server, instead of `--host` and `--port`')
+    parser.add_argument('--requests', type=int, default=1000, help='(Optional) The number of requests')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='(Optional) The number of concurrent clients, each sending requests one after another')
+    asyncio.run(main(parser.parse_args()))
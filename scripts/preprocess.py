@@ -3,6 +3,9 @@
 
 import argparse
 import logging
+import os
+import time
+from m3inference.consts import RESIZE_CHUNK_SIZE, setup_logging
 from m3inference.preprocess import resize_imgs, update_json
 
 
@@ -24,19 +27,33 @@ if __name__ == "__main__":
     parser.add_argument('--force', action='store_true', required=False,
                         help='(Optional) Force resizing every image, even if it exists in the output_dir.')
 
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), required=False,
+                        help='(Optional) The number of processes resizing images (the number of CPUs by default)')
+
+    parser.add_argument('--chunk_size', type=int, default=RESIZE_CHUNK_SIZE, required=False,
+                        help='(Optional) The number of images sent at a time to each process')
+
     parser.add_argument('--verbose', action='store_true', required=False, help='(Optional) Print debug message if set')
 
     parser.add_argument('--skip_logging', action='store_true', required=False, help='(Optional) Skip logging info if set. Overwrite `verbose`.')
 
     args = parser.parse_args()
 
+    # set up the log format before changing the level
+    setup_logging()
     if args.verbose:
         logger.setLevel(logging.DEBUG)
 
     if args.skip_logging:
         logging.getLogger().setLevel(logging.WARN)
 
-    resize_imgs(args.source_dir, args.output_dir, force=args.force)
+    start = time.perf_counter()
+    stats = resize_imgs(args.source_dir, args.output_dir, force=args.force, workers=args.workers,
+                        chunk_size=args.chunk_size)
+    seconds = time.perf_counter() - start
+    processed = stats['resized'] + stats['small'] + stats['failed']
+    print(f'Resized {stats["resized"]} images in {seconds:.1f}s ({processed / seconds:.1f} images/s), '
+          f'skipped {stats["unchanged"]} unchanged images.')
     if args.jsonl_path:
         assert args.jsonl_outpath is not None
         update_json(args.jsonl_path, args.jsonl_outpath, args.source_dir, args.output_dir)
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+
+from m3inference import M3Inference
+from m3inference.consts import SERVER_MAX_BATCH_SIZE, SERVER_MAX_WAIT_MS
+from m3inference.server import serve
+
+logger = logging.getLogger()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve M3 predictions over HTTP, batching concurrent requests.')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='(Optional) The host to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='(Optional) The port to listen on')
+    parser.add_argument('--unix_socket', type=str, default=None,
+                        help='(Optional) The path of a Unix socket to listen on instead of `--host` and `--port`')
+    parser.add_argument('--max_batch_size', type=int, default=SERVER_MAX_BATCH_SIZE,
+                        help='(Optional) The maximum number of entries per batch')
+    parser.add_argument('--max_wait_ms', type=float, default=SERVER_MAX_WAIT_MS,
+                        help='(Optional) The maximum time in milliseconds an entry waits for its batch to fill up')
+    parser.add_argument('--model_dir', type=str, default=None, help='(Optional) The dir of the pretrained models')
+    parser.add_argument('--text_model', action='store_true',
+                        help='(Optional) Use the text model instead of the full model')
+    parser.add_argument('--no_cuda', action='store_true', help='(Optional) Run on CPU even if there is a GPU')
+    parser.add_argument('--skip_logging', action='store_true', required=False, help='(Optional) Skip logging info if set.')
+    args = parser.parse_args()
+
+    kwargs = {} if args.model_dir is None else {'model_dir': args.model_dir}
+    m3 = M3Inference(use_full_model=not args.text_model, use_cuda=not args.no_cuda, skip_logging=args.skip_logging,
+                     **kwargs)
+    serve(m3, args.host, args.port, args.unix_socket, args.max_batch_size, args.max_wait_ms)
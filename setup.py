@@ -14,8 +14,9 @@ setuptools.setup(
     description='M3 Inference',
     long_description=long_description,
     long_description_content_type='text/markdown',
-    python_requires='>=3.6',
+    python_requires='>=3.8',
     install_requires=reqs.strip().split('\n'),
+    extras_require={'onnx': ['onnx', 'onnxruntime'], 'parquet': ['pyarrow']},
     url='https://github.com/euagendas/m3inference',
     include_package_data=True,
     license='GNU Affero General Public License v3.0',
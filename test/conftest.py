@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+from m3inference import resize_imgs, update_json
+
+TEST_DIR = os.path.dirname(__file__)
+
+
+@pytest.fixture(scope='session')
+def resized_data(tmp_path_factory):
+    '''
+    The path to a copy of `data.jsonl` whose images are resized to 224x224 (the test images are 400x400 and 399x399).
+    '''
+    tmp_path = tmp_path_factory.mktemp('resized')
+    resize_imgs(os.path.join(TEST_DIR, 'pic'), str(tmp_path / 'pic'), workers=1)
+    data_path = str(tmp_path / 'data.jsonl')
+    update_json(os.path.join(TEST_DIR, 'data.jsonl'), data_path, './test/pic', str(tmp_path / 'pic'))
+    return data_path
+
+
+def _assert_same_predictions(pred, expected):
+    assert list(pred) == list(expected)
+    for _id in expected:
+        for cat in expected[_id]:
+            for k, v in expected[_id][cat].items():
+                assert abs(pred[_id][cat][k] - v) < 1e-3
+
+
+@pytest.fixture
+def assert_same_predictions():
+    '''
+    Checks that two predictions in the `json` format have the same ids, in the same order, and close probabilities.
+    '''
+    return _assert_same_predictions
@@ -0,0 +1,109 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+from m3inference import M3Twitter
+from m3inference.consts import TW_DEFAULT_PROFILE_IMG
+from m3inference.preprocess import ImageDownloader
+
+PIC_DIR = os.path.join(os.path.dirname(__file__), 'pic')
+PIC_NAMES = sorted(name for name in os.listdir(PIC_DIR) if name.endswith('.jpg'))
+
+
+class PicHandler(SimpleHTTPRequestHandler):
+    '''
+    Serves `test/pic`, after `delay` seconds. The paths of `failures` get a 503 status the given number of times.
+    '''
+    delay = 0
+    failures = {}
+    active = 0
+    max_active = 0
+    lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=PIC_DIR, **kwargs)
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+            failed = cls.failures.get(self.path, 0) > 0
+            if failed:
+                cls.failures[self.path] -= 1
+        time.sleep(cls.delay)
+        # a request is no longer active once its response is sent, as the client may then reuse its connection
+        with cls.lock:
+            cls.active -= 1
+        if failed:
+            self.send_error(503)
+        else:
+            super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+class PicServer(ThreadingHTTPServer):
+
+    def handle_error(self, request, client_address):
+        # the client closed the connection of a timed out request
+        pass
+
+
+@contextmanager
+def pic_server(delay=0, failures=None):
+    handler = type('Handler', (PicHandler,), {'delay': delay, 'failures': dict(failures or {}),
+                                              'lock': threading.Lock()})
+    server = PicServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}', handler
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def write_tweets(path, base_url, names):
+    with open(path, 'w') as f:
+        for i, name in enumerate(names):
+            user = {'id_str': str(i), 'name': f'user {i}', 'screen_name': f'user{i}', 'description': '',
+                    'default_profile_image': False,
+                    'profile_image_url_https': f'{base_url}/{name.replace("_400x400", "_normal")}'}
+            f.write(json.dumps({'user': user}) + '\n')
+
+
+def test_transform_jsonl(tmp_path):
+    m3twitter = M3Twitter(cache_dir=str(tmp_path / 'cache'), pretrained=False, use_full_model=False, use_cuda=False,
+                          skip_logging=True)
+    names = PIC_NAMES * 3 + ['missing_400x400.jpg']
+    with pic_server(delay=0.05, failures={f'/{PIC_NAMES[0]}': 2}) as (base_url, handler):
+        input_path, output_path = str(tmp_path / 'tweets.jsonl'), str(tmp_path / 'm3_input.jsonl')
+        write_tweets(input_path, base_url, names)
+        downloader = ImageDownloader(per_host=2, backoff=0)
+        m3twitter.transform_jsonl(input_path, output_path, download_threads=8, downloader=downloader)
+    # the connections to the host are capped, and the failed download is retried
+    assert handler.max_active == 2
+    assert handler.failures[f'/{PIC_NAMES[0]}'] == 0
+
+    with open(output_path) as f:
+        entries = [json.loads(line) for line in f]
+    assert [entry['id'] for entry in entries] == [str(i) for i in range(len(names))]
+    for entry in entries[:-1]:
+        assert Image.open(entry['img_path']).size == (224, 224)
+    assert entries[-1]['img_path'] == TW_DEFAULT_PROFILE_IMG
+
+
+def test_download_timeout(tmp_path):
+    downloader = ImageDownloader(timeout=0.2, retries=1, backoff=0)
+    with pic_server(delay=1) as (base_url, _):
+        start = time.perf_counter()
+        assert downloader.download_resize_img(f'{base_url}/{PIC_NAMES[0]}', str(tmp_path / 'img.jpg')) is None
+        assert time.perf_counter() - start < 1
+    assert not os.path.exists(str(tmp_path / 'img.jpg'))
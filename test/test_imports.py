@@ -0,0 +1,20 @@
+import subprocess
+import sys
+
+HEAVY_MODULES = ['torch', 'torchvision', 'pandas', 'rauth', 'requests', 'pycld2']
+
+
+def imported_modules(statement):
+    code = f'import sys; {statement}; print(" ".join(sys.modules))'
+    return set(subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout.split())
+
+
+def test_import_is_lazy():
+    assert not imported_modules('import m3inference') & set(HEAVY_MODULES)
+    assert not imported_modules('from m3inference import resize_imgs') & set(HEAVY_MODULES)
+    assert imported_modules('from m3inference import M3Inference') & set(HEAVY_MODULES) == {'torch'}
+
+
+def test_import_does_not_configure_logging():
+    code = 'import logging, m3inference.m3inference, m3inference.m3twitter; print(len(logging.getLogger().handlers))'
+    assert subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout.strip() == '0'
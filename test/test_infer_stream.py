@@ -0,0 +1,150 @@
+import json
+import os
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader
+
+from m3inference import M3Inference
+from m3inference.consts import DES_LEN
+from m3inference.dataset import M3InferenceDataset, M3InferenceStreamDataset, decode_image
+from m3inference.output import PRED_COLUMNS
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), 'data.jsonl')
+
+
+def test_infer_stream_matches_infer():
+    m3 = M3Inference(pretrained=False, use_full_model=False, use_cuda=False, skip_logging=True)
+    expected = m3.infer(DATA_PATH, batch_size=3, num_workers=0)
+
+    for num_workers in [0, 2]:
+        streamed = {}
+        for chunk in m3.infer_stream(DATA_PATH, batch_size=3, num_workers=num_workers):
+            assert len(chunk) <= 3
+            streamed.update(chunk)
+        assert list(streamed) == list(expected)
+        assert streamed == expected
+
+    with open(DATA_PATH) as f:
+        entries = (json.loads(line) for line in f)
+        df = next(m3.infer_stream(entries, output_format='dataframe', batch_size=2, num_workers=0))
+    assert list(df['id']) == list(expected)[:2]
+
+
+def test_infer_stream_from_file_generator(tmp_path):
+    with open(DATA_PATH) as f:
+        entries = [json.loads(line) for line in f]
+    data_path = str(tmp_path / 'data.jsonl')
+    with open(data_path, 'w') as f:
+        for i in range(400):
+            f.write(json.dumps(dict(entries[i % len(entries)], id=str(i))) + '\n')
+
+    m3 = M3Inference(pretrained=False, use_full_model=False, use_cuda=False, skip_logging=True)
+    expected = m3.infer(data_path, batch_size=16, num_workers=0)
+    # the generator is read once, by this process, even with workers
+    with open(data_path) as f:
+        streamed = {}
+        for chunk in m3.infer_stream((json.loads(line) for line in f), batch_size=16, num_workers=2):
+            streamed.update(chunk)
+    assert list(streamed) == list(expected)
+    assert streamed == expected
+
+    with open(data_path) as f:
+        dataset = M3InferenceStreamDataset((json.loads(line) for line in f), use_img=False, chunk_size=16)
+        with pytest.raises(Exception, match='single process'):
+            list(DataLoader(dataset, batch_size=None, num_workers=2))
+
+
+def test_bucket_by_length_keeps_input_order(monkeypatch, assert_same_predictions):
+    monkeypatch.setattr('m3inference.m3inference.BUCKET_POOL_BATCHES', 2)
+    with open(DATA_PATH) as f:
+        entries = [json.loads(line) for line in f]
+    data = [dict(entry, id=f'{entry["id"]}_{i}') for i in range(5) for entry in entries]
+
+    m3 = M3Inference(pretrained=False, use_full_model=False, use_cuda=False, skip_logging=True)
+    expected = m3.infer(data, batch_size=3, num_workers=0)
+    for num_workers in [0, 2]:
+        pred = m3.infer(data, batch_size=3, num_workers=num_workers, bucket_by_length=True)
+        assert_same_predictions(pred, expected)
+
+    chunks = list(m3.infer_stream(data, output_format='dataframe', batch_size=3, num_workers=0,
+                                  bucket_by_length=True))
+    assert [len(df) for df in chunks] == [3] * 11 + [2]
+    assert [i for df in chunks for i in df['id']] == list(expected)
+
+
+def test_dynamic_padding_matches_fixed_padding():
+    with open(DATA_PATH) as f:
+        entries = [json.loads(line) for line in f]
+    m3 = M3Inference(pretrained=False, use_full_model=False, use_cuda=False, skip_logging=True)
+
+    fixed = next(iter(DataLoader(M3InferenceDataset(entries, use_img=False), batch_size=len(entries))))
+    _, dynamic, _ = next(iter(M3InferenceStreamDataset(entries, use_img=False, chunk_size=len(entries))))
+    assert fixed[5].shape[1] == DES_LEN
+    assert dynamic[5].shape[1] == max(dynamic[6])
+    with torch.no_grad():
+        for fixed_pred, dynamic_pred in zip(m3.model(fixed), m3.model(dynamic)):
+            assert torch.allclose(fixed_pred, dynamic_pred, atol=1e-6)
+
+
+def test_columnar_outputs(tmp_path):
+    m3 = M3Inference(pretrained=False, use_full_model=False, use_cuda=False, skip_logging=True)
+    expected = m3.infer(DATA_PATH, output_format='dataframe', batch_size=3, num_workers=0)
+
+    path = str(tmp_path / 'npy')
+    assert m3.infer(DATA_PATH, output_format='npy', batch_size=3, num_workers=0, output_path=path) == path
+    with open(os.path.join(path, 'id.txt')) as f:
+        assert f.read().split() == list(expected['id'])
+    for column in PRED_COLUMNS:
+        assert np.array_equal(np.load(os.path.join(path, f'{column}.npy'), mmap_mode='r'), expected[column].values)
+
+    pytest.importorskip('pyarrow')
+    import pyarrow
+    import pyarrow.parquet
+    m3.infer(DATA_PATH, output_format='parquet', batch_size=3, num_workers=0, output_path=str(tmp_path / 'out.parquet'))
+    m3.infer(DATA_PATH, output_format='arrow', batch_size=3, num_workers=0, output_path=str(tmp_path / 'out.arrow'))
+    for table in [pyarrow.parquet.read_table(str(tmp_path / 'out.parquet')),
+                  pyarrow.ipc.open_file(str(tmp_path / 'out.arrow')).read_all()]:
+        assert table.column_names == ['id'] + PRED_COLUMNS
+        df = table.to_pandas()
+        assert list(df['id']) == list(expected['id'])
+        assert np.array_equal(df[PRED_COLUMNS].values, expected[PRED_COLUMNS].values)
+
+    # integer ids are written as strings
+    with open(DATA_PATH) as f:
+        entries = [dict(json.loads(line), id=i) for i, line in enumerate(f)]
+    for output_format in ['parquet', 'arrow', 'npy']:
+        path = str(tmp_path / f'int_ids.{output_format}')
+        m3.infer(entries, output_format=output_format, batch_size=3, num_workers=0, output_path=path)
+        if output_format == 'npy':
+            with open(os.path.join(path, 'id.txt')) as f:
+                ids = f.read().split()
+        else:
+            ids = (pyarrow.parquet.read_table(path) if output_format == 'parquet' else
+                   pyarrow.ipc.open_file(path).read_all()).column('id').to_pylist()
+        assert ids == [str(i) for i in range(len(entries))]
+
+
+def test_images_are_resized_when_decoded(tmp_path):
+    # the test images are 400x400 and 399x399 JPEG and RGBA PNG files
+    with open(DATA_PATH) as f:
+        entries = [json.loads(line) for line in f]
+    resized = []
+    for entry in entries:
+        img_path = str(tmp_path / (os.path.basename(entry['img_path']) + '.png'))
+        Image.open(entry['img_path']).convert('RGB').resize((224, 224), Image.BILINEAR).save(img_path)
+        resized.append(dict(entry, img_path=img_path))
+
+    m3 = M3Inference(pretrained=False, use_cuda=False, skip_logging=True)
+    expected = m3.infer(resized, batch_size=4, num_workers=0)
+    assert m3.infer(entries, batch_size=4, num_workers=0) == expected
+
+    # large JPEG images are decoded at a reduced scale
+    img_path = str(tmp_path / 'large.jpg')
+    Image.open(entries[0]['img_path']).resize((1000, 1000), Image.BILINEAR).save(img_path, quality=95)
+    image = decode_image(img_path)
+    assert image.mode == 'RGB' and image.size == (224, 224)
+    reference = Image.open(img_path).convert('RGB').resize((224, 224), Image.BILINEAR)
+    assert np.abs(np.asarray(image, np.float32) - np.asarray(reference, np.float32)).mean() < 4
@@ -0,0 +1,230 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+import torch
+
+from m3inference import M3Inference
+from m3inference import dataset, m3inference
+from m3inference.consts import ARTIFACT_META_SUFFIX, LSTM_HIDDEN_SIZE, PRED_CATS, PRETRAINED_MODEL_MD5_MAP
+from m3inference.dataset import M3InferenceStreamDataset
+from m3inference.full_model import M3InferenceModel
+from m3inference.quantization import prediction_drift
+from m3inference.text_model import M3InferenceTextModel
+from m3inference.utils import file_md5, pack_wrapper, unpack_wrapper
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), 'data.jsonl')
+
+
+def test_forward_is_thread_safe():
+    with open(DATA_PATH) as f:
+        entries = [json.loads(line) for line in f]
+    model = M3InferenceTextModel(device='cpu').eval()
+    # batches of different sizes and lengths
+    batches = [batch for chunk_size in [1, 2, 3, 7]
+               for _, batch, _ in M3InferenceStreamDataset(entries, use_img=False, chunk_size=chunk_size)]
+
+    with torch.no_grad():
+        expected = [model(batch) for batch in batches]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(model, batches * 4))
+
+    for i, result in enumerate(results):
+        for pred, expected_pred in zip(result, expected[i % len(batches)]):
+            assert torch.allclose(pred, expected_pred, atol=1e-6)
+    assert not any(name.endswith('_h0') or name.endswith('_c0') for name in vars(model))
+
+
+def unpacked_encode_text(text, text_len, lang_embed, embed, dense, lstm):
+    # the original encoder, which reads the final states from the unpacked and unsorted LSTM output
+    text_embed = dense(torch.cat([embed(text), lang_embed.unsqueeze(1).expand(-1, text.shape[1], -1)], 2))
+    text_pack, text_unsort = pack_wrapper(text_embed, text_len)
+    text_out, _ = lstm(text_pack)
+    text_output = unpack_wrapper(text_out, text_unsort)
+    batch_idx = torch.arange(0, text.shape[0], dtype=torch.int64)
+    return torch.cat([text_output[batch_idx, text_len - 1, :LSTM_HIDDEN_SIZE],
+                      text_output[batch_idx, 0, LSTM_HIDDEN_SIZE:]], 1)
+
+
+def test_final_states_match_unpacked_output():
+    with open(DATA_PATH) as f:
+        entries = [json.loads(line) for line in f]
+    for model_class, use_img in [(M3InferenceTextModel, False), (M3InferenceModel, True)]:
+        model = model_class(device='cpu').eval()
+        for _, batch, _ in M3InferenceStreamDataset(entries, use_img=False, chunk_size=3):
+            if use_img:
+                batch = batch + [torch.rand(len(batch[0]), LSTM_HIDDEN_SIZE * 2)]
+            with torch.no_grad():
+                expected = model(batch)
+                model._encode_text = unpacked_encode_text
+                result = model(batch)
+                del model._encode_text
+            for pred, expected_pred in zip(result, expected):
+                assert torch.allclose(pred, expected_pred, atol=1e-6)
+
+
+def test_torchscript_matches_eager(tmp_path, resized_data, assert_same_predictions):
+    for use_full_model in [False, True]:
+        m3 = M3Inference(pretrained=False, use_full_model=use_full_model, use_cuda=False, skip_logging=True)
+        data_path = resized_data if use_full_model else DATA_PATH
+        expected = m3.infer(data_path, batch_size=3, num_workers=0)
+
+        model_type = 'full_model' if use_full_model else 'text_model'
+        m3.export_torchscript(str(tmp_path / f'{model_type}.pt'))
+        compiled = M3Inference(model_dir=str(tmp_path), use_full_model=use_full_model, use_cuda=False,
+                               skip_logging=True, use_torchscript=True)
+        assert isinstance(compiled.model, torch.jit.ScriptModule)
+        assert_same_predictions(compiled.infer(data_path, batch_size=3, num_workers=0), expected)
+        if use_full_model:
+            # images that are not keyed go through the compiled `embed_images`
+            compiled.constant_images.clear()
+            assert_same_predictions(compiled.infer(data_path, batch_size=3, num_workers=0), expected)
+
+
+def save_pretrained_text_model(model_dir, seed, monkeypatch):
+    m3 = M3Inference(pretrained=False, use_full_model=False, use_cuda=False, skip_logging=True, seed=seed)
+    model_path = os.path.join(model_dir, 'text_model.mdl')
+    m3.save_weights(model_path)
+    # a new mtime, even on file systems with a coarse resolution
+    os.utime(model_path, ns=(seed * 10 ** 9, seed * 10 ** 9))
+    monkeypatch.setitem(PRETRAINED_MODEL_MD5_MAP, 'text_model', file_md5(model_path))
+    return m3.infer(DATA_PATH, output_format='dataframe', batch_size=3, num_workers=0)
+
+
+def check_exported_model_follows_weights(model_dir, monkeypatch, **kwargs):
+    '''
+    Check that a model exported to `model_dir` is reused until the weights change.
+    :return: the names of the export functions called by the last load
+    '''
+    exports = []
+    for name in ['trace_model', 'export_onnx']:
+        monkeypatch.setattr(m3inference, name, lambda *args, _f=getattr(m3inference, name), _name=name:
+                            exports.append(_name) or _f(*args))
+    for seed in [1, 2]:
+        expected = save_pretrained_text_model(model_dir, seed, monkeypatch)
+        # exported from the new weights, then reused
+        for exported in [True, False]:
+            exports.clear()
+            m3 = M3Inference(model_dir=model_dir, use_full_model=False, use_cuda=False, skip_logging=True, **kwargs)
+            assert bool(exports) == exported
+            result = m3.infer(DATA_PATH, output_format='dataframe', batch_size=3, num_workers=0)
+            assert np.allclose(result.drop(columns='id').values, expected.drop(columns='id').values, atol=1e-5)
+    return exports
+
+
+def test_torchscript_follows_weights_and_options(tmp_path, monkeypatch):
+    exports = check_exported_model_follows_weights(str(tmp_path), monkeypatch, use_torchscript=True)
+    assert os.path.isfile(str(tmp_path / f'text_model.pt{ARTIFACT_META_SUFFIX}'))
+    # a model traced without concurrent towers is traced again
+    m3 = M3Inference(model_dir=str(tmp_path), use_full_model=False, use_cuda=False, skip_logging=True,
+                     use_torchscript=True, concurrent_towers=True)
+    assert exports == ['trace_model'] and 'prim::fork' in str(m3.model.inlined_graph)
+
+
+def test_onnx_follows_weights(tmp_path, monkeypatch):
+    pytest.importorskip('onnxruntime')
+    check_exported_model_follows_weights(str(tmp_path), monkeypatch, backend='onnxruntime')
+    assert os.path.isfile(str(tmp_path / f'text_model.onnx{ARTIFACT_META_SUFFIX}'))
+
+
+def test_onnxruntime_matches_torch(resized_data):
+    pytest.importorskip('onnxruntime')
+    for use_full_model in [False, True]:
+        m3 = M3Inference(pretrained=False, use_full_model=use_full_model, use_cuda=False, skip_logging=True)
+        data_path = resized_data if use_full_model else DATA_PATH
+        onnx = M3Inference(pretrained=False, use_full_model=use_full_model, use_cuda=False, skip_logging=True,
+                           backend='onnxruntime')
+        # batches of different sizes and lengths than the ones the models were exported with
+        for batch_size in [1, 7]:
+            expected = m3.infer(data_path, output_format='dataframe', batch_size=batch_size, num_workers=0)
+            result = onnx.infer(data_path, output_format='dataframe', batch_size=batch_size, num_workers=0)
+            assert list(result['id']) == list(expected['id'])
+            assert np.allclose(result.drop(columns='id').values, expected.drop(columns='id').values, atol=1e-5)
+
+
+def test_int8_quantization(resized_data):
+    for use_full_model in [False, True]:
+        data_path = resized_data if use_full_model else DATA_PATH
+        m3 = M3Inference(pretrained=False, use_full_model=use_full_model, use_cuda=False, skip_logging=True)
+        expected = m3.infer(data_path, output_format='dataframe', batch_size=3, num_workers=0)
+        quantized = M3Inference(pretrained=False, use_full_model=use_full_model, use_cuda=False, skip_logging=True,
+                                quantize='int8', quantize_calibration_data=data_path if use_full_model else None)
+        assert not isinstance(quantized.model.des_lstm, torch.nn.LSTM)
+        result = quantized.infer(data_path, output_format='dataframe', batch_size=3, num_workers=0)
+        assert list(result['id']) == list(expected['id'])
+        drift = prediction_drift(expected, result)
+        assert set(drift) == set(PRED_CATS)
+        assert all(0 < d < 0.1 for d in drift.values()), drift
+
+
+def test_vision_bf16(resized_data):
+    data_path = resized_data
+    _, batch, _ = next(iter(M3InferenceStreamDataset(data_path, chunk_size=3, uint8_images=True)))
+    assert batch[-1].dtype == torch.uint8
+
+    m3 = M3Inference(pretrained=False, use_cuda=False, skip_logging=True)
+    expected = m3.infer(data_path, output_format='dataframe', batch_size=3, num_workers=0)
+    bf16 = M3Inference(pretrained=False, use_cuda=False, skip_logging=True, vision_bf16=True)
+    # images that are not keyed go through the model's forward
+    for constant_images in [bf16.constant_images, {}]:
+        bf16.constant_images = constant_images
+        result = bf16.infer(data_path, output_format='dataframe', batch_size=3, num_workers=0)
+        assert list(result['id']) == list(expected['id'])
+        assert all(d < 0.05 for d in prediction_drift(expected, result).values())
+
+
+def test_cascade(resized_data, monkeypatch):
+    data_path = resized_data
+    decoded = []
+    decode_image = dataset.decode_image
+    monkeypatch.setattr(dataset, 'decode_image', lambda image_name: decoded.append(image_name) or
+                        decode_image(image_name))
+
+    def cascade_infer(thresholds):
+        m3 = M3Inference(pretrained=False, use_cuda=False, skip_logging=True, cascade=True,
+                         cascade_thresholds=thresholds)
+        decoded.clear()
+        return m3, m3.infer(data_path, output_format='dataframe', batch_size=3, num_workers=0)
+
+    _, text = cascade_infer({cat: 0 for cat in PRED_CATS})
+    _, full = cascade_infer({cat: 1.1 for cat in PRED_CATS})
+    assert set(text['model']) == {'text_model'} and set(full['model']) == {'full_model'}
+    assert len(decoded) == len(full)
+    _, text = cascade_infer({cat: 0 for cat in PRED_CATS})
+    assert not decoded
+    expected = M3Inference(pretrained=False, use_cuda=False, skip_logging=True) \
+        .infer(data_path, output_format='dataframe', batch_size=3, num_workers=0)
+    assert np.allclose(full.drop(columns=['id', 'model']).values, expected.drop(columns='id').values, atol=1e-6)
+
+    # only the entries with a text gender confidence below the median go through the full model
+    confidence = text[['gender_male', 'gender_female']].max(axis=1)
+    m3, mixed = cascade_infer({'gender': confidence.median(), 'age': 0, 'org': 0})
+    is_full = (confidence < confidence.median()).values
+    assert list(mixed['model']) == ['full_model' if i else 'text_model' for i in is_full]
+    assert m3.cascade_stats == {'entries': len(mixed), 'full_model': is_full.sum()}
+    # only the images of the entries going through the full model are decoded
+    assert len(decoded) == is_full.sum()
+    for rows, reference in [(is_full, full), (~is_full, text)]:
+        assert np.allclose(mixed[rows].drop(columns=['id', 'model']).values,
+                           reference[rows].drop(columns=['id', 'model']).values, atol=1e-6)
+    assert {pred['model'] for pred in m3.infer(data_path, batch_size=3, num_workers=0).values()} == \
+           {'text_model', 'full_model'}
+
+
+def test_concurrent_towers(resized_data):
+    data_path = resized_data
+    for use_full_model in [False, True]:
+        m3 = M3Inference(pretrained=False, use_full_model=use_full_model, use_cuda=False, skip_logging=True)
+        expected = m3.infer(data_path, output_format='dataframe', batch_size=3, num_workers=0)
+        for use_torchscript in [False, True]:
+            concurrent = M3Inference(pretrained=False, use_full_model=use_full_model, use_cuda=False,
+                                     skip_logging=True, use_torchscript=use_torchscript, concurrent_towers=True)
+            if use_torchscript:
+                assert 'prim::fork' in str(concurrent.model.inlined_graph)
+            if use_full_model:
+                # images that are not keyed make the vision model one of the concurrent towers
+                concurrent.constant_images.clear()
+            result = concurrent.infer(data_path, output_format='dataframe', batch_size=3, num_workers=0)
+            assert np.allclose(result.drop(columns='id').values, expected.drop(columns='id').values, atol=1e-6)
@@ -0,0 +1,38 @@
+import json
+import os
+
+from m3inference import M3Inference
+from m3inference.parallel import iter_jsonl_range, jsonl_byte_ranges
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), 'data.jsonl')
+
+
+def test_byte_ranges_cover_each_line_once(tmp_path):
+    lines = [json.dumps({'id': str(i), 'description': 'é🙂' * (i % 5)}, ensure_ascii=False) for i in range(50)]
+    path = tmp_path / 'data.jsonl'
+    path.write_text('\n'.join(lines[:20]) + '\n\n' + '\n'.join(lines[20:]), encoding='utf-8')
+
+    for n_ranges in [1, 2, 7, 50, 10000]:
+        ranges = jsonl_byte_ranges(str(path), n_ranges)
+        assert len(ranges) <= n_ranges
+        assert [line.strip() for start, end in ranges for line in iter_jsonl_range(str(path), start, end)] == lines
+
+
+def test_parallel_infer_matches_infer(assert_same_predictions):
+    m3 = M3Inference(pretrained=False, use_full_model=False, use_cuda=False, skip_logging=True)
+    expected = m3.infer(DATA_PATH, batch_size=2, num_workers=0)
+    assert_same_predictions(m3.parallel_infer(DATA_PATH, n_procs=2, batch_size=2), expected)
+    assert_same_predictions(m3.parallel_infer(DATA_PATH, n_procs=2, batch_size=2, share_weights=False), expected)
+    assert list(m3.parallel_infer(DATA_PATH, n_procs=3, output_format='dataframe', bucket_by_length=True)['id']) == \
+           list(expected)
+
+
+def test_mapped_weights(tmp_path, resized_data, assert_same_predictions):
+    data = resized_data
+    m3 = M3Inference(pretrained=False, use_cuda=False, skip_logging=True, seed=1)
+    weights_path = str(tmp_path / 'full_model.pt')
+    m3.save_weights(weights_path)
+
+    mapped = M3Inference(pretrained=False, use_cuda=False, skip_logging=True, weights_path=weights_path)
+    assert not any(param.is_meta for param in mapped.model.parameters())
+    assert_same_predictions(mapped.infer(data, num_workers=0), m3.infer(data, num_workers=0))
@@ -0,0 +1,77 @@
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+from PIL import Image
+
+from m3inference import preprocess
+from m3inference.consts import RESIZE_MANIFEST
+from m3inference.preprocess import load_manifest, resize_imgs, update_json
+
+TEST_DIR = os.path.dirname(__file__)
+PIC_DIR = os.path.join(TEST_DIR, 'pic')
+
+
+def test_resize_imgs(tmp_path, monkeypatch):
+    serial_dir, parallel_dir = str(tmp_path / 'serial'), str(tmp_path / 'parallel')
+    stats = resize_imgs(PIC_DIR, serial_dir, workers=1)
+    assert stats == {'resized': len(os.listdir(PIC_DIR))}
+    assert resize_imgs(PIC_DIR, parallel_dir, workers=2, chunk_size=2) == stats
+    for name in os.listdir(PIC_DIR):
+        name = os.path.splitext(name)[0] + '.jpeg'
+        image = Image.open(os.path.join(parallel_dir, name))
+        assert image.size == (224, 224)
+        assert np.array_equal(np.asarray(image), np.asarray(Image.open(os.path.join(serial_dir, name))))
+    assert len(load_manifest(os.path.join(parallel_dir, RESIZE_MANIFEST))) == len(os.listdir(PIC_DIR))
+
+    # unchanged images are skipped without being opened, changed ones are resized again
+    src_dir = tmp_path / 'src'
+    src_dir.mkdir()
+    for name in ['small.png', 'large.png']:
+        size = (100, 100) if name == 'small.png' else (400, 400)
+        Image.open(os.path.join(PIC_DIR, 'qM73ouCP_400x400.png')).resize(size).save(str(src_dir / name))
+    assert resize_imgs(str(src_dir), str(tmp_path / 'out'), workers=1) == {'resized': 1, 'small': 1}
+    with monkeypatch.context() as m:
+        m.setattr(Image, 'open', None)
+        assert resize_imgs(str(src_dir), str(tmp_path / 'out'), workers=1) == {'unchanged': 2}
+    os.utime(str(src_dir / 'large.png'), ns=(0, 0))
+    assert resize_imgs(str(src_dir), str(tmp_path / 'out'), workers=1) == {'resized': 1, 'unchanged': 1}
+
+
+def test_resize_imgs_without_main_guard(tmp_path):
+    # a script without an `if __name__ == '__main__':` guard resizes in its own process by default, and fails instead of
+    # hanging with more than one worker
+    script = tmp_path / 'resize.py'
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(TEST_DIR))
+    for kwargs, returncode in [('', 0), (', workers=2, chunk_size=2', 1)]:
+        script.write_text('from m3inference.preprocess import resize_imgs\n'
+                          f'resize_imgs({PIC_DIR!r}, {str(tmp_path / "out")!r}, force=True{kwargs})\n')
+        result = subprocess.run([sys.executable, str(script)], cwd=str(tmp_path), env=env, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, universal_newlines=True, timeout=120)
+        assert result.returncode == returncode
+    assert "`if __name__ == '__main__':` guard" in result.stderr
+
+
+def test_resize_imgs_without_manifest(tmp_path, monkeypatch):
+    dest_dir = str(tmp_path / 'resized')
+    resize_imgs(PIC_DIR, dest_dir, workers=1)
+    # the images resized by earlier versions, without a manifest, are kept
+    os.remove(os.path.join(dest_dir, RESIZE_MANIFEST))
+    monkeypatch.setattr(preprocess, 'resize_img', None)
+    assert resize_imgs(PIC_DIR, dest_dir, workers=1) == {'unchanged': len(os.listdir(PIC_DIR))}
+    assert resize_imgs(PIC_DIR, dest_dir, workers=1) == {'unchanged': len(os.listdir(PIC_DIR))}
+
+
+def test_update_json(tmp_path):
+    out_path = str(tmp_path / 'data.jsonl')
+    update_json(os.path.join(TEST_DIR, 'data.jsonl'), out_path, './test/pic', str(tmp_path / 'pic'))
+    with open(os.path.join(TEST_DIR, 'data.jsonl')) as f:
+        entries = [json.loads(line) for line in f]
+    with open(out_path) as f:
+        updated = [json.loads(line) for line in f]
+    assert [entry['id'] for entry in updated] == [entry['id'] for entry in entries]
+    for entry, updated_entry in zip(entries, updated):
+        name = os.path.splitext(os.path.basename(entry['img_path']))[0]
+        assert updated_entry['img_path'] == str(tmp_path / 'pic' / f'{name}.jpeg')
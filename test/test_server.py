@@ -0,0 +1,106 @@
+import asyncio
+import json
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import requests
+
+from m3inference import M3Inference
+from m3inference import m3inference
+from m3inference.server import M3InferenceServer
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), 'data.jsonl')
+
+
+@contextmanager
+def running_server(m3, unix_socket=None, **kwargs):
+    loop = asyncio.new_event_loop()
+    server = M3InferenceServer(m3, **kwargs)
+    asyncio_server = loop.run_until_complete(server.start(port=0, unix_socket=unix_socket))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        yield server, asyncio_server.sockets[0].getsockname()
+    finally:
+        asyncio.run_coroutine_threadsafe(shutdown(asyncio_server), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+async def shutdown(asyncio_server):
+    asyncio_server.close()
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def test_server_batches_concurrent_requests():
+    with open(DATA_PATH) as f:
+        entries = [json.loads(line) for line in f]
+    m3 = M3Inference(pretrained=False, use_full_model=False, use_cuda=False, skip_logging=True)
+    expected = m3.infer(entries, num_workers=0)
+
+    with running_server(m3, max_batch_size=4, max_wait_ms=200) as (server, (host, port)):
+        url = f'http://{host}:{port}/infer'
+        with ThreadPoolExecutor(max_workers=len(entries)) as executor:
+            responses = list(executor.map(lambda entry: requests.post(url, json=entry), entries))
+        for entry, response in zip(entries, responses):
+            assert response.status_code == 200
+            assert response.json() == {entry['id']: expected[entry['id']]}
+        # concurrent requests share batches
+        assert server.stats['entries'] == len(entries)
+        assert server.stats['batches'] < len(entries)
+
+        # a list of entries gets a single response
+        assert requests.post(url, json=entries).json() == json.loads(json.dumps(expected))
+        assert requests.post(url, data='{').status_code == 400
+        assert requests.post(url, json={'name': 'no id'}).status_code == 400
+        assert requests.get(f'http://{host}:{port}/health').json() == {'status': 'ok'}
+
+
+def test_predict_entries(resized_data, assert_same_predictions, monkeypatch):
+    with open(resized_data) as f:
+        entries = [json.loads(line) for line in f]
+    m3 = M3Inference(pretrained=False, use_cuda=False, skip_logging=True, cascade=True,
+                     cascade_thresholds={'gender': 1.1})
+    expected = m3.infer(entries, num_workers=0)
+    assert m3.cascade_stats['full_model'] == len(entries)
+    stats = m3.vision_stats, m3.cascade_stats
+
+    # no dataloader or progress bar is started, and the stats of `infer` are kept
+    monkeypatch.setattr(m3inference, 'DataLoader', None)
+    monkeypatch.setattr(m3inference, 'tqdm', None)
+    results = m3.predict_entries(entries)
+    assert [list(result) for result in results] == [[entry['id']] for entry in entries]
+    pred = {_id: dict(pred) for result in results for _id, pred in result.items()}
+    assert all(pred[_id].pop('model') == expected[_id].pop('model') == 'full_model' for _id in expected)
+    assert_same_predictions(pred, expected)
+    assert (m3.vision_stats, m3.cascade_stats) == stats
+
+
+def test_server_unix_socket(tmp_path):
+    entry = {'id': '1', 'name': 'M3', 'screen_name': 'm3inference', 'description': 'Demographic inference', 'lang': 'en'}
+    m3 = M3Inference(pretrained=False, use_full_model=False, use_cuda=False, skip_logging=True)
+    expected = m3.infer([entry], num_workers=0)
+
+    unix_socket = str(tmp_path / 'm3.sock')
+    with running_server(m3, unix_socket=unix_socket):
+        body = json.dumps(entry).encode()
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.connect(unix_socket)
+            sock.sendall(b'POST /infer HTTP/1.1\r\nConnection: close\r\n'
+                         b'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+            response = b''
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                response += chunk
+    headers, _, payload = response.partition(b'\r\n\r\n')
+    assert headers.startswith(b'HTTP/1.1 200')
+    assert json.loads(payload) == json.loads(json.dumps(expected))
@@ -0,0 +1,37 @@
+import os
+
+import numpy as np
+
+from m3inference import M3Inference, compile_shards
+from m3inference.consts import SHARD_INDEX
+from m3inference.shards import M3InferenceShardDataset
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), 'data.jsonl')
+
+
+def test_shards_match_infer(tmp_path, resized_data, assert_same_predictions):
+    data = resized_data
+    shard_dir = str(tmp_path / 'shards')
+    assert compile_shards(data, shard_dir, shard_size=3) == 7
+    assert os.path.isfile(os.path.join(shard_dir, SHARD_INDEX))
+    assert np.load(os.path.join(shard_dir, '00000', 'des.npy')).dtype == np.int16
+    assert np.load(os.path.join(shard_dir, '00000', 'fig.npy')).shape == (3, 3, 224, 224)
+    assert len(M3InferenceShardDataset(shard_dir, chunk_size=2)) == 5
+
+    m3 = M3Inference(pretrained=False, use_cuda=False, skip_logging=True)
+    # every image goes through the vision model, as with the shards
+    m3.constant_images.clear()
+    expected = m3.infer(data, batch_size=2, num_workers=0)
+    for num_workers in [0, 2]:
+        assert_same_predictions(m3.infer(shard_dir, batch_size=2, num_workers=num_workers), expected)
+
+
+def test_text_shards(tmp_path):
+    shard_dir = str(tmp_path / 'shards')
+    compile_shards(DATA_PATH, shard_dir, use_img=False)
+    assert not os.path.isfile(os.path.join(shard_dir, '00000', 'fig.npy'))
+
+    m3 = M3Inference(pretrained=False, use_full_model=False, use_cuda=False, skip_logging=True)
+    expected = m3.infer(DATA_PATH, batch_size=3, num_workers=0)
+    assert m3.infer(shard_dir, batch_size=3, num_workers=0) == expected
+    assert list(m3.infer(shard_dir, output_format='dataframe', num_workers=0)['id']) == list(expected)
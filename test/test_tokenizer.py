@@ -0,0 +1,42 @@
+import json
+import os
+import unicodedata
+
+from m3inference.consts import EMB, USERNAME_LEN, SCREENNAME_LEN, DES_LEN
+from m3inference.tokenizer import get_tokenizer
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), 'data.jsonl')
+
+
+def reference_encode(text, max_len, char_to_id, empty_id):
+    # the original per-character encoding of `M3InferenceDataset`
+    ids = [0] * max_len
+    if text.strip(" ") == "":
+        ids[0] = empty_id
+        return ids, 1
+    text = text[:max_len]
+    ids[:len(text)] = [char_to_id(i) for i in text]
+    return ids, len(text)
+
+
+def test_tokenizer_matches_reference():
+    with open(DATA_PATH) as f:
+        entries = [json.loads(line) for line in f]
+    texts = [e[k] for e in entries for k in ['name', 'screen_name', 'description']]
+    texts += ['', '   ', ' ' * 40 + 'abc', 'x' * 300, '⃌\U0001F1FA\U0001F1F8\ud83c', 'あ\u0000\t\U000E0001']
+
+    tokenizer = get_tokenizer()
+    for encode, max_len, char_to_id, empty_id in [
+        (tokenizer.encode_username, USERNAME_LEN, lambda c: EMB.get(c, len(EMB) + 1), EMB['<empty>']),
+        (tokenizer.encode_screenname, SCREENNAME_LEN, ord, 32),
+        (tokenizer.encode_des, DES_LEN, lambda c: EMB.get(c, EMB[unicodedata.category(c)]), EMB['<empty>'])]:
+        ids, lengths = encode(texts)
+        assert ids.shape == (len(texts), max_len)
+        for text, row_ids, length in zip(texts, ids, lengths):
+            expected_ids, expected_len = reference_encode(text, max_len, char_to_id, empty_id)
+            assert list(row_ids) == expected_ids
+            assert length == expected_len
+
+    ids, lengths = tokenizer.encode_des(['ab', 'abcd', ''], pad_to_max_len=False)
+    assert ids.shape == (3, 4)
+    assert list(lengths) == [2, 4, 1]
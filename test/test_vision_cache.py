@@ -0,0 +1,96 @@
+import json
+import shutil
+
+import numpy as np
+
+from m3inference import M3Inference
+from m3inference.consts import TW_DEFAULT_PROFILE_IMG
+from m3inference.vision_cache import KEY_SIZE, VisionCache
+
+def test_vision_cache(tmp_path, resized_data, assert_same_predictions):
+    data_path = resized_data
+    cache_dir = str(tmp_path / 'cache')
+
+    m3 = M3Inference(pretrained=False, use_cuda=False, skip_logging=True)
+    expected = m3.infer(data_path, batch_size=4, num_workers=0)
+
+    m3 = M3Inference(pretrained=False, use_cuda=False, skip_logging=True, vision_cache_dir=cache_dir)
+    assert_same_predictions(m3.infer(data_path, batch_size=4, num_workers=0), expected)
+    assert len(m3.vision_cache) == len(expected)
+
+    # a new run reads every embedding from the cache without running the vision model
+    m3 = M3Inference(pretrained=False, use_cuda=False, skip_logging=True, vision_cache_dir=cache_dir)
+    m3.model.vision_model.forward = None
+    assert_same_predictions(m3.infer(data_path, batch_size=4, num_workers=2), expected)
+    assert len(m3.vision_cache) == len(expected)
+    assert np.isfinite(m3.vision_cache.get(np.arange(len(expected)))).all()
+
+
+def test_constant_images(tmp_path, resized_data, assert_same_predictions):
+    data_path = resized_data
+    with open(data_path) as f:
+        data = [json.loads(line) for line in f]
+    # a copy of the default image is recognized by its content
+    shutil.copy(TW_DEFAULT_PROFILE_IMG, str(tmp_path / 'default_copy.png'))
+    for entry in data[:3]:
+        entry['img_path'] = TW_DEFAULT_PROFILE_IMG
+    data[3]['img_path'] = str(tmp_path / 'default_copy.png')
+
+    m3 = M3Inference(pretrained=False, use_cuda=False, skip_logging=True)
+    m3.constant_images.clear()
+    expected = m3.infer(data, batch_size=len(data), num_workers=0)
+
+    m3 = M3Inference(pretrained=False, use_cuda=False, skip_logging=True)
+    vision_batch_sizes = []
+    m3.model.vision_model.register_forward_hook(lambda module, inputs, output: vision_batch_sizes.append(len(output)))
+    assert_same_predictions(m3.infer(data, batch_size=len(data), num_workers=0), expected)
+    assert vision_batch_sizes == [len(data) - 4]
+
+
+def test_duplicated_images(tmp_path, resized_data, assert_same_predictions):
+    data_path = resized_data
+    with open(data_path) as f:
+        data = [json.loads(line) for line in f]
+    data[1]['img_path'] = data[0]['img_path']
+    data[2]['img_path'] = data[0]['img_path']
+    # the same image under another path
+    shutil.copy(data[0]['img_path'], str(tmp_path / 'copy.jpeg'))
+    data[3]['img_path'] = str(tmp_path / 'copy.jpeg')
+
+    m3 = M3Inference(pretrained=False, use_cuda=False, skip_logging=True)
+    vision_batch_sizes = []
+    m3.model.vision_model.register_forward_hook(lambda module, inputs, output: vision_batch_sizes.append(len(output)))
+    pred = m3.infer(data, batch_size=len(data), num_workers=0)
+    assert vision_batch_sizes == [len(data) - 3]
+    assert m3.vision_stats['duplicate'] == 3
+    assert m3.vision_stats['computed'] == len(data) - 3
+
+    m3.constant_images.clear()
+    assert_same_predictions(pred, m3.infer(data, batch_size=len(data), num_workers=0))
+    assert not m3.vision_stats
+
+
+def test_shared_vision_cache(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    keys = [bytes([i]) * KEY_SIZE for i in range(6)]
+    vectors = np.arange(6 * 4, dtype=np.float32).reshape(6, 4)
+
+    # two writers sharing a dir append in turns, each picking up the rows of the other when it writes
+    first, second = VisionCache(cache_dir, 'model', dim=4), VisionCache(cache_dir, 'model', dim=4)
+    first.put(keys[:2], vectors[:2])
+    second.put(keys[1:4], vectors[1:4])
+    first.put(keys[3:5], vectors[3:5])
+    for cache, n_keys in [(first, 5), (second, 4), (VisionCache(cache_dir, 'model', dim=4), 5)]:
+        rows = cache.lookup(keys[:n_keys])
+        assert (rows >= 0).all()
+        assert np.array_equal(cache.get(rows), vectors[:n_keys])
+    assert len(VisionCache(cache_dir, 'model', dim=4)) == 5
+
+    # vectors written without their keys by an interrupted process are dropped
+    with open(first.vectors_path, 'ab') as f:
+        f.write(vectors[5].tobytes()[:10])
+    cache = VisionCache(cache_dir, 'model', dim=4)
+    assert len(cache) == 5
+    cache.put(keys[5:], vectors[5:])
+    cache = VisionCache(cache_dir, 'model', dim=4)
+    assert np.array_equal(cache.get(cache.lookup(keys)), vectors)
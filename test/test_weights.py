@@ -0,0 +1,66 @@
+import hashlib
+import os
+
+import torch
+
+from m3inference import M3Inference
+from m3inference import utils
+from m3inference.consts import MAPPED_WEIGHTS_SUFFIX, MD5_STAMP_SUFFIX, PRETRAINED_MODEL_MD5_MAP
+from m3inference.utils import check_file_md5, file_md5
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), 'data.jsonl')
+
+
+def test_file_md5(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'MD5_CHUNK_SIZE', 1000)
+    path = tmp_path / 'model.mdl'
+    content = os.urandom(4321)
+    path.write_bytes(content)
+    assert file_md5(str(path)) == hashlib.md5(content).hexdigest()
+
+
+def test_md5_stamp(tmp_path, monkeypatch):
+    path = tmp_path / 'text_model.mdl'
+    path.write_bytes(b'weights')
+    monkeypatch.setitem(PRETRAINED_MODEL_MD5_MAP, 'text_model', hashlib.md5(b'weights').hexdigest())
+    assert check_file_md5('text_model', str(path))
+    assert os.path.isfile(str(path) + MD5_STAMP_SUFFIX)
+
+    # the stamp matches: the file is not hashed
+    with monkeypatch.context() as m:
+        m.setattr(utils, 'file_md5', None)
+        assert check_file_md5('text_model', str(path))
+
+    # the file changed: it is hashed again
+    path.write_bytes(b'changed')
+    assert not check_file_md5('text_model', str(path))
+
+
+def test_pretrained_weights_are_mapped(tmp_path, monkeypatch):
+    m3 = M3Inference(pretrained=False, use_full_model=False, use_cuda=False, skip_logging=True, seed=1)
+    model_path = str(tmp_path / 'text_model.mdl')
+    # the pretrained weights were saved in the legacy format
+    torch.save(m3.model.state_dict(), model_path, _use_new_zipfile_serialization=False)
+    monkeypatch.setitem(PRETRAINED_MODEL_MD5_MAP, 'text_model', file_md5(model_path))
+
+    pretrained = M3Inference(model_dir=str(tmp_path), use_full_model=False, use_cuda=False, skip_logging=True)
+    assert pretrained.weights_path == str(tmp_path / f'text_model{MAPPED_WEIGHTS_SUFFIX}')
+    expected = m3.infer(DATA_PATH, num_workers=0)
+    assert pretrained.infer(DATA_PATH, num_workers=0) == expected
+
+    # the converted copy and the MD5 stamp are reused
+    mtime = os.stat(pretrained.weights_path).st_mtime_ns
+    monkeypatch.setattr(utils, 'file_md5', None)
+    pretrained = M3Inference(model_dir=str(tmp_path), use_full_model=False, use_cuda=False, skip_logging=True)
+    assert os.stat(pretrained.weights_path).st_mtime_ns == mtime
+    assert pretrained.infer(DATA_PATH, num_workers=0) == expected
+    monkeypatch.undo()
+
+    # other weights with an older mtime (e.g. copied with `cp -p`) are converted again
+    other = M3Inference(pretrained=False, use_full_model=False, use_cuda=False, skip_logging=True, seed=2)
+    torch.save(other.model.state_dict(), model_path, _use_new_zipfile_serialization=False)
+    os.utime(model_path, ns=(0, 0))
+    monkeypatch.setitem(PRETRAINED_MODEL_MD5_MAP, 'text_model', file_md5(model_path))
+    pretrained = M3Inference(model_dir=str(tmp_path), use_full_model=False, use_cuda=False, skip_logging=True)
+    assert pretrained.weights_path == str(tmp_path / f'text_model{MAPPED_WEIGHTS_SUFFIX}')
+    assert pretrained.infer(DATA_PATH, num_workers=0) == other.infer(DATA_PATH, num_workers=0)